@@ -0,0 +1,80 @@
+""" Micro-benchmark for the per-call overhead FilterMongoCollection adds on
+    top of pymongo.
+
+    Usage: python benchmarks/bench_update_one.py [mongo uri]
+
+    The first section needs no server: it times turning the arguments of an
+    update_one call into callargs (inspect.getcallargs vs the precompiled
+    binder). The second section runs update_one against a live mongo (default
+    mongodb://localhost:27017) through raw pymongo and through a
+    FilterMongoCollection and reports the difference per call.
+"""
+
+import sys
+import timeit
+
+from pymongo import MongoClient
+from pymongo.collection import Collection
+from pymongo.errors import ConnectionFailure
+
+from mongodec.changeling import convert_arg_soup, slow_convert_arg_soup
+from mongodec.filter_mongo import FilterMongoCollection
+
+
+BIND_CALLS = 100000
+UPDATE_CALLS = 5000
+
+
+def per_call_us(timer, number):
+    """ Best of three runs of timer, in microseconds per call """
+    return min(timer.repeat(repeat=3, number=number)) / number * 1e6
+
+
+def bench_binding():
+    collection = Collection.__new__(Collection)
+    method = collection.update_one
+    args = ({'id': 1}, {'$set': {'val': 2}})
+
+    slow = timeit.Timer(lambda: slow_convert_arg_soup(method, *args,
+                                                      upsert=True))
+    fast = timeit.Timer(lambda: convert_arg_soup(method, *args, upsert=True))
+
+    print 'callargs for Collection.update_one (no server needed)'
+    print '  inspect.getcallargs  %8.2f us/call' % per_call_us(slow,
+                                                               BIND_CALLS)
+    print '  precompiled binder   %8.2f us/call' % per_call_us(fast,
+                                                               BIND_CALLS)
+
+
+def bench_update_one(uri):
+    client = MongoClient(uri, serverSelectionTimeoutMS=2000)
+    try:
+        client.admin.command('ping')
+    except ConnectionFailure:
+        print 'no mongo at %s, skipping update_one round trips' % uri
+        return
+
+    raw = client['mongodec_bench']['update_one']
+    raw.drop()
+    raw.insert_one({'tenant': 'a', 'id': 1, 'val': 0})
+    filtered = FilterMongoCollection(raw, _filter={'tenant': 'a'})
+
+    raw_timer = timeit.Timer(lambda: raw.update_one({'tenant': 'a', 'id': 1},
+                                                    {'$inc': {'val': 1}}))
+    filtered_timer = timeit.Timer(lambda: filtered.update_one(
+        {'id': 1}, {'$inc': {'val': 1}}))
+
+    raw_us = per_call_us(raw_timer, UPDATE_CALLS)
+    filtered_us = per_call_us(filtered_timer, UPDATE_CALLS)
+    print 'update_one round trips against %s' % uri
+    print '  raw pymongo             %8.2f us/call' % raw_us
+    print '  FilterMongoCollection   %8.2f us/call' % filtered_us
+    print '  overhead                %8.2f us/call' % (filtered_us - raw_us)
+    client.drop_database('mongodec_bench')
+
+
+if __name__ == '__main__':
+    bench_binding()
+    print
+    bench_update_one(sys.argv[1] if len(sys.argv) > 1 else
+                     'mongodb://localhost:27017')
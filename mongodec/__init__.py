@@ -7,10 +7,19 @@
 
 # Setup namespace
 
-from mongodec import MongoConfig
+from mongodec import MongoConfig, RetryPolicy, RetryBudget, \
+                     CircuitBreaker, CircuitOpenError
 from changeling import Changeling
+from metrics import CallMetrics, SlowQueryLog, prometheus_text
+from buffered import BufferedWriter, WriteFuture, WriteNotExecuted
+from cache import ResultCache, SingleFlight
+from multi_tenant import fan_out, QuerySpec, TenantResult, \
+                         DeadlineExceeded, batched_find
+from scan import partitioned_scan, process_map, ScanCheckpoint, \
+                 FileCheckpoint
 from filter_mongo import FilterMongoDB, \
                          FilterMongoCollection, \
+                         FilterMongoCollectionSpec, \
                          FilterMongoBulkOperationBuilder
 
 __version__ = '1.0.16'
@@ -0,0 +1,323 @@
+""" Coalesces single writes into bulk_write batches """
+
+from collections import namedtuple
+import atexit
+import logging
+import threading
+import time
+import weakref
+
+from pymongo.errors import BulkWriteError, PyMongoError, WriteError, \
+                           WriteConcernError
+from pymongo.operations import InsertOne, UpdateOne, UpdateMany, ReplaceOne, \
+                               DeleteOne, DeleteMany
+from pymongo.results import BulkWriteResult
+
+
+logger = logging.getLogger('mongodec.buffered')
+logger.addHandler(logging.NullHandler())
+
+
+'''
+##############################################################################
+#                                                                            #
+#                               WRITE FUTURES                                #
+#                                                                            #
+##############################################################################
+'''
+
+# What a WriteFuture resolves to: the request that was written, the _id of
+# the inserted or upserted document (None otherwise) and the BulkWriteResult
+# of the batch it went out in
+BufferedResult = namedtuple('BufferedResult', ['request', 'inserted_id',
+                                               'upserted_id', 'bulk_result'])
+
+
+class WriteNotExecuted(PyMongoError):
+    """ Set on the writes of an ordered batch that came after a failed one,
+        which mongo never tried
+    """
+
+
+class WriteFuture(object):
+    """ The outcome of one buffered write, known once its batch is flushed """
+    def __init__(self, request):
+        self.request = request
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+    def done(self):
+        return self.event.is_set()
+
+    def result(self, timeout=None):
+        """ Waits for the write's batch to be flushed
+        ARGS:
+            timeout - seconds to wait, forever if None
+        RETURNS:
+            a BufferedResult
+        RAISES:
+            the write's error: a pymongo WriteError (with the server's code
+            and details) if mongo rejected this write, WriteNotExecuted if
+            an earlier write of its ordered batch failed, or whatever
+            bulk_write raised for the whole batch. RuntimeError on timeout
+        """
+        if not self.event.wait(timeout):
+            raise RuntimeError('Buffered write not flushed within %ss' %
+                               timeout)
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def exception(self, timeout=None):
+        """ Like result, but returns the write's error (or None) """
+        if not self.event.wait(timeout):
+            raise RuntimeError('Buffered write not flushed within %ss' %
+                               timeout)
+        return self.error
+
+    def set_result(self, value):
+        self.value = value
+        self.event.set()
+
+    def set_error(self, error):
+        self.error = error
+        self.event.set()
+
+
+'''
+##############################################################################
+#                                                                            #
+#                              BUFFERED WRITER                               #
+#                                                                            #
+##############################################################################
+'''
+
+# BufferedWriters not closed yet, for close_writers
+OPEN_WRITERS = weakref.WeakSet()
+
+
+class BufferedWriter(object):
+    """ Collects single writes to a collection and sends them as bulk_write
+        batches, so bursts of insert_one/update_one calls cost one round
+        trip per batch instead of one each. Writes go through the
+        collection's bulk_write, so a FilterMongoCollection still injects
+        its filter (and stamps, retries, ...).
+
+        Each write method returns a WriteFuture right away. A batch is
+        flushed when batch_size writes are waiting (by the thread that
+        adds the last one), when the oldest has waited flush_interval
+        seconds (by a background thread), on flush(), and on close() /
+        leaving a with block. Errors never escape a flush: they're set on
+        the futures of the writes they belong to.
+
+        Batches go out one at a time, in the order the writes were made.
+        Writers still open when the interpreter exits are closed (so
+        flushed) by an atexit handler, before the shared clients are.
+    ARGS:
+        collection - a FilterMongoCollection or pymongo Collection
+        batch_size - most writes per bulk_write
+        flush_interval - seconds a write may wait for its batch to fill up;
+                         None to only flush by size and explicitly
+        ordered - passed on to bulk_write
+    """
+    def __init__(self, collection, batch_size=1000, flush_interval=0.1,
+                 ordered=True):
+        if batch_size < 1:
+            raise ValueError('batch_size must be at least 1')
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.ordered = ordered
+        self.pending = []
+        self.oldest = None
+        self.closed = False
+        self.lock = threading.Condition(threading.Lock())
+        self.flush_lock = threading.Lock()
+        self.flusher = None
+        OPEN_WRITERS.add(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    ######################################################################
+    #   Writes                                                           #
+    ######################################################################
+
+    def insert_one(self, document):
+        return self.write(InsertOne(document))
+
+    def update_one(self, filter, update, upsert=False):
+        return self.write(UpdateOne(filter, update, upsert=upsert))
+
+    def update_many(self, filter, update, upsert=False):
+        return self.write(UpdateMany(filter, update, upsert=upsert))
+
+    def replace_one(self, filter, replacement, upsert=False):
+        return self.write(ReplaceOne(filter, replacement, upsert=upsert))
+
+    def delete_one(self, filter):
+        return self.write(DeleteOne(filter))
+
+    def delete_many(self, filter):
+        return self.write(DeleteMany(filter))
+
+    def write(self, request):
+        """ Buffers a pymongo write request (InsertOne, UpdateOne, ...)
+        RETURNS:
+            the request's WriteFuture
+        """
+        future = WriteFuture(request)
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('BufferedWriter is closed')
+            if not self.pending:
+                self.oldest = time.time()
+            self.pending.append(future)
+            full = len(self.pending) >= self.batch_size
+            if self.flush_interval is not None and self.flusher is None:
+                self.start_flusher()
+            self.lock.notify()
+        if full:
+            self.flush()
+        return future
+
+    ######################################################################
+    #   Flushing                                                         #
+    ######################################################################
+
+    def flush(self):
+        """ Sends every buffered write, batch_size at a time
+        RETURNS:
+            the futures of the writes sent
+        """
+        flushed = []
+        with self.flush_lock:
+            while True:
+                with self.lock:
+                    batch = self.pending[:self.batch_size]
+                    del self.pending[:self.batch_size]
+                    self.oldest = time.time() if self.pending else None
+                if not batch:
+                    return flushed
+                self.send(batch)
+                flushed.extend(batch)
+
+    def close(self):
+        """ Flushes what's left and stops the background flusher. Writes
+            after close raise RuntimeError
+        """
+        with self.lock:
+            self.closed = True
+            flusher, self.flusher = self.flusher, None
+            self.lock.notify_all()
+        OPEN_WRITERS.discard(self)
+        if flusher is not None and flusher is not threading.current_thread():
+            flusher.join()
+        self.flush()
+
+    def send(self, batch):
+        """ bulk_writes batch and settles its futures """
+        requests = [future.request for future in batch]
+        try:
+            bulk_result = self.collection.bulk_write(requests,
+                                                     ordered=self.ordered)
+        except BulkWriteError as error:
+            settle_failed_batch(batch, error.details, self.ordered)
+            logger.warning('%s of %s buffered writes failed',
+                           len(error.details.get('writeErrors', [])),
+                           len(batch))
+        except Exception as error:
+            for future in batch:
+                future.set_error(error)
+            logger.warning('Buffered batch of %s writes failed: %r',
+                           len(batch), error)
+        else:
+            upserted_ids = (bulk_result.upserted_ids
+                            if bulk_result.acknowledged else {})
+            for index, future in enumerate(batch):
+                future.set_result(buffered_result(future.request, bulk_result,
+                                                  upserted_ids.get(index)))
+
+    def start_flusher(self):
+        """ Starts the thread that flushes by time. Call with lock held """
+        self.flusher = threading.Thread(target=self.run_flusher,
+                                        name='mongodec-buffered-writer')
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def run_flusher(self):
+        while True:
+            with self.lock:
+                while not self.closed:
+                    if self.oldest is not None:
+                        wait = self.oldest + self.flush_interval - time.time()
+                        if wait <= 0:
+                            break
+                    else:
+                        wait = None
+                    self.lock.wait(wait)
+                if self.closed:
+                    return
+            self.flush()
+
+
+def close_writers():
+    """ Closes every open BufferedWriter, flushing its buffered writes.
+        Registered with atexit, since the flusher threads are daemons and
+        die with the interpreter
+    """
+    for writer in list(OPEN_WRITERS):
+        try:
+            writer.close()
+        except Exception:
+            logger.exception('Could not flush a BufferedWriter at exit')
+
+
+# Registered after mongodec.close_clients (the package imports mongodec
+# first), so it runs before the clients are closed
+atexit.register(close_writers)
+
+
+def buffered_result(request, bulk_result, upserted_id):
+    """ The BufferedResult of a request that went through """
+    inserted_id = None
+    if isinstance(request, InsertOne) and isinstance(request._doc, dict):
+        inserted_id = request._doc.get('_id')
+    return BufferedResult(request, inserted_id, upserted_id, bulk_result)
+
+
+def settle_failed_batch(batch, details, ordered):
+    """ Settles the futures of a batch whose bulk_write raised
+        BulkWriteError: writes the server rejected get a WriteError, writes
+        an ordered batch never got to get WriteNotExecuted, and the rest get
+        their results (or a WriteConcernError if the write concern wasn't
+        met)
+    """
+    write_errors = dict((error['index'], error)
+                        for error in details.get('writeErrors', []))
+    upserted_ids = dict((upsert['index'], upsert['_id'])
+                        for upsert in details.get('upserted', []))
+    concern_errors = details.get('writeConcernErrors', [])
+    bulk_result = BulkWriteResult(details, True)
+    first_error = min(write_errors) if write_errors else None
+
+    for index, future in enumerate(batch):
+        if index in write_errors:
+            error = write_errors[index]
+            future.set_error(WriteError(error.get('errmsg'),
+                                        error.get('code'), error))
+        elif ordered and first_error is not None and index > first_error:
+            future.set_error(WriteNotExecuted(
+                'Not executed: write %s of the ordered batch failed' %
+                first_error))
+        elif concern_errors:
+            error = concern_errors[-1]
+            future.set_error(WriteConcernError(error.get('errmsg'),
+                                               error.get('code'), error))
+        else:
+            future.set_result(buffered_result(future.request, bulk_result,
+                                              upserted_ids.get(index)))
@@ -0,0 +1,376 @@
+""" In-process caching and sharing of FilterMongoCollection read results """
+
+from collections import OrderedDict
+import copy
+import threading
+import time
+
+from bson import BSON
+from bson.son import SON
+from pymongo.command_cursor import CommandCursor
+
+from metrics import TimedCursor
+
+
+'''
+##############################################################################
+#                                                                            #
+#                                RESULT CACHE                                #
+#                                                                            #
+##############################################################################
+'''
+
+# Reads whose results get cached
+CACHED_METHODS = frozenset(['find_one', 'count', 'distinct'])
+
+# Calls after which a collection's cached results are dropped
+WRITE_METHODS = frozenset(['insert_one', 'insert_many', 'insert', 'save',
+                           'update', 'update_one', 'update_many',
+                           'replace_one', 'remove', 'delete_one',
+                           'delete_many', 'find_one_and_delete',
+                           'find_one_and_replace', 'find_one_and_update',
+                           'find_and_modify', 'bulk_write', 'drop',
+                           'rename'])
+
+
+class ResultCache(object):
+    """ LRU cache of find_one, count and distinct results, with a TTL and
+        limits on the number of entries and their total (BSON) size. Pass
+        it to FilterMongoCollection (or FilterMongoDB, to share one across
+        collections) as result_cache; it runs as a cdict call hook, so
+        entries are keyed by the query as sent to mongo -- with the filter
+        injected -- along with the collection, its codec options and read
+        preference, the method and other arguments.
+
+        Writes through the same wrappers (update_*, delete_*, replace_one,
+        find_one_and_*, bulk_write, bulk op builders, inserts, drops...)
+        drop every entry of their collection. Writes from anywhere else
+        aren't seen: ttl bounds how stale a result can get.
+
+        Callers get their own copy of cached documents, so mutating a
+        result doesn't change the cache.
+    ARGS:
+        ttl - seconds an entry is served for
+        max_entries - most results kept
+        max_bytes - most total BSON size of the results kept; results
+                    bigger than this on their own aren't cached
+    """
+    def __init__(self, ttl=5.0, max_entries=10000,
+                 max_bytes=64 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.epoch = 0
+        self.total_bytes = 0
+        self.counts = {'hits': 0, 'misses': 0, 'evictions': 0,
+                       'invalidations': 0}
+        self.lock = threading.Lock()
+
+    def __call__(self, func, cdict, name, callargs):
+        collection = (cdict or {}).get('collection_name')
+        if name in WRITE_METHODS:
+            try:
+                return func(**callargs)
+            finally:
+                self.invalidate(collection)
+        if name not in CACHED_METHODS or callargs.get('session') is not None:
+            return func(**callargs)
+
+        key = cache_key(collection, name, callargs,
+                        (cdict or {}).get('collection_options'))
+        if key is None:
+            return func(**callargs)
+        found, result = self.get(key)
+        if found:
+            return result
+
+        generation = self.generation(collection)
+        result = func(**callargs)
+        self.put(key, result, generation)
+        return result
+
+    def get(self, key):
+        """ Returns (True, a copy of the result) for a live entry, otherwise
+            (False, None)
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                self.drop(key)
+                entry = None
+            if entry is None:
+                self.counts['misses'] += 1
+                return False, None
+            self.counts['hits'] += 1
+            self.entries[key] = self.entries.pop(key)
+        return True, copy.deepcopy(entry[1])
+
+    def put(self, key, result, generation):
+        """ Stores result under key, unless the key's collection was written
+            to since generation was read (the result may predate the write)
+        """
+        size = result_size(result)
+        if size is None or size > self.max_bytes:
+            return
+        result = copy.deepcopy(result)
+        with self.lock:
+            if (self.epoch, self.generations.get(key[0], 0)) != generation:
+                return
+            if key in self.entries:
+                self.drop(key)
+            self.entries[key] = (time.time() + self.ttl, result, size)
+            self.total_bytes += size
+            while (len(self.entries) > self.max_entries or
+                   self.total_bytes > self.max_bytes):
+                self.drop(next(iter(self.entries)))
+                self.counts['evictions'] += 1
+
+    def drop(self, key):
+        """ Removes an entry. Call with lock held """
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry[2]
+
+    def generation(self, collection):
+        """ Changes whenever collection's entries are invalidated """
+        with self.lock:
+            return (self.epoch, self.generations.get(collection, 0))
+
+    def invalidate(self, collection=None):
+        """ Drops the cached results of collection (a full name), or of
+            every collection if None
+        """
+        with self.lock:
+            if collection is None:
+                self.epoch += 1
+                self.entries.clear()
+                self.total_bytes = 0
+            else:
+                self.generations[collection] = \
+                    self.generations.get(collection, 0) + 1
+                for key in [key for key in self.entries
+                            if key[0] == collection]:
+                    self.drop(key)
+            self.counts['invalidations'] += 1
+
+    def stats(self):
+        """ Returns a dict with the hit, miss, eviction and invalidation
+            counts, the hit_ratio, and the current entries and bytes
+        """
+        with self.lock:
+            stats = dict(self.counts)
+            stats['entries'] = len(self.entries)
+            stats['bytes'] = self.total_bytes
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = float(stats['hits']) / lookups if lookups else 0.0
+        return stats
+
+    def clear(self):
+        """ Drops every entry and resets the statistics """
+        self.invalidate()
+        with self.lock:
+            self.counts = dict.fromkeys(self.counts, 0)
+
+
+'''
+##############################################################################
+#                                                                            #
+#                                SINGLE FLIGHT                               #
+#                                                                            #
+##############################################################################
+'''
+
+# Reads that concurrent identical calls share by default
+SHARED_METHODS = frozenset(['find_one', 'count', 'distinct'])
+
+# Reads returning cursors, which are read to the end when they're shared
+CURSOR_METHODS = frozenset(['aggregate'])
+
+# Aggregation stages that write, making the pipeline a write
+WRITE_STAGES = frozenset(['$out', '$merge'])
+
+
+class Flight(object):
+    """ One read in progress, and what its followers need to wait on it """
+    def __init__(self):
+        self.event = threading.Event()
+        self.followers = 0
+        self.result = None
+        self.error = None
+        self.cursor = None
+        self.landed = False
+
+
+class SingleFlight(object):
+    """ Makes concurrent identical reads share one trip to mongo: while a
+        find_one, count or distinct is in flight, other threads making the
+        same call (same collection, same query with the filter injected,
+        same arguments) wait for it and get its result -- or its error --
+        rather than sending their own. Pass it to FilterMongoCollection (or
+        FilterMongoDB) as single_flight; it runs as a cdict call hook, after
+        the result_cache if there's one.
+
+        Followers get their own deep copy of the result. aggregate is only
+        shared if it's in methods, and never for pipelines ending in $out
+        or $merge. An aggregate nobody joined returns its own cursor; a
+        shared one is read to the end (so held in memory) by the call that
+        runs, and every caller gets a CommandCursor over its own copy of the
+        documents.
+    ARGS:
+        methods - names of the methods to share calls of
+    """
+    def __init__(self, methods=SHARED_METHODS):
+        self.methods = frozenset(methods)
+        self.flights = {}
+        self.counts = {'calls': 0, 'shared': 0}
+        self.lock = threading.Lock()
+
+    def __call__(self, func, cdict, name, callargs):
+        if (name not in self.methods or
+            callargs.get('session') is not None or
+            (name == 'aggregate' and writes(callargs.get('pipeline')))):
+            return func(**callargs)
+        collection_name = (cdict or {}).get('collection_name')
+        key = cache_key(collection_name, name, callargs,
+                        (cdict or {}).get('collection_options'))
+        if key is None:
+            return func(**callargs)
+
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = self.flights[key] = Flight()
+                self.counts['calls'] += 1
+                leader = True
+            else:
+                flight.followers += 1
+                self.counts['shared'] += 1
+                leader = False
+
+        if leader:
+            return self.lead(key, flight, func, name, callargs,
+                             collection_name)
+
+        flight.event.wait()
+        if flight.error is not None:
+            raise flight.error
+        result = copy.deepcopy(flight.result)
+        if name in CURSOR_METHODS:
+            return shared_cursor(flight.cursor, result, collection_name)
+        return result
+
+    def lead(self, key, flight, func, name, callargs, collection_name):
+        """ Makes the call for everyone waiting on flight """
+        # BaseExceptions (KeyboardInterrupt, GreenletExit, ...) land the
+        # flight too, or followers would wait on it forever
+        result = error = None
+        try:
+            result = func(**callargs)
+            followers = self.take_off(key, flight)
+            if followers and name in CURSOR_METHODS:
+                flight.cursor = result
+                result = list(result)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.land(key, flight, result=result, error=error)
+        if followers and name in CURSOR_METHODS:
+            return shared_cursor(flight.cursor, result, collection_name)
+        return result
+
+    def take_off(self, key, flight):
+        """ Stops new calls from joining flight
+        RETURNS:
+            the number of followers waiting on it
+        """
+        with self.lock:
+            if not flight.landed:
+                flight.landed = True
+                del self.flights[key]
+            return flight.followers
+
+    def land(self, key, flight, result=None, error=None):
+        """ Ends flight, handing followers a copy of result (or error) """
+        followers = self.take_off(key, flight)
+        if followers and error is None:
+            flight.result = copy.deepcopy(result)
+        flight.error = error
+        flight.event.set()
+
+    def stats(self):
+        """ Returns a dict with the number of calls made ('calls') and of
+            calls that shared one of those instead ('shared')
+        """
+        with self.lock:
+            return dict(self.counts)
+
+
+def cache_key(collection, name, callargs, options=None):
+    """ Hashable key for a call, or None if its arguments can't be made
+        into one. options (see collection_options) tell apart collection
+        objects whose results differ for the same call
+    """
+    try:
+        key = (collection, name, freeze(callargs), options)
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def collection_options(collection):
+    """ What besides the call decides what a collection returns: its codec
+        options (document_class, tz_aware, ...) and read preference, as
+        hashable reprs
+    """
+    return (repr(getattr(collection, 'codec_options', None)),
+            repr(getattr(collection, 'read_preference', None)))
+
+
+def freeze(value):
+    """ Hashable stand-in for a query or argument value. Dicts compare
+        regardless of key order, except SONs and OrderedDicts (sort specs,
+        commands), whose order matters
+    """
+    if isinstance(value, (SON, OrderedDict)):
+        return ('ordered',) + tuple((k, freeze(v)) for k, v in value.items())
+    elif isinstance(value, dict):
+        return ('dict',) + tuple(sorted((k, freeze(v))
+                                        for k, v in value.items()))
+    elif isinstance(value, (list, tuple)):
+        return ('list',) + tuple(freeze(v) for v in value)
+    return value
+
+
+def writes(pipeline):
+    """ Whether an aggregation pipeline ends in a stage that writes """
+    if not isinstance(pipeline, (list, tuple)) or not pipeline:
+        return False
+    last = pipeline[-1]
+    return isinstance(last, dict) and bool(WRITE_STAGES.intersection(last))
+
+
+def shared_cursor(cursor, documents, collection_name):
+    """ A finished CommandCursor over documents, like the cursor they were
+        read from, or an iterator over them if that wasn't a CommandCursor
+    """
+    if isinstance(cursor, TimedCursor):
+        cursor = cursor.cursor
+    # CommandCursor doesn't expose its collection, which it needs to
+    # return documents
+    collection = getattr(cursor, '_CommandCursor__collection', None)
+    if not isinstance(cursor, CommandCursor) or collection is None:
+        return iter(documents)
+    return CommandCursor(collection, {'id': 0, 'firstBatch': documents,
+                                      'ns': collection_name},
+                         cursor.address)
+
+
+def result_size(result):
+    """ BSON size of a result, or None if it can't be encoded """
+    try:
+        return len(BSON.encode({'result': result}))
+    except Exception:
+        return None
@@ -1,4 +1,3 @@
-
 import inspect
 
 '''
@@ -8,11 +7,26 @@ import inspect
 #                                                                             #
 ###############################################################################
 '''
+
+# Attributes that determine what __getattr__ builds; assigning any of them
+# drops the compiled dispatch cache
+DISPATCH_ATTRS = ('base_object', 'cdict', 'no_wrap_all', 'class_prefix')
+
+
 class Changeling(object):
     """ Generic class that serves as a parent for all our imitation classes.
         This and all its children are instatiated as an object and will allow
         one to easily overwrite any method, but maintain standard behavior for
         undecorated methods.
+
+        The final callable for each wrapped method is built once and stored
+        on the instance, so repeat lookups don't go through __getattr__ at
+        all. Reassigning base_object, cdict, no_wrap_all or class_prefix
+        clears the cache; if you mutate the cdict in place after the first
+        call, call invalidate_dispatch() yourself.
+
+        If the cdict has a 'metrics' entry (a mongodec.metrics.CallMetrics),
+        every method call is counted and timed through it.
     """
     def __init__(self, base_object, cdict=None):
         self.base_object = base_object
@@ -23,40 +37,98 @@ class Changeling(object):
     def __eq__(self, other):
         return self.base_object == other.base_object
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name in DISPATCH_ATTRS:
+            self.invalidate_dispatch()
+
+    def invalidate_dispatch(self):
+        """ Drops every compiled method so the next access rebuilds it from
+            the current cdict
+        """
+        for name in self.__dict__.pop('_dispatch_names', ()):
+            self.__dict__.pop(name, None)
+        self.__dict__['_dispatch_names'] = set()
+
     def __getattr__(self, name):
-        methods = self.class_prefix + '_methods'
-        if not callable(getattr(self.base_object, name)):
-            return getattr(self.base_object, name)
+        attr = getattr(self.base_object, name)
+        if not callable(attr):
+            return attr
 
-        elif self.cdict.get(methods, {}).get(name) is not None:
-            func = self.cdict[methods][name]
+        final_wrapper = self.compile_method(name, attr)
+        self.__dict__[name] = final_wrapper
+        self.__dict__.setdefault('_dispatch_names', set()).add(name)
+        return final_wrapper
+
+    def compiled(self, name):
+        """ The compiled stand-in for base_object.<name>, cached like the
+            ones __getattr__ builds, for subclasses that define a method of
+            that name but still want to dispatch through the cdict
+        """
+        key = '_compiled_%s' % name
+        final_wrapper = self.__dict__.get(key)
+        if final_wrapper is None:
+            final_wrapper = self.compile_method(
+                name, getattr(self.base_object, name))
+            self.__dict__[key] = final_wrapper
+            self.__dict__.setdefault('_dispatch_names', set()).add(key)
+        return final_wrapper
+
+    def compile_method(self, name, method):
+        """ Builds the callable that stands in for base_object.<name>
+        ARGS:
+            name - name of the method on the base object
+            method - the bound method itself
+        RETURNS:
+            a function that applies the cdict's method wrapper and _wrap_all
+            wrapper (if any; only for the names in _wrap_only, if that's
+            set) before calling method
+        """
+        cdict = self.cdict
+        func = cdict.get(self.class_prefix + '_methods', {}).get(name)
+
+        bind = get_binder(self.signature_of(name, method))
+
+        if func is not None:
             def wrapper(*args, **kwargs):
                 if kwargs.pop('no_changeling', False):
-                    return getattr(self.base_object, name)(*args, **kwargs)
-                callargs = convert_arg_soup(getattr(self.base_object, name),
-                                            *args, **kwargs)
-                return func(getattr(self.base_object, name), cdict=self.cdict,
-                            callargs=callargs)
-
+                    return method(*args, **kwargs)
+                callargs = bind(*args, **kwargs)
+                return func(method, cdict=cdict, callargs=callargs)
         else:
             def wrapper(*args, **kwargs):
-                return getattr(self.base_object, name)(*args, **kwargs)
+                return method(*args, **kwargs)
 
-        if (self.cdict.get(self.class_prefix + '_wrap_all') is not None and
-            not self.no_wrap_all):
-            wrap_all = self.cdict[self.class_prefix + '_wrap_all']
+        wrap_all = cdict.get(self.class_prefix + '_wrap_all')
+        wrap_only = cdict.get(self.class_prefix + '_wrap_only')
+        if (wrap_all is not None and not self.no_wrap_all and
+            (wrap_only is None or name in wrap_only)):
             def final_wrapper(*args, **kwargs):
                 if kwargs.get('no_changeling'):
                     return wrapper(*args, **kwargs)
                 else:
-                    callargs = convert_arg_soup(getattr(self.base_object, name),
-                                                *args, **kwargs)
-                    return wrap_all(wrapper, self.cdict, callargs)
+                    callargs = bind(*args, **kwargs)
+                    return wrap_all(wrapper, cdict, callargs)
         else:
             final_wrapper = wrapper
 
+        metrics = cdict.get('metrics')
+        if metrics is not None:
+            final_wrapper = metrics.instrument(self.metrics_label(), name,
+                                               final_wrapper)
+
         return final_wrapper
 
+    def signature_of(self, name, method):
+        """ The function whose signature calls to method are bound with,
+            for base objects whose methods only take *args, **kwargs
+        """
+        return method
+
+    def metrics_label(self):
+        """ Label calls are recorded under when the cdict has 'metrics' """
+        return self.class_prefix
+
 
 '''
 ##############################################################################
@@ -77,6 +149,13 @@ def convert_arg_soup(function, *args, **kwargs):
         a dict of kwargs that can then be called like
         function(**RETURNVALUE)
     """
+    return get_binder(function)(*args, **kwargs)
+
+
+def slow_convert_arg_soup(function, *args, **kwargs):
+    """ convert_arg_soup by way of inspect.getcallargs. Used when a signature
+        can't be precompiled and to raise the right TypeError on bad calls
+    """
     callargs = inspect.getcallargs(function, *args, **kwargs)
     if 'kwargs' in callargs:
         callargs.update(callargs.pop('kwargs'))
@@ -87,7 +166,152 @@ def convert_arg_soup(function, *args, **kwargs):
     return callargs
 
 
+# Binders keyed by (underlying function, is bound), so every bound method of a
+# class shares the one built off its signature
+BINDERS = {}
+
+
+def get_binder(function):
+    """ Returns the (cached) binder for function. See build_binder """
+    raw = getattr(function, '__func__', function)
+    key = (raw, getattr(function, '__self__', None) is not None)
+    try:
+        return BINDERS[key]
+    except KeyError:
+        binder = BINDERS[key] = build_binder(*key)
+        return binder
+    except TypeError:
+        # Unhashable callable
+        return build_binder(*key)
+
+
+def build_binder(function, bound=False):
+    """ Reads function's signature once and builds a replacement for
+        convert_arg_soup(function, ...) that just zips names onto args.
+    ARGS:
+        function - a plain function (for methods, the underlying function)
+        bound - True if calls won't pass the first (self) argument
+    RETURNS:
+        a function bind(*args, **kwargs) returning the same dict
+        convert_arg_soup would. Calls the binder can't map (missing args,
+        unknown kwargs, ...) fall back on inspect.getcallargs, so errors are
+        unchanged
+    """
+    def slow_bind(*args, **kwargs):
+        if bound:
+            args = (None,) + args
+        callargs = slow_convert_arg_soup(function, *args, **kwargs)
+        if bound and names:
+            callargs.pop(names[0], None)
+        return callargs
+
+    try:
+        names, varargs, varkw, defaults = inspect.getargspec(function)
+    except (TypeError, ValueError):
+        # Builtins, keyword-only args and other things we can't read
+        names = None
+        return slow_bind
+
+    positions = dict((name, i - bound) for i, name in enumerate(names))
+    num_names = len(names) - bound
+    num_defaults = len(defaults or ())
+    default_items = list(zip(names[len(names) - num_defaults:],
+                             defaults or ()))
+    required = frozenset(names[bound:len(names) - num_defaults])
+    positional = names[bound:]
+
+    def bind(*args, **kwargs):
+        num_args = len(args)
+        if num_args > num_names and varargs is None:
+            return slow_bind(*args, **kwargs)
+
+        callargs = dict(default_items)
+        callargs.update(zip(positional, args))
+        if varargs is not None:
+            callargs[varargs] = args[num_names:]
+
+        extra = {}
+        for k, v in kwargs.items():
+            position = positions.get(k)
+            if position is None:
+                if varkw is None:
+                    return slow_bind(*args, **kwargs)
+                extra[k] = v
+            elif position < num_args:
+                return slow_bind(*args, **kwargs)
+            else:
+                callargs[k] = v
+
+        if num_args < len(required) and not required.issubset(callargs):
+            return slow_bind(*args, **kwargs)
+
+        if varkw == 'kwargs':
+            callargs.update(extra)
+        elif varkw is not None:
+            callargs[varkw] = extra
+        callargs.pop('self', None)
+        return callargs
+
+    return bind
+
+
 def replace_arg(argname, replacer, cdict=None):
     def wrapper(wrappee, callargs, cdict=cdict):
         return wrappee(**replacer(argname, cdict=cdict, callargs=callargs))
     return wrapper
+
+
+def replace_args(replacements, cdict=None):
+    """ Like replace_arg for several arguments
+    ARGS:
+        replacements - list of (argname, replacer) pairs, applied in order
+        cdict - passed to each replacer
+    RETURNS:
+        a method wrapper
+    """
+    def wrapper(wrappee, callargs, cdict=cdict):
+        for argname, replacer in replacements:
+            callargs = replacer(argname, cdict=cdict, callargs=callargs)
+        return wrappee(**callargs)
+    return wrapper
+
+
+def call_through(wrappee, callargs, cdict=None):
+    """ Method wrapper that calls wrappee with callargs as they are. Wrap it
+        in hooked to run the call hooks on methods that need no rewriting
+    """
+    return wrappee(**callargs)
+
+
+def hooked(method_wrapper):
+    """ Wraps a cdict method wrapper so that the final call to the base
+        method -- after method_wrapper has rewritten the callargs -- goes
+        through the hooks listed in cdict['call_hooks'].
+    ARGS:
+        method_wrapper - a wrapper like the ones replace_arg builds
+    RETURNS:
+        a wrapper with the same signature
+    """
+    def wrapper(wrappee, callargs, cdict=None):
+        hooks = (cdict or {}).get('call_hooks')
+        if hooks:
+            wrappee = apply_hooks(hooks, wrappee, cdict)
+        return method_wrapper(wrappee, cdict=cdict, callargs=callargs)
+    return wrapper
+
+
+def apply_hooks(hooks, func, cdict, name=None):
+    """ Returns func wrapped in hooks, the first hook outermost. Each hook is
+        called like hook(func, cdict, name, callargs) and must return
+        func(**callargs) (or something standing in for it)
+    """
+    name = name or func.__name__
+    for hook in reversed(hooks):
+        func = bind_hook(hook, func, cdict, name)
+    return func
+
+
+def bind_hook(hook, func, cdict, name):
+    def wrapper(**callargs):
+        return hook(func, cdict, name, callargs)
+    return wrapper
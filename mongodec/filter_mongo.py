@@ -1,34 +1,129 @@
-from mongodec import mongo_timeout_wrap, modify_agg_pipeline, update_filter
-from changeling import Changeling, replace_arg
+from mongodec import mongo_timeout_wrap, modify_agg_pipeline, update_filter, \
+                     update_requests, stamp_inserts, stamp_replacement, \
+                     RetryPolicy, compile_filter
+from changeling import Changeling, replace_arg, replace_args, hooked, \
+                       apply_hooks, call_through
+from cache import WRITE_METHODS, collection_options
+from buffered import BufferedWriter
+from bson.raw_bson import RawBSONDocument, DEFAULT_RAW_BSON_OPTIONS
 from pymongo.collection import Collection
+from collections import OrderedDict
+import struct
+import os
+import threading
+
+
+# Used when a circuit breaker is wanted without retries
+NO_RETRY_POLICY = RetryPolicy(max_attempts=1, budget=None)
 
 
 class FilterMongoDB(Changeling):
     """ Wrapper for mongoDB object.
         Supports accessing collections using the .property or the ['indexing']
         accessors. Returns ChangelingCollections everywhere
+
+        Wrapped collections are kept in a LRU cache of cache_size entries,
+        keyed by collection name and options, so repeat accesses return the
+        same FilterMongoCollection. Use evict_collection to drop entries.
+
+        Any other kwargs (e.g. retry_policy) are passed on to every
+        FilterMongoCollection this builds.
     """
-    def __init__(self, base_object, _filter=None):
+    def __init__(self, base_object, _filter=None, cache_size=128,
+                 **collection_kwargs):
         super(self.__class__, self).__init__(base_object)
         self._filter = _filter
+        self.collection_kwargs = collection_kwargs
+        self.cache_size = cache_size
+        self.collection_cache = OrderedDict()
+        self.cache_lock = threading.Lock()
 
     def __getattr__(self, name):
+        if (not name.startswith('_') and
+            not hasattr(self.base_object.__class__, name)):
+            cached = self.cached_collection((name,))
+            if cached is not None:
+                return cached
         if isinstance(getattr(self.base_object, name), Collection):
-            collection_obj = self.base_object[name]
-            return FilterMongoCollection(collection_obj, _filter=self._filter)
-        elif name in ['create_collection', 'get_collection']:
+            return self.filter_collection((name,), self.base_object[name])
+        elif name == 'create_collection':
             def wrapper(*args, **kwargs):
-                collection_obj = getattr(self.base_object, name)(*args,
-                                                                 **kwargs)
-                return FilterMongoCollection(collection_obj,
-                                             _filter=self._filter)
+                collection_obj = self.base_object.create_collection(*args,
+                                                                    **kwargs)
+                return self.filter_collection((collection_obj.name,),
+                                              collection_obj, replace=True)
             return wrapper
         else:
             return super(self.__class__, self).__getattr__(name)
 
     def __getitem__(self, collection_name):
-        collection_obj = self.base_object[collection_name]
-        return FilterMongoCollection(collection_obj, _filter=self._filter)
+        cached = self.cached_collection((collection_name,))
+        if cached is not None:
+            return cached
+        return self.filter_collection((collection_name,),
+                                      self.base_object[collection_name])
+
+    def get_collection(self, name, codec_options=None, read_preference=None,
+                       write_concern=None, read_concern=None):
+        """ Same as pymongo.database.Database.get_collection, but returns a
+            (cached) FilterMongoCollection
+        """
+        options = (codec_options, read_preference, write_concern,
+                   read_concern)
+        if options == (None, None, None, None):
+            key = (name,)
+        else:
+            key = (name,) + tuple(repr(option) for option in options)
+        cached = self.cached_collection(key)
+        if cached is not None:
+            return cached
+        collection_obj = self.base_object.get_collection(name, *options)
+        return self.filter_collection(key, collection_obj)
+
+    ######################################################################
+    #   Collection cache                                                 #
+    ######################################################################
+
+    def cached_collection(self, key):
+        """ Returns the cached FilterMongoCollection for key, or None """
+        with self.cache_lock:
+            filter_coll = self.collection_cache.pop(key, None)
+            if filter_coll is not None:
+                self.collection_cache[key] = filter_coll
+            return filter_coll
+
+    def filter_collection(self, key, collection_obj, replace=False):
+        """ Wraps collection_obj and stores it in the cache under key. If
+            another thread got there first, returns its wrapper instead
+            (unless replace is True)
+        """
+        filter_coll = FilterMongoCollection(collection_obj,
+                                            _filter=self._filter,
+                                            **self.collection_kwargs)
+        with self.cache_lock:
+            if not replace and key in self.collection_cache:
+                return self.collection_cache[key]
+            self.collection_cache.pop(key, None)
+            self.collection_cache[key] = filter_coll
+            while len(self.collection_cache) > max(self.cache_size, 0):
+                self.collection_cache.popitem(last=False)
+        return filter_coll
+
+    def evict_collection(self, name=None):
+        """ Drops cached FilterMongoCollections
+        ARGS:
+            name - collection name whose wrappers (for every set of options)
+                   get dropped. If None, the whole cache is cleared
+        RETURNS:
+            None
+        """
+        with self.cache_lock:
+            if name is None:
+                self.collection_cache.clear()
+                return
+            for key in list(self.collection_cache):
+                if key[0] == name:
+                    del self.collection_cache[key]
 
     def drop_collection(self, collection_thing):
         """ Drops a collection from the mongo db,
@@ -40,56 +135,262 @@ class FilterMongoDB(Changeling):
             None
         """
         if isinstance(collection_thing, basestring):
-            return self.base_object.drop_collection(collection_thing)
+            name = collection_thing
         else:
-            return self.base_object.drop_collection(collection_thing.name)
+            name = collection_thing.name
+        self.evict_collection(name)
+        result_cache = self.collection_kwargs.get('result_cache')
+        if result_cache is not None:
+            result_cache.invalidate('%s.%s' % (self.base_object.name, name))
+        return self.base_object.drop_collection(name)
+
+
+def filter_methods(cdict, stamp=False, wrap=hooked):
+    """ Builds the cdict method wrappers that put cdict's filter into every
+        query (and, with stamp, its fields into written documents)
+    ARGS:
+        cdict - the Changeling's cdict, with the 'update_filter' and
+                'filter_plan' the wrappers use
+        stamp - whether to stamp inserted and replacement documents
+        wrap - applied to each wrapper; by default changeling.hooked, so
+               the calls go through cdict['call_hooks']
+    RETURNS:
+        dict of method name to wrapper
+    """
+    method_dict = {}
+    for method in ['count', 'replace_one', 'update_one', 'update_many',
+                   'delete_one', 'delete_many',
+                   'find_one_and_delete', 'find_one_and_replace',
+                   'find_one_and_update', 'distinct']:
+
+        method_dict[method] = wrap(replace_arg('filter', update_filter,
+                                               cdict=cdict))
+
+    method_dict['update'] = wrap(replace_arg('spec', update_filter,
+                                             cdict=cdict))
+    method_dict['remove'] = wrap(replace_arg('spec_or_id', update_filter,
+                                             cdict=cdict))
+    for method in ['aggregate', 'aggregate_raw_batches']:
+        method_dict[method] = wrap(replace_arg('pipeline',
+                                               modify_agg_pipeline,
+                                               cdict=cdict))
+    method_dict['group'] = wrap(replace_arg('condition', update_filter,
+                                            cdict=cdict))
+    method_dict['bulk_write'] = wrap(replace_arg('requests', update_requests,
+                                                 cdict=cdict))
+
+    if stamp:
+        for method, argname in [('insert_one', 'document'),
+                                ('insert_many', 'documents'),
+                                ('insert', 'doc_or_docs'),
+                                ('save', 'to_save')]:
+            method_dict[method] = wrap(replace_arg(argname, stamp_inserts,
+                                                   cdict=cdict))
+        for method, filter_arg, doc_arg in [
+                ('replace_one', 'filter', 'replacement'),
+                ('find_one_and_replace', 'filter', 'replacement'),
+                ('update', 'spec', 'document')]:
+            method_dict[method] = wrap(replace_args(
+                [(filter_arg, update_filter),
+                 (doc_arg, stamp_replacement)], cdict=cdict))
+
+    return method_dict
+
+
+def raw_batches(cursor):
+    """ Yields a memoryview over each batch of a RawBatchCursor (or
+        RawBatchCommandCursor): the documents' BSON back to back, as the
+        server sent them, ready to be written out without decoding. The
+        cursor is closed when the generator is
+    """
+    try:
+        for batch in cursor:
+            yield memoryview(batch)
+    finally:
+        cursor.close()
+
+
+def raw_documents(batch, codec_options=None):
+    """ Splits a raw batch into RawBSONDocuments, which only decode the
+        fields that are read from them
+    ARGS:
+        batch - a batch from raw_batches (or bytes of BSON documents)
+        codec_options - used to decode fields; its document_class is
+                        replaced by RawBSONDocument
+    RETURNS:
+        an iterator of RawBSONDocuments
+    """
+    if codec_options is None:
+        codec_options = DEFAULT_RAW_BSON_OPTIONS
+    else:
+        codec_options = codec_options.with_options(
+            document_class=RawBSONDocument)
+    view = memoryview(batch)
+    position = 0
+    while position < len(view):
+        size = struct.unpack('<i', view[position:position + 4].tobytes())[0]
+        yield RawBSONDocument(view[position:position + size].tobytes(),
+                              codec_options)
+        position += size
 
 
 class FilterMongoCollection(Changeling):
+    """ Wrapper for a mongo collection that applies _filter to every query.
+        With timeout_wrap, calls that fail on network errors are retried per
+        retry_policy (a mongodec.RetryPolicy; the default one if None).
+        If circuit_breaker (a mongodec.CircuitBreaker) is given, calls fail
+        fast while it's open; without timeout_wrap they then just aren't
+        retried. If metrics (a mongodec.metrics.CallMetrics) is given, calls
+        are recorded in it under the collection's full name, and slow calls
+        are kept in slow_query_log (a mongodec.metrics.SlowQueryLog) if given.
+        find_one, count and distinct results are cached in result_cache (a
+        mongodec.cache.ResultCache) if given, until a write through this
+        wrapper or the cache's ttl. With single_flight (a
+        mongodec.cache.SingleFlight), concurrent identical find_one, count
+        and distinct calls (and aggregate calls, if it's asked to) share one
+        query
+
+        filter_mode picks how _filter is combined with callers' queries:
+        'merge' (the default) keeps the caller's value for keys both have,
+        'and' makes every query match _filter as well; see
+        mongodec.FilterPlan.apply
+
+        aggregate only filters the collection itself unless filter_lookups
+        is given: True to also filter the sub-pipelines of every $lookup,
+        $graphLookup and $unionWith, or a list of the collection names whose
+        joins should be filtered
 
-    def __init__(self, base_object, _filter=None, timeout_wrap=True):
+        With stamp, documents written through the collection get the
+        filter's equality fields (see mongodec.FilterPlan.stamp), so they
+        stay visible through it: inserted documents (insert_one,
+        insert_many -- stamped one by one as pymongo consumes the iterable
+        -- insert, save and bulk inserts) have them set in place, like _id,
+        and replacement documents (replace_one, find_one_and_replace,
+        ReplaceOne, update with a replacement) get them on a copy. Upserts
+        with update operators need nothing: mongo copies the query's
+        equality fields into the new document
+
+        find(..., raw=True) and aggregate(..., raw=True) skip decoding: they
+        run find_raw_batches and aggregate_raw_batches (filtered the same
+        way) and return raw_batches, memoryviews over each batch's BSON to
+        write out as is. Use raw_documents to read a batch's documents as
+        RawBSONDocuments
+
+        Anything in cdict['call_hooks'] sees the call to the pymongo method
+        after the filter has been injected; see changeling.hooked
+    """
+    def __init__(self, base_object, _filter=None, timeout_wrap=True,
+                 retry_policy=None, circuit_breaker=None, metrics=None,
+                 slow_query_log=None, filter_mode='merge',
+                 filter_lookups=False, stamp=False, result_cache=None,
+                 single_flight=None):
         super(self.__class__, self).__init__(base_object)
         self._filter = _filter
+        self.cdict['metrics'] = metrics
 
         method_dict = {}
         self.cdict['%s_methods' % self.class_prefix] = method_dict
         self.cdict['update_filter'] = _filter
+        self.cdict['filter_plan'] = compile_filter(_filter, filter_mode)
+        if filter_lookups and filter_lookups is not True:
+            filter_lookups = frozenset(filter_lookups)
+        self.cdict['filter_lookups'] = filter_lookups
+        self.cdict['stamp'] = stamp
+
+        method_dict.update(filter_methods(self.cdict, stamp))
+
+        # With a result cache, writes we don't rewrite still go through the
+        # call hooks so that they're seen by it. Without one they're left
+        # unwrapped, and cost nothing extra per call
+        if result_cache is not None:
+            for method in WRITE_METHODS:
+                method_dict.setdefault(method, hooked(call_through))
 
-        for method in ['count', 'replace_one', 'update_one', 'update_many',
-                       'delete_one', 'delete_many',
-                       'find_one_and_delete', 'find_one_and_replace',
-                       'find_one_and_update', 'distinct']:
-
-            method_dict[method] = replace_arg('filter', update_filter,
-                                              cdict=self.cdict)
-
-            method_dict['update'] = replace_arg('spec', update_filter,
-                                                cdict=self.cdict)
-            method_dict['remove'] = replace_arg('spec_or_id',
-                                                update_filter,
-                                                cdict=self.cdict)
-            method_dict['aggregate'] = replace_arg('pipeline',
-                                                   modify_agg_pipeline,
-                                                   cdict=self.cdict)
-            method_dict['group'] = replace_arg('condition', update_filter,
-                                               cdict=self.cdict)
-        if timeout_wrap:
+        call_hooks = []
+        if result_cache is not None:
+            call_hooks.append(result_cache)
+        if single_flight is not None:
+            call_hooks.append(single_flight)
+        if slow_query_log is not None:
+            call_hooks.append(slow_query_log)
+        self.cdict['call_hooks'] = call_hooks
+        self.cdict['collection_name'] = self.base_object.full_name
+        self.cdict['collection_options'] = collection_options(
+            self.base_object)
+        self.cdict['result_cache'] = result_cache
+
+        if timeout_wrap or circuit_breaker is not None:
             self.cdict['%s_wrap_all' % self.class_prefix] = mongo_timeout_wrap
+            self.cdict['retry_policy'] = (retry_policy if timeout_wrap else
+                                          NO_RETRY_POLICY)
+            self.cdict['circuit_breaker'] = circuit_breaker
+
+    def metrics_label(self):
+        return self.base_object.full_name
+
+    def call_base(self, name, **callargs):
+        """ Calls base_object.<name>(**callargs) through the call hooks and
+            metrics, for methods we overwrite rather than wrap in the cdict
+        """
+        method = getattr(self.base_object, name)
+        hooks = self.cdict.get('call_hooks')
+        if hooks:
+            method = apply_hooks(hooks, method, self.cdict, name)
+        metrics = self.cdict.get('metrics')
+        if metrics is not None:
+            method = metrics.instrument(self.metrics_label(), name, method)
+        return method(**callargs)
+
+    def buffered_writer(self, **kwargs):
+        """ Returns a BufferedWriter that batches single writes to this
+            collection into bulk_write calls (filtered like any other), see
+            mongodec.buffered.BufferedWriter for the kwargs
+        """
+        return BufferedWriter(self, **kwargs)
 
     ######################################################################
     #   Wrappers and weird overwrite methods                             #
     ######################################################################
 
     def find(self, _filter=None, projection=None, no_changeling=False,
-             **other_kwargs):
+             raw=False, **other_kwargs):
         """ Not handled by the getattr because the implementation doesn't name
-            args past *args, **kwargs
+            args past *args, **kwargs. With raw, returns raw_batches of a
+            find_raw_batches cursor instead of a Cursor
         """
+        if raw:
+            return raw_batches(self.find_raw_batches(
+                _filter, projection, no_changeling=no_changeling,
+                **other_kwargs))
+
         if not no_changeling:
             _filter = update_filter('filter', self.cdict,
                                     {'filter': _filter})['filter']
 
-        return self.base_object.find(_filter, projection, **other_kwargs)
+        return self.call_base('find', filter=_filter, projection=projection,
+                              **other_kwargs)
+
+
+    def aggregate(self, pipeline, raw=False, **kwargs):
+        """ Dispatched through the cdict like any other method, except that
+            raw is handled here, before no_changeling: with raw, returns
+            raw_batches of an aggregate_raw_batches cursor instead of a
+            CommandCursor
+        """
+        if raw:
+            return raw_batches(self.aggregate_raw_batches(pipeline, **kwargs))
+        return self.compiled('aggregate')(pipeline, **kwargs)
+
+
+    def find_raw_batches(self, _filter=None, projection=None,
+                         no_changeling=False, **other_kwargs):
+        """ Returns pymongo's RawBatchCursor over the filtered query """
+        if not no_changeling:
+            _filter = update_filter('filter', self.cdict,
+                                    {'filter': _filter})['filter']
+
+        return self.call_base('find_raw_batches', filter=_filter,
+                              projection=projection, **other_kwargs)
 
 
     def find_one(self, _filter=None, projection=None, no_changeling=False,
@@ -101,7 +402,8 @@ class FilterMongoCollection(Changeling):
             _filter = update_filter('filter', self.cdict,
                                     {'filter': _filter})['filter']
 
-        return self.base_object.find_one(_filter, projection, **other_kwargs)
+        return self.call_base('find_one', filter=_filter,
+                              projection=projection, **other_kwargs)
 
 
 
@@ -111,7 +413,11 @@ class FilterMongoCollection(Changeling):
         for more details
         """
         bulk_op = self.base_object.initialize_unordered_bulk_op(**kwargs)
-        return FilterMongoBulkOperationBuilder(bulk_op, _filter=self._filter)
+        return FilterMongoBulkOperationBuilder(
+            bulk_op, _filter=self._filter,
+            filter_plan=self.cdict['filter_plan'], stamp=self.cdict['stamp'],
+            result_cache=self.cdict['result_cache'],
+            collection_name=self.cdict['collection_name'])
 
 
     def initialize_ordered_bulk_op(self, **kwargs):
@@ -120,23 +426,80 @@ class FilterMongoCollection(Changeling):
         for more details
         """
         bulk_op = self.base_object.initialize_ordered_bulk_op(**kwargs)
-        return FilterMongoBulkOperationBuilder(bulk_op, _filter=self._filter)
+        return FilterMongoBulkOperationBuilder(
+            bulk_op, _filter=self._filter,
+            filter_plan=self.cdict['filter_plan'], stamp=self.cdict['stamp'],
+            result_cache=self.cdict['result_cache'],
+            collection_name=self.cdict['collection_name'])
+
+
+
 
+class FilterMongoCollectionSpec(object):
+    """ Picklable description of a FilterMongoCollection: where the
+        collection is (a MongoConfig and names), its _filter and any other
+        FilterMongoCollection kwargs, which have to pickle too (so no
+        CircuitBreakers, CallMetrics or RetryPolicies with a RetryBudget;
+        build those in the worker). Send it to worker processes and call
+        collection() there.
+    """
+    def __init__(self, config, collection_name, _filter=None, database=None,
+                 **collection_kwargs):
+        self.config = config
+        self.collection_name = collection_name
+        self._filter = _filter
+        self.database = database
+        self.collection_kwargs = collection_kwargs
+        self.built = None
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['built'] = None
+        return state
+
+    def collection(self):
+        """ Returns the FilterMongoCollection this describes, built once per
+            process on the process's shared client for config (forked
+            children get their own, see mongodec.client_registry)
+        """
+        pid = os.getpid()
+        if self.built is None or self.built[0] != pid:
+            database = self.database or self.config.resolve()['database']
+            base_object = self.config.client()[database][self.collection_name]
+            self.built = (pid, FilterMongoCollection(
+                base_object, _filter=self._filter, **self.collection_kwargs))
+        return self.built[1]
 
 
 class FilterMongoBulkOperationBuilder(Changeling):
-    def __init__(self, base_object, _filter=None):
+    def __init__(self, base_object, _filter=None, filter_plan=None,
+                 stamp=False, result_cache=None, collection_name=None):
         super(self.__class__, self).__init__(base_object)
         self._filter = _filter
+        self.filter_plan = filter_plan or compile_filter(_filter)
+        self.stamp = stamp
+        self.result_cache = result_cache
+        self.collection_name = collection_name
         self.no_wrap_all = True
 
 
     def find(self, selector, no_changeling=False, **other_kwargs):
         if not no_changeling:
-            selector = update_filter('selector',
-                                     {'update_filter': self._filter},
-                                     {'selector': selector})['selector']
+            selector = self.filter_plan.apply(selector)
 
         return self.base_object.find(selector, **other_kwargs)
 
+
+    def insert(self, document, no_changeling=False):
+        if self.stamp and not no_changeling:
+            self.filter_plan.stamp(document, in_place=True)
+
+        return self.base_object.insert(document)
+
+
+    def execute(self, *args, **kwargs):
+        try:
+            return self.base_object.execute(*args, **kwargs)
+        finally:
+            if self.result_cache is not None:
+                self.result_cache.invalidate(self.collection_name)
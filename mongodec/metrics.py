@@ -0,0 +1,372 @@
+""" Call counts, latencies, errors and retries for Changeling methods """
+
+from collections import deque
+import logging
+import threading
+import time
+
+
+'''
+###############################################################################
+#                                                                             #
+#                                 CALL METRICS                                #
+#                                                                             #
+###############################################################################
+'''
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+class CallMetrics(object):
+    """ Collects per-method metrics for Changelings. Put an instance in a
+        Changeling's cdict under 'metrics' (FilterMongoCollection and
+        FilterMongoDB take a metrics kwarg) and every call to a method of the
+        base object is counted and timed, keyed by (label, method name), where
+        label is the Changeling's metrics_label() -- the collection's full
+        name for FilterMongoCollections. Retries made by mongo_timeout_wrap
+        are counted against the call they happen in. Calls returning
+        Futures are timed until the Future resolves.
+
+        Changelings without metrics in their cdict don't get the timing
+        wrapper at all, so disabled metrics cost nothing per call.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.current = threading.local()
+
+    def instrument(self, label, method, func):
+        """ Returns func wrapped to record each call under (label, method) """
+        def wrapper(*args, **kwargs):
+            outer = getattr(self.current, 'key', None)
+            self.current.key = (label, method)
+            start_time = time.time()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                self.observe(label, method, time.time() - start_time,
+                             error=True)
+                raise
+            else:
+                if hasattr(result, 'add_done_callback'):
+                    # A Future (e.g. from Motor): time it until it resolves
+                    def done(future):
+                        self.observe(label, method, time.time() - start_time,
+                                     error=future.exception() is not None)
+                    result.add_done_callback(done)
+                else:
+                    self.observe(label, method, time.time() - start_time)
+                return result
+            finally:
+                self.current.key = outer
+        return wrapper
+
+    def current_key(self):
+        """ The (label, method) of the call this thread is making, if any """
+        return getattr(self.current, 'key', None)
+
+    def stats_for(self, key):
+        """ Returns the (mutable) stats dict for key. Call with lock held """
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = {'calls': 0, 'errors': 0, 'retries': 0,
+                                       'total_seconds': 0.0,
+                                       'bucket_counts':
+                                           [0] * (len(self.buckets) + 1)}
+        return stats
+
+    def observe(self, label, method, duration, error=False):
+        """ Records one call of method that took duration seconds """
+        index = 0
+        for bound in self.buckets:
+            if duration <= bound:
+                break
+            index += 1
+        with self.lock:
+            stats = self.stats_for((label, method))
+            stats['calls'] += 1
+            stats['errors'] += int(bool(error))
+            stats['total_seconds'] += duration
+            stats['bucket_counts'][index] += 1
+
+    def record_retry(self, key=None):
+        """ Records a retry of the call under key, by default the call this
+            thread is currently making
+        """
+        if key is None:
+            key = self.current_key()
+        if key is None:
+            return
+        with self.lock:
+            self.stats_for(key)['retries'] += 1
+
+    def snapshot(self):
+        """ Returns a copy of the metrics collected so far
+        RETURNS:
+            dict mapping (label, method) to a dict with keys 'calls',
+            'errors', 'retries', 'total_seconds' and 'buckets', a list of
+            cumulative (upper bound, count) pairs ending with
+            (float('inf'), calls)
+        """
+        bounds = self.buckets + (float('inf'),)
+        with self.lock:
+            snapshot = {}
+            for key, stats in self.stats.items():
+                cumulative, buckets = 0, []
+                for bound, count in zip(bounds, stats['bucket_counts']):
+                    cumulative += count
+                    buckets.append((bound, cumulative))
+                snapshot[key] = {'calls': stats['calls'],
+                                 'errors': stats['errors'],
+                                 'retries': stats['retries'],
+                                 'total_seconds': stats['total_seconds'],
+                                 'buckets': buckets}
+            return snapshot
+
+    def reset(self):
+        """ Drops everything collected so far """
+        with self.lock:
+            self.stats = {}
+
+
+'''
+##############################################################################
+#                                                                            #
+#                               SLOW QUERY LOG                               #
+#                                                                            #
+##############################################################################
+'''
+
+# Methods returning cursors, which are timed until they've been read
+LAZY_METHODS = frozenset(['find', 'aggregate'])
+
+# Names a wrapped method's query argument can go by
+QUERY_ARGNAMES = ('filter', 'spec', 'spec_or_id', 'condition', 'pipeline')
+
+logger = logging.getLogger('mongodec.slow_queries')
+logger.addHandler(logging.NullHandler())
+
+
+class SlowQueryLog(object):
+    """ Keeps the last maxlen calls that took at least threshold seconds, with
+        the query as it was sent to mongo (i.e. after the filter was injected),
+        values redacted. Pass it to FilterMongoCollection as slow_query_log;
+        it runs as a cdict call hook. Each slow call is also logged to the
+        'mongodec.slow_queries' logger at WARNING.
+
+        find and aggregate return cursors that fetch documents as they're
+        read, so their cursors come back wrapped in a TimedCursor: the call
+        is timed until the cursor is exhausted or closed (counting the time
+        spent building and reading it, not the caller's time in between),
+        and n_returned is the number of documents read. Cursors dropped
+        before either aren't recorded.
+    """
+    def __init__(self, threshold=0.1, maxlen=1000):
+        self.threshold = threshold
+        self.records = deque(maxlen=maxlen)
+        self.lock = threading.Lock()
+
+    def __call__(self, func, cdict, name, callargs):
+        start_time = time.time()
+        result = func(**callargs)
+        duration = time.time() - start_time
+        collection = (cdict or {}).get('collection_name')
+        if name in LAZY_METHODS and result is not None:
+            def finished(duration, n_returned):
+                if duration >= self.threshold:
+                    self.record(collection, name, callargs, duration,
+                                n_returned)
+            return TimedCursor(result, duration, finished)
+        if duration >= self.threshold:
+            self.record(collection, name, callargs, duration,
+                        count_returned(result))
+        return result
+
+    def record(self, collection, method, callargs, duration, n_returned):
+        """ Adds a record for a slow call """
+        query = None
+        for argname in QUERY_ARGNAMES:
+            if argname in callargs:
+                query = redact(callargs[argname])
+                break
+        record = {'time': time.time(),
+                  'collection': collection,
+                  'method': method,
+                  'query': query,
+                  'duration': duration,
+                  'n_returned': n_returned}
+        with self.lock:
+            self.records.append(record)
+        logger.warning('Slow mongo query (%.3fs): %s.%s %r', duration,
+                       collection, method, query)
+
+    def entries(self):
+        """ Returns the slow calls recorded so far, oldest first """
+        with self.lock:
+            return list(self.records)
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+
+
+class TimedCursor(object):
+    """ Wraps a cursor to time reading it. Everything but iteration and
+        close is passed on to the cursor; its methods that return the cursor
+        itself (sort, limit, ...) return the TimedCursor instead.
+    ARGS:
+        cursor - the cursor (or any iterator) to wrap
+        duration - seconds already spent making it
+        finished - called like finished(duration, n_returned) once, when
+                   the cursor is exhausted, fails or is closed
+    """
+    def __init__(self, cursor, duration, finished):
+        self.cursor = cursor
+        self.duration = duration
+        self.n_returned = 0
+        self.finished = finished
+        self.done = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        start_time = time.time()
+        try:
+            document = next(self.cursor)
+        except BaseException:
+            self.duration += time.time() - start_time
+            self.finish()
+            raise
+        self.duration += time.time() - start_time
+        self.n_returned += 1
+        return document
+
+    __next__ = next
+
+    def close(self):
+        try:
+            close = getattr(self.cursor, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self.finish()
+
+    def finish(self):
+        if not self.done:
+            self.done = True
+            self.finished(self.duration, self.n_returned)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getitem__(self, index):
+        return self.passed_on(self.cursor[index])
+
+    def __getattr__(self, name):
+        attr = getattr(self.cursor, name)
+        if not callable(attr):
+            return attr
+
+        def method(*args, **kwargs):
+            return self.passed_on(attr(*args, **kwargs))
+        return method
+
+    def passed_on(self, result):
+        return self if result is self.cursor else result
+
+
+def redact(query):
+    """ Returns the shape of a query: the same keys and operators, with every
+        value replaced by '?'. Lists of values collapse to ['?']
+    """
+    if isinstance(query, dict):
+        return dict((k, redact(v)) for k, v in query.items())
+    elif isinstance(query, (list, tuple)):
+        shapes = []
+        for item in query:
+            shape = redact(item)
+            if shape not in shapes:
+                shapes.append(shape)
+        return shapes
+    elif query is None:
+        return None
+    return '?'
+
+
+def count_returned(result):
+    """ Number of documents a call returned, or None if that can't be told
+        without consuming it (cursors) or it didn't return documents
+    """
+    if result is None:
+        return 0
+    elif isinstance(result, dict):
+        return 1
+    elif isinstance(result, list):
+        return len(result)
+    return None
+
+
+'''
+##############################################################################
+#                                                                            #
+#                               EXPORTERS                                    #
+#                                                                            #
+##############################################################################
+'''
+
+def prometheus_text(metrics, prefix='mongodec'):
+    """ Renders a CallMetrics snapshot in the Prometheus text format
+    ARGS:
+        metrics - a CallMetrics instance
+        prefix - prefix for the metric names
+    RETURNS:
+        a string with the counters <prefix>_calls_total,
+        <prefix>_call_errors_total, <prefix>_call_retries_total and the
+        histogram <prefix>_call_duration_seconds, labelled by collection and
+        method
+    """
+    snapshot = metrics.snapshot()
+    keys = sorted(snapshot)
+    lines = []
+
+    for name, field, doc in [('calls_total', 'calls', 'Calls made'),
+                             ('call_errors_total', 'errors',
+                              'Calls that raised'),
+                             ('call_retries_total', 'retries',
+                              'Retries made by mongo_timeout_wrap')]:
+        lines.append('# HELP %s_%s %s' % (prefix, name, doc))
+        lines.append('# TYPE %s_%s counter' % (prefix, name))
+        for key in keys:
+            lines.append('%s_%s{%s} %s' % (prefix, name, prometheus_labels(key),
+                                           snapshot[key][field]))
+
+    name = '%s_call_duration_seconds' % prefix
+    lines.append('# HELP %s Call latency' % name)
+    lines.append('# TYPE %s histogram' % name)
+    for key in keys:
+        labels = prometheus_labels(key)
+        for bound, count in snapshot[key]['buckets']:
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append('%s_bucket{%s,le="%s"} %s' % (name, labels, le,
+                                                       count))
+        lines.append('%s_sum{%s} %r' % (name, labels,
+                                        snapshot[key]['total_seconds']))
+        lines.append('%s_count{%s} %s' % (name, labels,
+                                          snapshot[key]['calls']))
+
+    return '\n'.join(lines) + '\n'
+
+
+def prometheus_labels(key):
+    """ Formats a (label, method) key as Prometheus labels """
+    def escape(value):
+        return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+                .replace('\n', '\\n'))
+    return 'collection="%s",method="%s"' % (escape(key[0]), escape(key[1]))
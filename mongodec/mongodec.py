@@ -9,7 +9,16 @@ import inspect
 import time
 from pymongo.collection import Collection
 from pymongo.errors import NetworkTimeout, ConnectionFailure
+from bson.regex import Regex
+from pymongo.operations import InsertOne, UpdateOne, UpdateMany, \
+                               ReplaceOne, DeleteOne, DeleteMany
 import json
+import copy
+import re
+import atexit
+import random
+import threading
+import collections
 
 
 '''
@@ -41,9 +50,50 @@ class MongoConfig(object):
         self.client_kwargs = client_kwargs
         # OR PASS AN ENV VAR
         self.environ_var = environ_var
+        self.resolved_config = None
 
-    def client(self):
-        """Returns a pymongo MongoClient instance"""
+    def client(self, shared=True):
+        """Returns a pymongo MongoClient instance. By default this is the
+           process-wide client for this config's URI and client_kwargs (see
+           shared_client); pass shared=False for a private one
+        """
+        resolved = self.resolve()
+        if shared:
+            return shared_client(resolved['uri'], resolved['client_kwargs'])
+        return MongoClient(resolved['uri'], **resolved['client_kwargs'])
+
+    def close(self):
+        """ Closes and forgets the shared client for this config, if any """
+        resolved = self.resolve()
+        close_clients(resolved['uri'], resolved['client_kwargs'])
+
+    def uri(self):
+        """Returns the mongodb:// connection string for this config"""
+        return self.resolve()['uri']
+
+    def resolve(self):
+        """ Returns the resolved connection settings, a dict with keys 'uri',
+            'database' and 'client_kwargs'. These are worked out (and the
+            environment variable parsed) once; call refresh() to pick up
+            changes, e.g. rotated credentials
+        """
+        resolved = self.resolved_config
+        if resolved is None:
+            resolved = self.resolved_config = self.build_resolved_config()
+        return resolved
+
+    def refresh(self):
+        """ Drops the resolved settings and re-reads them (including the
+            environment variable). Clients for the old URI are left to
+            close_clients
+        RETURNS:
+            the new resolved config (see resolve)
+        """
+        self.resolved_config = None
+        return self.resolve()
+
+    def build_resolved_config(self):
+        """ Builds the dict returned by resolve """
         if self.environ_var is not None:
             config_dict = json.loads(os.environ.get(self.environ_var))
         else:
@@ -69,22 +119,346 @@ class MongoConfig(object):
             db_uri = 'mongodb://%s:%s@%s%s/%s%s' % (user, password, host, port,
                                                     database, replica_set)
         else:
-            db_uri = 'mongodb://%s/%s%s' % (host, port, database)
+            db_uri = 'mongodb://%s%s/%s%s' % (host, port, database,
+                                              replica_set)
 
-        return MongoClient(db_uri, **(self.client_kwargs or {}))
+        return {'uri': db_uri,
+                'database': database,
+                'client_kwargs': dict(self.client_kwargs or {})}
 
     def modify_client_kwargs(self, new_kwargs):
         """ Setter method for client_kwargs """
         self.client_kwargs = new_kwargs
+        self.resolved_config = None
 
     def db(self):
         """Returns a pymongo Database instance"""
+        return self.client()[self.resolve()['database']]
 
-        if self.environ_var is not None:
-            database = json.loads(os.environ.get(self.environ_var))['database']
+
+'''
+##############################################################################
+#                                                                            #
+#                               SHARED CLIENTS                               #
+#                                                                            #
+##############################################################################
+'''
+
+# One MongoClient per (uri, client_kwargs), owned by the process in 'pid'.
+# MongoClients aren't fork-safe, so a child process starts with an empty
+# registry (and a fresh lock, in case a parent thread held it mid-fork)
+CLIENT_REGISTRY = {'pid': os.getpid(), 'clients': {},
+                   'lock': threading.Lock()}
+
+
+def client_registry():
+    """ Returns CLIENT_REGISTRY, reset first if we've forked since it was
+        last used. The parent's clients are dropped, not closed: their
+        sockets belong to the parent
+    """
+    if CLIENT_REGISTRY['pid'] != os.getpid():
+        CLIENT_REGISTRY.update({'pid': os.getpid(), 'clients': {},
+                                'lock': threading.Lock()})
+    return CLIENT_REGISTRY
+
+
+def client_key(uri, client_kwargs=None):
+    """ Hashable registry key for a uri and client kwargs (which may hold
+        unhashable values, so they're keyed by repr)
+    """
+    return (uri, repr(sorted((client_kwargs or {}).items())))
+
+
+def shared_client(uri, client_kwargs=None):
+    """ Returns the process-wide MongoClient for uri and client_kwargs,
+        creating it on first use
+    ARGS:
+        uri - mongodb:// connection string
+        client_kwargs - dict of extra MongoClient kwargs
+    RETURNS:
+        a pymongo MongoClient, shared with every other caller in this process
+        asking for the same uri and kwargs
+    """
+    registry = client_registry()
+    key = client_key(uri, client_kwargs)
+    with registry['lock']:
+        client = registry['clients'].get(key)
+        if client is None:
+            client = MongoClient(uri, **(client_kwargs or {}))
+            registry['clients'][key] = client
+        return client
+
+
+def close_clients(uri=None, client_kwargs=None):
+    """ Closes and forgets shared clients
+    ARGS:
+        uri - if given, only the client for uri and client_kwargs is closed.
+              Otherwise every shared client this process owns is
+    RETURNS:
+        None
+    """
+    registry = client_registry()
+    with registry['lock']:
+        if uri is None:
+            clients = list(registry['clients'].values())
+            registry['clients'].clear()
         else:
-            database = self.database
-        return self.client()[database]
+            client = registry['clients'].pop(client_key(uri, client_kwargs),
+                                             None)
+            clients = [client] if client is not None else []
+    for client in clients:
+        client.close()
+
+
+atexit.register(close_clients)
+
+
+'''
+##############################################################################
+#                                                                            #
+#                               RETRY POLICIES                               #
+#                                                                            #
+##############################################################################
+'''
+
+
+class RetryBudget(object):
+    """ Token bucket that caps retries across everything sharing it, so that
+        retries stop piling load onto a cluster that's already down.
+        Every retry takes a token, every successful call puts back
+        token_ratio of one; once the bucket is down to half of max_tokens
+        retries are refused until enough calls succeed again.
+    """
+    def __init__(self, max_tokens=100, token_ratio=0.1):
+        self.max_tokens = float(max_tokens)
+        self.token_ratio = token_ratio
+        self.tokens = float(max_tokens)
+        self.lock = threading.Lock()
+
+    def withdraw(self):
+        """ Takes a token for a retry. Returns False if the retry should be
+            skipped
+        """
+        with self.lock:
+            if self.tokens - 1 < self.max_tokens / 2:
+                return False
+            self.tokens -= 1
+            return True
+
+    def deposit(self):
+        """ Records a successful call """
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.token_ratio)
+
+
+# Shared by every RetryPolicy that isn't given its own budget
+DEFAULT_RETRY_BUDGET = RetryBudget()
+
+
+class RetryPolicy(object):
+    """ How mongo_timeout_wrap retries failed calls: exponential backoff from
+        base_delay up to max_delay seconds (with full jitter unless jitter is
+        False), until deadline seconds have passed since the first attempt,
+        max_attempts attempts have been made (None for no limit) or budget
+        refuses the retry. Only exceptions in retryable are retried; once we
+        give up, the last one is re-raised.
+    """
+    def __init__(self, base_delay=0.05, max_delay=2.0, jitter=True,
+                 deadline=30, max_attempts=None,
+                 retryable=(NetworkTimeout, ConnectionFailure),
+                 budget=DEFAULT_RETRY_BUDGET):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.retryable = tuple(retryable)
+        self.budget = budget
+
+    def delay(self, attempt):
+        """ Seconds to sleep after the attempt-th (1-indexed) failure """
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def should_retry(self, attempt, elapsed, delay):
+        """ Whether to make another attempt after the attempt-th failure,
+            elapsed seconds in, and sleeping delay seconds first
+        """
+        if self.max_attempts is not None and attempt >= self.max_attempts:
+            return False
+        if self.deadline is not None and elapsed + delay > self.deadline:
+            return False
+        if self.budget is not None and not self.budget.withdraw():
+            return False
+        return True
+
+    def call(self, func, callargs, circuit_breaker=None, metrics=None):
+        """ Calls func(**callargs), retrying per this policy. If
+            circuit_breaker is given, every attempt goes through it; if
+            metrics (a CallMetrics) is, retries are recorded in it
+        """
+        start_time = time.time()
+        attempt = 0
+        while True:
+            attempt += 1
+            if circuit_breaker is not None:
+                circuit_breaker.before_call()
+            try:
+                result = func(**callargs)
+            except Exception as e:
+                delay = self.failed(e, attempt, time.time() - start_time,
+                                    circuit_breaker, metrics)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+            except BaseException:
+                self.interrupted(circuit_breaker)
+                raise
+            else:
+                self.succeeded(circuit_breaker)
+                return result
+
+    # The bookkeeping of one attempt, shared with the coroutine version of
+    # call in motor_mongo
+
+    def failed(self, error, attempt, elapsed, circuit_breaker=None,
+               metrics=None, metrics_key=None):
+        """ Records the attempt-th attempt's error, elapsed seconds after
+            the first attempt started
+        ARGS:
+            metrics, metrics_key - the CallMetrics to record a retry in, and
+                                   the key to record it under (by default
+                                   the call this thread is making)
+        RETURNS:
+            seconds to sleep before the next attempt, or None if error
+            should be re-raised
+        """
+        if circuit_breaker is not None:
+            circuit_breaker.record_result(error)
+        if not isinstance(error, self.retryable):
+            return None
+        delay = self.delay(attempt)
+        if not self.should_retry(attempt, elapsed, delay):
+            return None
+        if metrics is not None:
+            metrics.record_retry(metrics_key)
+        return delay
+
+    def succeeded(self, circuit_breaker=None):
+        """ Records an attempt that went through """
+        if circuit_breaker is not None:
+            circuit_breaker.record_result(None)
+        if self.budget is not None:
+            self.budget.deposit()
+
+    def interrupted(self, circuit_breaker=None):
+        """ Records an attempt stopped by a BaseException (KeyboardInterrupt,
+            GreenletExit, ...), which says nothing about mongo but mustn't
+            keep a half open breaker's probe slot
+        """
+        if circuit_breaker is not None:
+            circuit_breaker.release_probe()
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+'''
+##############################################################################
+#                                                                            #
+#                               CIRCUIT BREAKERS                             #
+#                                                                            #
+##############################################################################
+'''
+
+
+class CircuitOpenError(ConnectionFailure):
+    """ Raised instead of calling mongo while a CircuitBreaker is open """
+
+
+class CircuitBreaker(object):
+    """ Fails calls fast once mongo looks down. After failure_threshold
+        consecutive failures (exceptions in failures) the breaker opens and
+        every call raises CircuitOpenError for reset_timeout seconds. Then
+        it goes half open and lets up to half_open_calls probe calls
+        through: one success closes it again, one failure re-opens it.
+        Any other outcome, including non-connection errors, counts as a
+        success since mongo answered.
+
+        Share one breaker between the collections of a client (e.g. by
+        passing it to FilterMongoDB), and read snapshot() for health checks.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30,
+                 half_open_calls=1, failures=(ConnectionFailure,)):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.failures = tuple(failures)
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probes = 0
+
+    def before_call(self):
+        """ Raises CircuitOpenError if the call shouldn't go through """
+        with self.lock:
+            if (self.state == self.OPEN and
+                time.time() - self.opened_at >= self.reset_timeout):
+                self.state = self.HALF_OPEN
+                self.probes = 0
+            if self.state == self.OPEN:
+                raise CircuitOpenError('Circuit open for %.1f more seconds' %
+                                       self.seconds_until_probe())
+            if self.state == self.HALF_OPEN:
+                if self.probes >= self.half_open_calls:
+                    raise CircuitOpenError('Circuit half open, waiting on '
+                                           'probe calls')
+                self.probes += 1
+
+    def release_probe(self):
+        """ Gives back the probe slot of a call that passed before_call
+            but has no result to record (e.g. it was interrupted)
+        """
+        with self.lock:
+            if self.state == self.HALF_OPEN and self.probes > 0:
+                self.probes -= 1
+
+    def record_result(self, error):
+        """ Records how a call that passed before_call went
+        ARGS:
+            error - the exception it raised, or None if it succeeded
+        """
+        with self.lock:
+            if isinstance(error, self.failures):
+                self.consecutive_failures += 1
+                if (self.state == self.HALF_OPEN or
+                    self.consecutive_failures >= self.failure_threshold):
+                    self.state = self.OPEN
+                    self.opened_at = time.time()
+            else:
+                self.state = self.CLOSED
+                self.consecutive_failures = 0
+                self.opened_at = None
+
+    def seconds_until_probe(self):
+        if self.state != self.OPEN:
+            return 0
+        return max(0, self.opened_at + self.reset_timeout - time.time())
+
+    def snapshot(self):
+        """ Returns the breaker's state as a dict, e.g. for health checks """
+        with self.lock:
+            return {'state': self.state,
+                    'consecutive_failures': self.consecutive_failures,
+                    'opened_at': self.opened_at,
+                    'seconds_until_probe': self.seconds_until_probe()}
 
 
 '''
@@ -98,28 +472,30 @@ class MongoConfig(object):
 
 
 def mongo_timeout_wrap(func, cdict, callargs):
-    """ Wrapper that tries failed commands until we hit 30 seconds """
-    start_time = time.time()
-    while True:
-        if time.time() - start_time > 30:
-            raise Exception("Mongo query timeout wrapped over 30 seconds")
-        try:
-            return func(**callargs)
-        except NetworkTimeout:
-            pass
-        except ConnectionFailure:
-            pass
-            # I don't think we have to rebuild the connection here
+    """ Wrapper that retries failed commands according to the cdict's
+        'retry_policy' (a RetryPolicy; DEFAULT_RETRY_POLICY if unset, which
+        gives up after 30 seconds), through its 'circuit_breaker' if set.
+        Retries are counted in its 'metrics', if set
+    """
+    cdict = cdict or {}
+    policy = cdict.get('retry_policy') or DEFAULT_RETRY_POLICY
+    return policy.call(func, callargs, cdict.get('circuit_breaker'),
+                       cdict.get('metrics'))
 
 
 def modify_agg_pipeline(argname, cdict, callargs):
+    """ Puts the cdict's filter into an aggregation pipeline (and the
+        sub-pipelines of joins against the collections in the cdict's
+        'filter_lookups'), see rewrite_pipeline. Modifies the callargs
+        argument, but also returns the new callargs
+    """
     assert argname == 'pipeline'
 
-    new_step_0 = [{'$match': update_filter(argname, cdict,
-                                           {argname: None})[argname]}]
-    if new_step_0 != [{'$match': None}]:
-        callargs['pipeline'] = new_step_0 + callargs['pipeline']
-
+    plan = cdict.get('filter_plan')
+    if plan is None:
+        plan = compile_filter(cdict.get('update_filter'))
+    callargs['pipeline'] = rewrite_pipeline(plan, callargs['pipeline'],
+                                            cdict.get('filter_lookups'))
     return callargs
 
 
@@ -129,18 +505,494 @@ def update_filter(argname, cdict, callargs):
     If _filter is a dict and doesn't include composer_id, we add it in
     If _filter is not a dict, we assume it's a spec for the _id
 
+    Uses the cdict's precompiled 'filter_plan' if it has one, otherwise
+    compiles 'update_filter' on the spot.
+
+    Modifies the callargs argument, but also returns the new callargs. The
+    filter in callargs is replaced, never modified, so callers can reuse
+    their query dicts
+    """
+    plan = cdict.get('filter_plan')
+    if plan is None:
+        plan = compile_filter(cdict.get('update_filter'))
+    callargs[argname] = plan.apply(callargs[argname])
+    return callargs
+
+
+# bulk_write request classes that carry a filter
+FILTERED_REQUESTS = (UpdateOne, UpdateMany, ReplaceOne, DeleteOne, DeleteMany)
+
+
+def update_requests(argname, cdict, callargs):
+    """ Puts the cdict's filter into every filtered write in a bulk_write
+        request list (UpdateOne, UpdateMany, ReplaceOne, DeleteOne,
+        DeleteMany), in one pass. With the cdict's 'stamp' set, inserted and
+        replacement documents get the filter's equality fields too (see
+        filter_request). The request objects passed in aren't modified;
+        filtered ones are replaced by copies.
+
+    Modifies the callargs argument, but also returns the new callargs
+    """
+    plan = cdict.get('filter_plan')
+    if plan is None:
+        plan = compile_filter(cdict.get('update_filter'))
+    stamp = cdict.get('stamp', False)
+    callargs[argname] = [filter_request(plan, request, stamp)
+                         for request in callargs[argname]]
+    return callargs
+
+
+def filter_request(plan, request, stamp=False):
+    """ Returns request with plan's filter applied, if it has a filter. With
+        stamp, InsertOne documents get the filter's equality fields set in
+        place and ReplaceOne replacements get them on a copy, see
+        FilterPlan.stamp
+    """
+    if stamp and isinstance(request, InsertOne):
+        plan.stamp(request._doc, in_place=True)
+        return request
+    if not isinstance(request, FILTERED_REQUESTS):
+        return request
+    new_filter = plan.apply(request._filter)
+    new_doc = None
+    if stamp and isinstance(request, ReplaceOne):
+        new_doc = plan.stamp(request._doc)
+        if new_doc is request._doc:
+            new_doc = None
+    if new_filter is request._filter and new_doc is None:
+        return request
+    request = copy.copy(request)
+    request._filter = new_filter
+    if new_doc is not None:
+        request._doc = new_doc
+    return request
+
+
+def stamp_inserts(argname, cdict, callargs):
+    """ Sets the cdict's filter's equality fields on the documents about to
+        be inserted (see FilterPlan.stamp): on the document itself if
+        callargs[argname] is a dict, on each document of a list or tuple
+        (which is passed on as is, so the driver's own checks -- e.g. for an
+        empty list -- still apply), and on each document of any other
+        iterator as the driver pulls it, so large insert_many generators
+        aren't materialized an extra time. Anything else is left alone.
+
+        Like pymongo's own _id, the fields are set on the caller's documents.
+
+    Modifies the callargs argument, but also returns the new callargs
+    """
+    plan = cdict.get('filter_plan')
+    if plan is None:
+        plan = compile_filter(cdict.get('update_filter'))
+    documents = callargs[argname]
+    if not plan.stamp_items:
+        return callargs
+    if isinstance(documents, dict):
+        plan.stamp(documents, in_place=True)
+    elif isinstance(documents, (list, tuple)):
+        for document in documents:
+            plan.stamp(document, in_place=True)
+    elif isinstance(documents, collections.Iterator):
+        callargs[argname] = (plan.stamp(document, in_place=True)
+                             for document in documents)
+    return callargs
+
+
+def stamp_replacement(argname, cdict, callargs):
+    """ Sets the cdict's filter's equality fields on the replacement document
+        callargs[argname], so a replaced (or upserted) document stays visible
+        through the filter. Update documents (operators or pipelines) are
+        left alone: on upsert mongo copies equality fields of the query into
+        the new document itself. The caller's document isn't modified.
+
     Modifies the callargs argument, but also returns the new callargs
     """
-    filter_kwargs = cdict.get('update_filter') or {}
-    _filter = callargs[argname]
-    for k, v in filter_kwargs.iteritems():
+    plan = cdict.get('filter_plan')
+    if plan is None:
+        plan = compile_filter(cdict.get('update_filter'))
+    document = callargs[argname]
+    if isinstance(document, dict) and not any(
+            isinstance(k, basestring) and k.startswith('$') for k in document):
+        callargs[argname] = plan.stamp(document)
+    return callargs
+
+
+'''
+##############################################################################
+#                                                                            #
+#                               FILTER PLANS                                 #
+#                                                                            #
+##############################################################################
+'''
+
+# Operators allowed as top-level keys of a filter
+QUERY_OPERATORS = frozenset(['$and', '$or', '$nor', '$expr', '$where',
+                             '$text', '$comment', '$jsonSchema'])
+
+
+# Values that match by pattern rather than equality
+RE_TYPES = (type(re.compile('')), Regex)
+
+
+# FilterPlan modes: MERGE keeps the caller's value for any key both filters
+# have; AND makes the result match both, see FilterPlan.apply_and
+MERGE = 'merge'
+AND = 'and'
+
+
+class FilterPlan(object):
+    """ A filter validated and frozen once, so that injecting it into a query
+        is a single merge. Build these with compile_filter.
+    """
+    def __init__(self, _filter, mode=MERGE):
+        if mode not in (MERGE, AND):
+            raise ValueError('Unknown filter mode %r' % (mode,))
+        validate_filter(_filter)
+        self.mode = mode
+        self.filter = copy.deepcopy(_filter or {})
+        self.items = tuple(self.filter.items())
+        self.keys = tuple(self.filter)
+        self.stamp_items = equality_items(self.filter)
+        self.and_plan = self if mode == AND else None
+
+    def as_and(self):
+        """ Returns this plan in AND mode """
+        if self.and_plan is None:
+            self.and_plan = FilterPlan(self.filter, AND)
+        return self.and_plan
+
+    def apply(self, _filter):
+        """ Returns _filter with this plan's filter merged in: keys _filter
+            already has are left alone (in MERGE mode, see apply_and for AND
+            mode), None becomes a copy of the filter and anything other than
+            a dict is taken as an _id.
+
+            _filter itself is never modified. If it already has every key of
+            the plan it's returned as is, otherwise a new top-level dict is
+            built (nested values are shared, not copied)
+        """
+        if not self.items:
+            return _filter
         if _filter is None:
-            _filter = {k: v}
-        elif isinstance(_filter, dict):
-            _filter[k] = _filter.get(k, v)
+            return dict(self.items)
+        if not isinstance(_filter, dict):
+            _filter = {'_id': _filter}
+        if self.mode == AND:
+            return self.apply_and(_filter)
+        for k in self.keys:
+            if k not in _filter:
+                break
         else:
-            _filter = {'_id': _filter, k: v}
-    callargs[argname] = _filter
-    return callargs
+            return _filter
+        new_filter = dict(self.items)
+        new_filter.update(_filter)
+        return new_filter
+
+    def apply_and(self, _filter):
+        """ Merges into the dict _filter so that the result matches this
+            plan's filter *and* _filter, so a caller can't widen the plan's
+            filter by using the same key. The plan's clauses stay top-level
+            (where the planner can use a tenant-prefixed index):
+              - keys only one side has, and equal values, are kept as is
+              - operator dicts with no operators in common are flattened
+                into one, e.g. {'$gte': 1} and {'$lt': 5}
+              - $and lists are concatenated
+              - anything else that clashes moves the caller's clause into a
+                top-level $and
+        """
+        new_filter = None
+        clauses = []
+        for k, v in self.items:
+            if k not in _filter:
+                pass
+            elif _filter[k] == v:
+                continue
+            elif k == '$and':
+                v = list(v) + list(_filter[k])
+            elif mergeable_operators(v, _filter[k]):
+                merged = dict(v)
+                merged.update(_filter[k])
+                v = merged
+            else:
+                clauses.append({k: _filter[k]})
+            if new_filter is None:
+                new_filter = dict(_filter)
+            new_filter[k] = v
+
+        if new_filter is None:
+            return _filter
+        if clauses:
+            new_filter['$and'] = list(new_filter.get('$and', [])) + clauses
+        return new_filter
+
+
+    def stamp(self, document, in_place=False):
+        """ Returns document with the plan's equality fields (see
+            equality_items) set, so that it matches the plan's filter once
+            written. In MERGE mode fields the document already has are left
+            alone, in AND mode they're overwritten.
+
+            Unless in_place, document isn't modified: a shallow copy is made
+            if anything needs setting. Anything but a dict (e.g. a
+            RawBSONDocument) is returned as is
+        """
+        if not self.stamp_items or not isinstance(document, dict):
+            return document
+        new_document = document
+        for k, v in self.stamp_items:
+            if k in document and (self.mode == MERGE or document[k] == v):
+                continue
+            if new_document is document and not in_place:
+                new_document = copy.copy(document)
+            new_document[k] = v
+        return new_document
+
+
+def equality_items(_filter):
+    """ The (field, value) pairs of _filter that pin a top-level field to a
+        single value -- plain values, embedded documents and {'$eq': value}
+        -- i.e. what a document needs to match the filter. Dotted fields and
+        other operators are skipped
+    """
+    items = []
+    for k, v in (_filter or {}).items():
+        if k.startswith('$') or '.' in k or isinstance(v, RE_TYPES):
+            continue
+        if isinstance(v, dict) and any(op.startswith('$') for op in v):
+            if list(v) != ['$eq']:
+                continue
+            v = v['$eq']
+        items.append((k, v))
+    return tuple(items)
+
+
+# Operators that only mean something together, so must come from one side
+REGEX_OPERATORS = frozenset(['$regex', '$options'])
+
+
+def mergeable_operators(a, b):
+    """ True if a and b are operator dicts with no operator in common, so
+        that one dict holding both means the same as requiring each. $regex
+        and $options count as one operator: merging one side's $options
+        into the other's $regex would change that regex
+    """
+    if not (isinstance(a, dict) and isinstance(b, dict) and a and b):
+        return False
+    if REGEX_OPERATORS.intersection(a) and REGEX_OPERATORS.intersection(b):
+        return False
+    for op in b:
+        if not op.startswith('$') or op in a:
+            return False
+    for op in a:
+        if not op.startswith('$'):
+            return False
+    return True
+
+
+def compile_filter(_filter, mode=MERGE):
+    """ Validates _filter and builds its FilterPlan
+    ARGS:
+        _filter - a filter dict (or None for no filter). If it's already a
+                  FilterPlan it's returned as is
+        mode - MERGE ('merge') or AND ('and'), see FilterPlan.apply
+    RETURNS:
+        a FilterPlan
+    RAISES:
+        ValueError if _filter isn't a valid mongo filter
+    """
+    if isinstance(_filter, FilterPlan):
+        return _filter
+    return FilterPlan(_filter, mode)
+
+
+def validate_filter(_filter):
+    """ Raises ValueError if _filter isn't a dict of field names and top-level
+        query operators, with operator values that make sense
+    """
+    if _filter is None:
+        return
+    if not isinstance(_filter, dict):
+        raise ValueError('Filter must be a dict, not %r' % (_filter,))
+
+    for k, v in _filter.items():
+        if not isinstance(k, basestring):
+            raise ValueError('Filter keys must be strings, not %r' % (k,))
+        if k.startswith('$'):
+            if k not in QUERY_OPERATORS:
+                raise ValueError('Unknown top-level query operator %s' % k)
+            if k in ('$and', '$or', '$nor'):
+                if not isinstance(v, (list, tuple)) or not v:
+                    raise ValueError('%s needs a non-empty list' % k)
+                for clause in v:
+                    validate_filter(clause)
+        elif isinstance(v, dict) and v:
+            operators = [op.startswith('$') for op in v]
+            if any(operators) and not all(operators):
+                raise ValueError('Mixed operators and fields under %s' % k)
+
+
+'''
+##############################################################################
+#                                                                            #
+#                           PIPELINE REWRITING                               #
+#                                                                            #
+##############################################################################
+'''
+
+# Stages that have to come first; the filter's $match goes right after them
+LEADING_STAGES = frozenset(['$search', '$searchMeta', '$vectorSearch'])
+
+# Stages that report on the collection or server rather than reading its
+# documents; a $match after them would drop everything, so they're left be
+METADATA_STAGES = frozenset(['$collStats', '$indexStats', '$currentOp',
+                             '$listSessions', '$listLocalSessions',
+                             '$planCacheStats'])
+
+# How to inject the filter, keyed by pipeline shape (see pipeline_shape)
+PIPELINE_ACTIONS = {}
+MAX_PIPELINE_ACTIONS = 1024
+
+
+def rewrite_pipeline(plan, pipeline, lookups=None):
+    """ Returns a copy of pipeline that only sees documents matching plan's
+        filter. The filter goes in as a $match at the front, except that:
+          - it's merged into a leading $match, or folded into the query of
+            a leading $geoNear
+          - after a $search/$searchMeta/$vectorSearch (which must be first),
+            where it's again merged into a $match that follows
+          - pipelines starting with a metadata stage ($collStats,
+            $indexStats, ...) are returned unchanged
+        Merges always use AND semantics, so a pipeline's own $match can't
+        widen the filter. Where to put the filter is worked out once per
+        pipeline shape.
+
+        Joins against the collections in lookups get the filter too, see
+        filter_joins.
+    ARGS:
+        plan - a FilterPlan
+        pipeline - list of stages (not modified)
+        lookups - True to filter every $lookup/$graphLookup/$unionWith,
+                  a set of collection names to filter only joins against
+                  those, or None/False for none
+    RETURNS:
+        the new list of stages
+    """
+    pipeline = list(pipeline)
+    if not plan.items:
+        return pipeline
+    if lookups:
+        pipeline = filter_joins(plan, pipeline, lookups)
+
+    shape = pipeline_shape(pipeline)
+    action = PIPELINE_ACTIONS.get(shape)
+    if action is None:
+        action = pipeline_action(shape)
+        if len(PIPELINE_ACTIONS) >= MAX_PIPELINE_ACTIONS:
+            PIPELINE_ACTIONS.clear()
+        PIPELINE_ACTIONS[shape] = action
+
+    how, index = action
+    plan = plan.as_and()
+    if how == 'skip':
+        return pipeline
+    elif how == 'insert':
+        pipeline.insert(index, {'$match': plan.apply(None)})
+    elif how == 'merge':
+        pipeline[index] = {'$match': plan.apply(pipeline[index]['$match'])}
+    elif how == 'geo_near':
+        geo_near = dict(pipeline[index]['$geoNear'])
+        geo_near['query'] = plan.apply(geo_near.get('query'))
+        pipeline[index] = {'$geoNear': geo_near}
+    return pipeline
+
+
+def pipeline_shape(pipeline):
+    """ The names of the first two stages: all that decides where the filter
+        goes
+    """
+    return tuple(stage_name(stage) for stage in pipeline[:2])
+
+
+def stage_name(stage):
+    if isinstance(stage, dict) and len(stage) == 1:
+        for name in stage:
+            return name
+    return None
+
+
+def pipeline_action(shape):
+    """ Returns (how, index): where rewrite_pipeline puts the filter for a
+        pipeline of this shape. how is one of 'insert', 'merge', 'geo_near'
+        or 'skip'
+    """
+    index = 0
+    if shape and shape[0] in METADATA_STAGES:
+        return ('skip', 0)
+    if shape and shape[0] in LEADING_STAGES:
+        index = 1
+    name = shape[index] if len(shape) > index else None
+    if name == '$match':
+        return ('merge', index)
+    if name == '$geoNear' and index == 0:
+        return ('geo_near', index)
+    return ('insert', index)
+
+
+def filter_joins(plan, pipeline, lookups):
+    """ Returns a copy of pipeline whose joins against collections in lookups
+        (see rewrite_pipeline) only see documents matching plan's filter:
+          - $lookup sub-pipelines are rewritten with rewrite_pipeline; a
+            localField/foreignField $lookup gets a pipeline holding just the
+            $match (which needs MongoDB 5.0+)
+          - $graphLookup gets the filter merged into restrictSearchWithMatch
+          - $unionWith gets its pipeline rewritten (or one added)
+        Sub-pipelines of joins against other collections, and of $facet, are
+        searched for joins in turn.
+    """
+    new_pipeline = []
+    for stage in pipeline:
+        name = stage_name(stage)
+        spec = stage.get(name) if name is not None else None
+
+        if name == '$lookup' and isinstance(spec, dict):
+            spec = dict(spec)
+            if joins_filtered(spec.get('from'), lookups):
+                spec['pipeline'] = rewrite_pipeline(
+                    plan, spec.get('pipeline', []), lookups)
+            elif 'pipeline' in spec:
+                spec['pipeline'] = filter_joins(plan, spec['pipeline'],
+                                                lookups)
+            stage = {name: spec}
+
+        elif name == '$graphLookup' and isinstance(spec, dict):
+            if joins_filtered(spec.get('from'), lookups):
+                spec = dict(spec)
+                spec['restrictSearchWithMatch'] = plan.as_and().apply(
+                    spec.get('restrictSearchWithMatch'))
+                stage = {name: spec}
+
+        elif name == '$unionWith':
+            spec = dict(spec) if isinstance(spec, dict) else {'coll': spec}
+            if joins_filtered(spec.get('coll'), lookups):
+                spec['pipeline'] = rewrite_pipeline(
+                    plan, spec.get('pipeline', []), lookups)
+                stage = {name: spec}
+            elif 'pipeline' in spec:
+                spec['pipeline'] = filter_joins(plan, spec['pipeline'],
+                                                lookups)
+                stage = {name: spec}
+
+        elif name == '$facet' and isinstance(spec, dict):
+            stage = {name: dict((k, filter_joins(plan, v, lookups))
+                                for k, v in spec.items())}
+
+        new_pipeline.append(stage)
+    return new_pipeline
 
 
+def joins_filtered(collection_name, lookups):
+    """ Whether a join against collection_name gets the filter """
+    if lookups is True:
+        return collection_name is not None
+    return isinstance(collection_name, basestring) and \
+           collection_name in lookups
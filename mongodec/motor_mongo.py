@@ -0,0 +1,185 @@
+""" FilterMongoDB and FilterMongoCollection for Motor, the async driver.
+    Needs tornado (pip install mongodec[motor]); mongodec itself doesn't
+    import this module.
+"""
+
+import time
+
+from tornado import gen
+from pymongo.collection import Collection
+
+from mongodec import DEFAULT_RETRY_POLICY, update_filter, compile_filter
+from changeling import Changeling
+from filter_mongo import NO_RETRY_POLICY, filter_methods
+
+
+# Motor collection methods that return Futures. The others (find,
+# aggregate, with_options, ...) return cursors and objects right away and
+# aren't retried
+ASYNC_METHODS = frozenset(['bulk_write', 'count', 'create_index',
+                           'create_indexes', 'delete_many', 'delete_one',
+                           'distinct', 'drop', 'drop_index', 'drop_indexes',
+                           'ensure_index', 'find_and_modify', 'find_one',
+                           'find_one_and_delete', 'find_one_and_replace',
+                           'find_one_and_update', 'group',
+                           'index_information', 'inline_map_reduce',
+                           'insert', 'insert_many', 'insert_one',
+                           'map_reduce', 'options', 'reindex', 'remove',
+                           'rename', 'replace_one', 'save', 'update',
+                           'update_many', 'update_one'])
+
+
+def no_hooks(method_wrapper):
+    """ Call hooks expect results, not Futures, so they're left out """
+    return method_wrapper
+
+
+@gen.coroutine
+def motor_timeout_wrap(func, cdict, callargs):
+    """ mongo_timeout_wrap for Futures: retries func(**callargs) per the
+        cdict's 'retry_policy' (DEFAULT_RETRY_POLICY if unset), through its
+        'circuit_breaker' if set, sleeping between attempts with gen.sleep
+        so the IOLoop carries on. Retries are counted in its 'metrics', if
+        set
+    """
+    cdict = cdict or {}
+    policy = cdict.get('retry_policy') or DEFAULT_RETRY_POLICY
+    circuit_breaker = cdict.get('circuit_breaker')
+    metrics = cdict.get('metrics')
+    # Retries happen on later IOLoop callbacks, outside the call metrics
+    # sees, so take its key while we're still in it
+    metrics_key = metrics.current_key() if metrics is not None else None
+
+    start_time = time.time()
+    attempt = 0
+    while True:
+        attempt += 1
+        if circuit_breaker is not None:
+            circuit_breaker.before_call()
+        try:
+            result = yield func(**callargs)
+        except Exception as e:
+            delay = policy.failed(e, attempt, time.time() - start_time,
+                                  circuit_breaker, metrics, metrics_key)
+            if delay is None:
+                raise
+            yield gen.sleep(delay)
+        except BaseException:
+            policy.interrupted(circuit_breaker)
+            raise
+        else:
+            policy.succeeded(circuit_breaker)
+            raise gen.Return(result)
+
+
+class FilterMotorDB(Changeling):
+    """ FilterMongoDB for a MotorDatabase: collections come back as
+        FilterMotorCollections, built with _filter and any other kwargs
+    """
+    def __init__(self, base_object, _filter=None, **collection_kwargs):
+        super(self.__class__, self).__init__(base_object)
+        self._filter = _filter
+        self.collection_kwargs = collection_kwargs
+
+    def __getattr__(self, name):
+        attr = getattr(self.base_object, name)
+        if isinstance(getattr(attr, 'delegate', None), Collection):
+            return self.filter_collection(attr)
+        return super(self.__class__, self).__getattr__(name)
+
+    def __getitem__(self, collection_name):
+        return self.filter_collection(self.base_object[collection_name])
+
+    def get_collection(self, name, *args, **kwargs):
+        return self.filter_collection(
+            self.base_object.get_collection(name, *args, **kwargs))
+
+    def filter_collection(self, collection_obj):
+        return FilterMotorCollection(collection_obj, _filter=self._filter,
+                                     **self.collection_kwargs)
+
+
+class FilterMotorCollection(Changeling):
+    """ FilterMongoCollection for a MotorCollection: the filter goes into
+        every query the same way, and methods return what Motor's do --
+        Futures to yield in a coroutine, or MotorCursors for find and
+        aggregate. With timeout_wrap, the Future-returning methods are
+        retried per retry_policy, through circuit_breaker if given, with
+        motor_timeout_wrap.
+
+        See FilterMongoCollection for filter_mode, filter_lookups, stamp and
+        metrics; calls returning Futures are timed until they resolve. Call
+        hooks, caching and bulk op builders aren't supported.
+    """
+    def __init__(self, base_object, _filter=None, timeout_wrap=True,
+                 retry_policy=None, circuit_breaker=None, metrics=None,
+                 filter_mode='merge', filter_lookups=False, stamp=False):
+        super(self.__class__, self).__init__(base_object)
+        self._filter = _filter
+        self.cdict['metrics'] = metrics
+
+        self.cdict['update_filter'] = _filter
+        self.cdict['filter_plan'] = compile_filter(_filter, filter_mode)
+        if filter_lookups and filter_lookups is not True:
+            filter_lookups = frozenset(filter_lookups)
+        self.cdict['filter_lookups'] = filter_lookups
+        self.cdict['stamp'] = stamp
+        self.cdict['%s_methods' % self.class_prefix] = filter_methods(
+            self.cdict, stamp, wrap=no_hooks)
+
+        if timeout_wrap or circuit_breaker is not None:
+            self.cdict['%s_wrap_all' % self.class_prefix] = motor_timeout_wrap
+            self.cdict['%s_wrap_only' % self.class_prefix] = ASYNC_METHODS
+            self.cdict['retry_policy'] = (retry_policy if timeout_wrap else
+                                          NO_RETRY_POLICY)
+            self.cdict['circuit_breaker'] = circuit_breaker
+
+    def metrics_label(self):
+        return self.base_object.full_name
+
+    def signature_of(self, name, method):
+        """ Motor's methods take *args, **kwargs and pass them on to the
+            pymongo Collection's, so bind calls with the pymongo signature
+        """
+        return getattr(self.base_object.delegate, name, method)
+
+    def call_base(self, name, **callargs):
+        """ Calls base_object.<name>(**callargs), through the retry wrapper
+            if there is one, and the metrics
+        """
+        method = getattr(self.base_object, name)
+        wrap_all = self.cdict.get('%s_wrap_all' % self.class_prefix)
+        if wrap_all is None:
+            call = lambda **callargs: method(**callargs)
+        else:
+            call = lambda **callargs: wrap_all(method, self.cdict, callargs)
+        metrics = self.cdict.get('metrics')
+        if metrics is not None:
+            call = metrics.instrument(self.metrics_label(), name, call)
+        return call(**callargs)
+
+    ######################################################################
+    #   Wrappers and weird overwrite methods                             #
+    ######################################################################
+
+    def find(self, _filter=None, projection=None, no_changeling=False,
+             **other_kwargs):
+        """ Returns a MotorCursor over the filtered query """
+        if not no_changeling:
+            _filter = update_filter('filter', self.cdict,
+                                    {'filter': _filter})['filter']
+
+        return self.base_object.find(filter=_filter, projection=projection,
+                                     **other_kwargs)
+
+    def find_one(self, _filter=None, projection=None, no_changeling=False,
+                 **other_kwargs):
+        """ Returns a Future of the first document matching the filtered
+            query
+        """
+        if not no_changeling:
+            _filter = update_filter('filter', self.cdict,
+                                    {'filter': _filter})['filter']
+
+        return self.call_base('find_one', filter=_filter,
+                              projection=projection, **other_kwargs)
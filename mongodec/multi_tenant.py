@@ -0,0 +1,278 @@
+""" Running the same query for many tenants """
+
+from collections import namedtuple, OrderedDict
+import Queue
+import threading
+import time
+
+from pymongo.cursor import Cursor
+from pymongo.command_cursor import CommandCursor
+from pymongo.errors import PyMongoError
+
+from filter_mongo import FilterMongoDB
+from mongodec import compile_filter
+from cache import freeze
+from metrics import TimedCursor
+
+
+'''
+##############################################################################
+#                                                                            #
+#                                  FAN OUT                                   #
+#                                                                            #
+##############################################################################
+'''
+
+# One tenant's outcome: its key, what the query returned (None if it
+# failed) and the exception it raised (None if it didn't)
+TenantResult = namedtuple('TenantResult', ['tenant', 'result', 'error'])
+
+
+class QuerySpec(namedtuple('QuerySpec', ['collection', 'method', 'args',
+                                         'kwargs'])):
+    """ A query to run against each tenant's FilterMongoDB:
+        filter_db[collection].<method>(*args, **kwargs). Cursors are read
+        into lists, so the tenant's result is complete when it's yielded
+    """
+    def __new__(cls, collection, method, args=(), kwargs=None):
+        return super(QuerySpec, cls).__new__(cls, collection, method,
+                                             tuple(args), kwargs or {})
+
+    def __call__(self, filter_db):
+        result = getattr(filter_db[self.collection], self.method)(
+            *self.args, **self.kwargs)
+        if isinstance(result, (Cursor, CommandCursor, TimedCursor)):
+            result = list(result)
+        return result
+
+
+class DeadlineExceeded(PyMongoError):
+    """ The error of tenants whose query didn't finish before fan_out's
+        deadline
+    """
+
+
+def fan_out(base_db, tenant_filters, query, max_workers=8, deadline=None,
+            **db_kwargs):
+    """ Runs query once per tenant, concurrently, and yields each tenant's
+        TenantResult as soon as it's done. Every tenant gets its own
+        FilterMongoDB over base_db, so all of them share base_db's client
+        (and its connection pool).
+
+        A tenant whose query raises gets the exception as its error; the
+        other tenants carry on. Tenants not done by the deadline are
+        yielded last, in tenant_filters' order, with a DeadlineExceeded
+        error. Their queries aren't interrupted, but ones that haven't
+        started by then never will, and neither will any once the caller
+        stops iterating.
+    ARGS:
+        base_db - a pymongo Database
+        tenant_filters - dict of tenant key to that tenant's _filter, or a
+                         list of (tenant key, _filter) pairs
+        query - a QuerySpec, or any function taking the tenant's
+                FilterMongoDB and returning the tenant's result
+        max_workers - most queries running at once
+        deadline - seconds the whole fan out may take, None for no limit
+        db_kwargs - passed on to each FilterMongoDB (e.g. retry_policy)
+    RETURNS:
+        an iterator of TenantResults
+    """
+    if isinstance(tenant_filters, dict):
+        tenant_filters = tenant_filters.items()
+    tenant_filters = list(tenant_filters)
+    end_time = None if deadline is None else time.time() + deadline
+
+    tasks = Queue.Queue()
+    for tenant, _filter in tenant_filters:
+        tasks.put((tenant, _filter))
+    results = Queue.Queue()
+    stopped = threading.Event()
+
+    def work():
+        while not stopped.is_set():
+            try:
+                tenant, _filter = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                filter_db = FilterMongoDB(base_db, _filter=_filter,
+                                          **db_kwargs)
+                results.put(TenantResult(tenant, query(filter_db), None))
+            except Exception as e:
+                results.put(TenantResult(tenant, None, e))
+
+    for _ in range(min(max_workers, len(tenant_filters))):
+        worker = threading.Thread(target=work, name='mongodec-fan-out')
+        worker.daemon = True
+        worker.start()
+
+    pending = [tenant for tenant, _ in tenant_filters]
+    try:
+        while pending:
+            if end_time is None:
+                # Queue.get without a timeout can't be interrupted
+                timeout = 3600
+            else:
+                timeout = end_time - time.time()
+                if timeout <= 0:
+                    break
+            try:
+                tenant_result = results.get(timeout=timeout)
+            except Queue.Empty:
+                continue
+            pending.remove(tenant_result.tenant)
+            yield tenant_result
+
+        for tenant in pending:
+            yield TenantResult(tenant, None, DeadlineExceeded(
+                'No result within the %ss deadline' % deadline))
+    finally:
+        stopped.set()
+
+
+'''
+##############################################################################
+#                                                                            #
+#                               BATCHED READS                                #
+#                                                                            #
+##############################################################################
+'''
+
+def batched_find(collection, tenant_filters, query=None, projection=None,
+                 tenant_field=None, max_in=1000, filter_mode='merge',
+                 **find_kwargs):
+    """ find for many tenants in a few queries: tenant filters that only
+        differ in the value of tenant_field are merged into one
+        {tenant_field: {'$in': [...]}} filter, and the documents that come
+        back are handed out to their tenants in a single pass over the
+        cursor. Tenants whose filter isn't just equalities on top-level
+        fields get a query of their own.
+
+        query is combined with each merged filter as FilterMongoCollection
+        combines queries with its _filter (see mongodec.FilterPlan.apply).
+        sort and the other find kwargs apply to each query as a whole, so
+        documents keep their sort order within a tenant; limit and skip
+        would cut across tenants and aren't allowed.
+    ARGS:
+        collection - a pymongo Collection (or FilterMongoCollection, whose
+                     own filter then applies as well)
+        tenant_filters - dict of tenant key to that tenant's filter, or a
+                         list of (tenant key, filter) pairs
+        query, projection - as for find
+        tenant_field - the field that tells tenants apart. If None, it's
+                       the one field whose value differs between filters
+        max_in - most values in one $in; more tenants make more queries
+        filter_mode - 'merge' or 'and', see FilterMongoCollection
+    RETURNS:
+        an OrderedDict of tenant key to its list of documents, in
+        tenant_filters' order
+    RAISES:
+        ValueError for limit or skip, or if tenant_field can't be told
+    """
+    for kwarg in ('limit', 'skip'):
+        if find_kwargs.get(kwarg):
+            raise ValueError('batched_find does not support %s' % kwarg)
+    if isinstance(tenant_filters, dict):
+        tenant_filters = tenant_filters.items()
+    tenant_filters = list(tenant_filters)
+    if tenant_field is None:
+        tenant_field = find_tenant_field(tenant_filters)
+
+    results = OrderedDict((tenant, []) for tenant, _ in tenant_filters)
+    projection, strip = with_field(projection, tenant_field)
+    for _filter, routes in group_tenants(tenant_filters, tenant_field,
+                                         max_in):
+        plan = compile_filter(_filter, filter_mode)
+        cursor = collection.find(plan.apply(query), projection, **find_kwargs)
+        for document in cursor:
+            if len(routes) == 1 and None in routes:
+                tenants = routes[None]
+            else:
+                value = document.get(tenant_field)
+                try:
+                    tenants = routes.get(freeze(value), ())
+                except TypeError:
+                    tenants = ()
+            if strip:
+                document.pop(tenant_field, None)
+            for i, tenant in enumerate(tenants):
+                results[tenant].append(document if i == 0 else
+                                       dict(document))
+    return results
+
+
+def find_tenant_field(tenant_filters):
+    """ The one field whose value differs between the filters """
+    fields = set()
+    values = {}
+    for _, _filter in tenant_filters:
+        for k, v in (_filter or {}).items():
+            values.setdefault(k, set()).add(repr(freeze(v)))
+    for k, seen in values.items():
+        if len(seen) > 1:
+            fields.add(k)
+    if not fields and len(values) == 1:
+        fields.update(values)
+    if len(fields) != 1:
+        raise ValueError('Pass tenant_field: filters differ in %s' %
+                         (sorted(fields) or 'nothing',))
+    return fields.pop()
+
+
+def group_tenants(tenant_filters, tenant_field, max_in):
+    """ Splits tenants into queries
+    RETURNS:
+        list of (filter, routes) pairs, routes mapping the frozen value of
+        tenant_field in a returned document to the tenants it belongs to
+        (or None to every document's tenants, for unmerged filters)
+    """
+    groups = OrderedDict()
+    singles = []
+    for tenant, _filter in tenant_filters:
+        _filter = _filter or {}
+        plan = compile_filter(_filter)
+        if (tenant_field not in _filter or
+            len(plan.stamp_items) != len(_filter)):
+            singles.append((_filter, {None: [tenant]}))
+            continue
+        value = dict(plan.stamp_items)[tenant_field]
+        rest = dict((k, v) for k, v in _filter.items() if k != tenant_field)
+        group = groups.setdefault(freeze(rest), (rest, OrderedDict()))
+        group[1].setdefault(freeze(value), (value, []))[1].append(tenant)
+
+    queries = []
+    for rest, values in groups.values():
+        values = values.values()
+        for start in range(0, len(values), max_in):
+            chunk = values[start:start + max_in]
+            _filter = dict(rest)
+            if len(chunk) == 1:
+                _filter[tenant_field] = chunk[0][0]
+            else:
+                _filter[tenant_field] = {'$in': [value for value, _ in chunk]}
+            queries.append((_filter, dict((freeze(value), tenants)
+                                          for value, tenants in chunk)))
+    return queries + singles
+
+
+def with_field(projection, field):
+    """ Returns (projection that includes field, whether field has to be
+        stripped from documents afterwards)
+    """
+    if projection is None:
+        return projection, False
+    if not isinstance(projection, dict):
+        projection = dict((name, 1) for name in projection)
+    included = [k for k, v in projection.items()
+                if k != '_id' and v and not isinstance(v, dict)]
+    if included:
+        if field in projection:
+            return projection, False
+        projection = dict(projection)
+        projection[field] = 1
+        return projection, True
+    if field in projection and not projection[field]:
+        projection = dict(projection)
+        del projection[field]
+        return projection, True
+    return projection, False
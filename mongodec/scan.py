@@ -0,0 +1,469 @@
+""" Reading a whole (filtered) collection in parallel key ranges """
+
+from collections import namedtuple, Counter
+import datetime
+import json
+import multiprocessing
+import os
+import Queue
+import threading
+
+from bson import json_util
+from bson.binary import Binary
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+from bson.timestamp import Timestamp
+
+from multi_tenant import with_field
+
+
+'''
+##############################################################################
+#                                                                            #
+#                                 PARTITIONS                                 #
+#                                                                            #
+##############################################################################
+'''
+
+class Partition(namedtuple('Partition', ['index', 'lower', 'upper',
+                                         'outside'])):
+    """ A range of the scan key: lower <= key < upper, None for no bound.
+        Range operators only match values of their bound's type (numbers
+        with numbers, strings with strings, ...), so once there are
+        boundaries one more partition, with outside set to the $type
+        aliases of the boundaries' type, holds every document whose key is
+        missing, null or of another type
+    """
+    def __new__(cls, index, lower, upper, outside=None):
+        return super(Partition, cls).__new__(cls, index, lower, upper,
+                                             outside)
+
+
+# How a partition's scan went: documents handled (this run) and the
+# exception that stopped it, if any
+PartitionResult = namedtuple('PartitionResult', ['partition', 'count',
+                                                 'error'])
+
+
+def type_bracket(value):
+    """ The $type aliases of the values a range operator on value matches,
+        or None for values that can't be partition boundaries
+    """
+    if value is None:
+        return None
+    elif isinstance(value, bool):
+        return ('bool',)
+    elif isinstance(value, (int, long, float, Decimal128)):
+        return ('number',)
+    elif isinstance(value, Binary):
+        return ('binData',)
+    elif isinstance(value, basestring):
+        return ('string', 'symbol')
+    elif isinstance(value, ObjectId):
+        return ('objectId',)
+    elif isinstance(value, datetime.datetime):
+        return ('date',)
+    elif isinstance(value, Timestamp):
+        return ('timestamp',)
+    return None
+
+
+def sample_boundaries(collection, partitions, key='_id', query=None,
+                      sample_size=None):
+    """ Picks partitions - 1 values of key that split the documents matching
+        query into roughly equal ranges, from a $sample of them. Through a
+        FilterMongoCollection the sample only sees the filtered documents.
+        Boundaries are all of one type, the most common one in the sample;
+        documents with keys of other types are scanned by the partition of
+        documents outside the ranges (see Partition).
+    ARGS:
+        collection - FilterMongoCollection or pymongo Collection
+        partitions - number of ranges wanted
+        key - field to split on; it should be indexed
+        query - only sample documents matching this
+        sample_size - documents to sample, by default 100 per partition
+    RETURNS:
+        sorted list of distinct boundary values (fewer than partitions - 1
+        if the sample is too small to tell more apart)
+    """
+    if partitions <= 1:
+        return []
+    sample_size = sample_size or 100 * partitions
+    pipeline = [{'$sample': {'size': sample_size}},
+                {'$sort': {key: 1}},
+                {'$project': {'_id': 0, 'key': '$' + key}}]
+    if query:
+        pipeline.insert(0, {'$match': query})
+    keys = [doc['key'] for doc in collection.aggregate(pipeline)
+            if type_bracket(doc.get('key')) is not None]
+    if keys:
+        brackets = Counter(type_bracket(k) for k in keys)
+        bracket = brackets.most_common(1)[0][0]
+        keys = [k for k in keys if type_bracket(k) == bracket]
+
+    boundaries = []
+    for i in range(1, partitions):
+        if not keys:
+            break
+        value = keys[i * len(keys) // partitions]
+        if not boundaries or boundaries[-1] != value:
+            boundaries.append(value)
+    return boundaries
+
+
+def partition_ranges(boundaries):
+    """ The Partitions that sorted boundaries split the key space into:
+        one per range, then (if there are boundaries) the one for keys
+        outside them
+    RAISES:
+        ValueError if the boundaries aren't all of one type
+    """
+    if not boundaries:
+        return [Partition(0, None, None)]
+    brackets = set(type_bracket(value) for value in boundaries)
+    if len(brackets) != 1 or None in brackets:
+        raise ValueError('Partition boundaries must all be of one type, '
+                         'got %r' % (boundaries,))
+    edges = [None] + list(boundaries) + [None]
+    ranges = [Partition(i, edges[i], edges[i + 1])
+              for i in range(len(edges) - 1)]
+    ranges.append(Partition(len(ranges), None, None, list(brackets.pop())))
+    return ranges
+
+
+def partition_query(partition, key, query=None, after=None):
+    """ query restricted to partition's range of key, and when resuming, to
+        documents sorted after the last one handled
+    ARGS:
+        after - None, or the (key, _id) of the last document handled (_id
+                None to resume at that key, handling it again)
+    """
+    clauses = []
+    bounds = {}
+    if partition.outside is not None:
+        clauses.append({key: {'$not': {'$type': partition.outside}}})
+        if after is not None:
+            clauses.append(after_clause(key, after, compare_expr))
+    else:
+        if after is not None:
+            clauses.append(after_clause(key, after, compare_query))
+        elif partition.lower is not None:
+            bounds['$gte'] = partition.lower
+        if partition.upper is not None:
+            bounds['$lt'] = partition.upper
+    if bounds:
+        clauses.insert(0, {key: bounds})
+
+    if not clauses:
+        return query
+    if query:
+        clauses.insert(0, query)
+    new_query = {}
+    for clause in clauses:
+        if any(k in new_query for k in clause):
+            new_query.setdefault('$and', []).append(clause)
+        else:
+            new_query.update(clause)
+    return new_query
+
+
+def after_clause(key, after, compare):
+    """ Matches documents sorted after after = (key value, _id), i.e. with a
+        greater key, or the same key and a greater _id
+    """
+    value, _id = after
+    if _id is None:
+        return compare(key, '$gte', value)
+    if key == '_id':
+        return compare(key, '$gt', value)
+    return {'$or': [compare(key, '$gt', value),
+                    {'$and': [compare(key, '$eq', value),
+                              compare('_id', '$gt', _id)]}]}
+
+
+def compare_query(field, op, value):
+    """ field <op> value, as a query operator """
+    return {field: value} if op == '$eq' else {field: {op: value}}
+
+
+def compare_expr(field, op, value):
+    """ field <op> value as an aggregation expression, which compares values
+        of any type in BSON order -- as sort does, missing fields as null --
+        where query operators only compare values of one type
+    """
+    return {'$expr': {op: [{'$ifNull': ['$' + field, None]}, value]}}
+
+
+def scan_projection(projection, key):
+    """ Returns (projection that includes key and _id, the fields to strip
+        from documents afterwards)
+    """
+    strip = []
+    if key != '_id':
+        projection, strip_key = with_field(projection, key)
+        if strip_key:
+            strip.append(key)
+    if projection is None:
+        return projection, strip
+    if not isinstance(projection, dict):
+        projection = dict((name, 1) for name in projection)
+    if '_id' in projection and not projection['_id']:
+        projection = dict(projection)
+        del projection['_id']
+        strip.append('_id')
+    return projection, strip
+
+
+'''
+##############################################################################
+#                                                                            #
+#                                CHECKPOINTS                                 #
+#                                                                            #
+##############################################################################
+'''
+
+class ScanCheckpoint(object):
+    """ Where a partitioned_scan got to: its boundaries, and per partition
+        the key and _id of the last document handled and whether it's done.
+        Kept in memory; see FileCheckpoint to survive restarts
+    """
+    def __init__(self, state=None):
+        self.state = state or {'boundaries': None, 'partitions': {}}
+        self.lock = threading.Lock()
+
+    def boundaries(self):
+        return self.state['boundaries']
+
+    def set_boundaries(self, boundaries):
+        with self.lock:
+            self.state['boundaries'] = list(boundaries)
+            self.state['partitions'] = {}
+        self.save()
+
+    def progress(self, index):
+        """ Returns ((key, _id) of the last document handled, or None if
+            there's none, whether partition is done). Checkpoints written
+            before _ids were recorded give (key, None)
+        """
+        entry = self.state['partitions'].get(str(index), {})
+        if 'last_id' in entry:
+            after = (entry['last'], entry['last_id'])
+        elif entry.get('last') is not None:
+            after = (entry['last'], None)
+        else:
+            after = None
+        return after, entry.get('done', False)
+
+    def record(self, index, after, done=False):
+        """ Records the (key, _id) of the last document handled (None if
+            there's none yet) and whether partition is done
+        """
+        entry = {'done': done}
+        if after is not None:
+            entry['last'], entry['last_id'] = after
+        with self.lock:
+            self.state['partitions'][str(index)] = entry
+        self.save()
+
+    def save(self):
+        """ Persists the state; nothing to do in memory """
+
+
+class FileCheckpoint(ScanCheckpoint):
+    """ ScanCheckpoint kept in a JSON file (extended JSON, so ObjectIds and
+        dates round trip), rewritten atomically on every update. Pass the
+        same path to resume a scan
+    """
+    def __init__(self, path):
+        self.path = path
+        state = None
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json_util.loads(f.read())
+        super(FileCheckpoint, self).__init__(state)
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.state, default=json_util.default)
+            tmp_path = '%s.tmp' % self.path
+            with open(tmp_path, 'w') as f:
+                f.write(data)
+            os.rename(tmp_path, self.path)
+
+
+'''
+##############################################################################
+#                                                                            #
+#                                    SCAN                                    #
+#                                                                            #
+##############################################################################
+'''
+
+def partitioned_scan(collection, handler, partitions=8, query=None,
+                     projection=None, key='_id', boundaries=None,
+                     max_workers=None, checkpoint=None, checkpoint_every=1000,
+                     **find_kwargs):
+    """ Reads every document matching query in key ranges, on threads, and
+        calls handler(partition, document) for each. Each range is its own
+        find (sorted on key, then _id) through collection, so a
+        FilterMongoCollection applies its filter to every one of them.
+        Documents whose key is missing, null or of another type than the
+        boundaries are read by one more partition (see Partition), so every
+        document is handled whatever its key.
+
+        With a checkpoint, the boundaries and the key and _id of each
+        partition's last handled document are recorded (every
+        checkpoint_every documents and when a partition ends), and a later
+        call with the same checkpoint skips finished partitions and picks
+        the others up after their last document, even among documents
+        sharing its key. handler should then be idempotent for the few
+        documents handled after the last record.
+    ARGS:
+        collection - FilterMongoCollection or pymongo Collection
+        handler - function(partition, document), called on worker threads
+        partitions - number of ranges, when boundaries aren't given
+        query, projection - as for find
+        key - top-level, non-array field to split on and sort by; it
+              should be indexed, together with _id unless it's _id
+        boundaries - sorted split values, all of one type, to use instead
+                     of sampling
+        max_workers - threads, by default one per partition
+        checkpoint - a ScanCheckpoint (or FileCheckpoint)
+        find_kwargs - passed on to each find (e.g. batch_size)
+    RETURNS:
+        list of PartitionResults, by partition. A failed partition doesn't
+        stop the others
+    """
+    if checkpoint is not None and checkpoint.boundaries() is not None:
+        boundaries = checkpoint.boundaries()
+    elif boundaries is None:
+        boundaries = sample_boundaries(collection, partitions, key, query)
+    if checkpoint is not None and checkpoint.boundaries() is None:
+        checkpoint.set_boundaries(boundaries)
+
+    ranges = partition_ranges(boundaries)
+    results = [None] * len(ranges)
+    tasks = Queue.Queue()
+    for partition in ranges:
+        tasks.put(partition)
+
+    def work():
+        while True:
+            try:
+                partition = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            results[partition.index] = scan_partition(
+                collection, handler, partition, query, projection, key,
+                checkpoint, checkpoint_every, find_kwargs)
+
+    workers = [threading.Thread(target=work, name='mongodec-scan')
+               for _ in range(min(max_workers or len(ranges), len(ranges)))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return results
+
+
+def scan_partition(collection, handler, partition, query, projection, key,
+                   checkpoint, checkpoint_every, find_kwargs):
+    """ Scans one partition, see partitioned_scan """
+    after = None
+    if checkpoint is not None:
+        after, done = checkpoint.progress(partition.index)
+        if done:
+            return PartitionResult(partition, 0, None)
+
+    projection, strip = scan_projection(projection, key)
+    sort = [(key, 1)] if key == '_id' else [(key, 1), ('_id', 1)]
+    count = 0
+    last = after
+    try:
+        cursor = collection.find(partition_query(partition, key, query,
+                                                 after),
+                                 projection, sort=sort, **find_kwargs)
+        for document in cursor:
+            # Only handled documents count as done, so a resume retries a
+            # document whose handler raised
+            position = (document.get(key), document.get('_id'))
+            for field in strip:
+                document.pop(field, None)
+            handler(partition, document)
+            last = position
+            count += 1
+            if checkpoint is not None and count % checkpoint_every == 0:
+                checkpoint.record(partition.index, last)
+    except Exception as e:
+        if checkpoint is not None and last is not None:
+            checkpoint.record(partition.index, last)
+        return PartitionResult(partition, count, e)
+    if checkpoint is not None:
+        checkpoint.record(partition.index, last, done=True)
+    return PartitionResult(partition, count, None)
+
+
+'''
+##############################################################################
+#                                                                            #
+#                                PROCESS POOLS                               #
+#                                                                            #
+##############################################################################
+'''
+
+def process_map(spec, func, partitions=None, query=None, projection=None,
+                key='_id', boundaries=None, processes=None, **find_kwargs):
+    """ Runs func(document) over every document matching query on a
+        multiprocessing Pool, for CPU-heavy transforms: the documents are
+        split into key ranges as for partitioned_scan, and each worker
+        process builds its own FilterMongoCollection (and client) from spec
+        and reads whole ranges. Yields what func returns, except None, a
+        range at a time in the order ranges finish.
+    ARGS:
+        spec - a FilterMongoCollectionSpec
+        func - picklable (i.e. module-level) function of a document
+        partitions - number of ranges, by default 4 per process. Each
+                     range's results are held in memory until sent back
+        query, projection, key, boundaries, find_kwargs - see
+                                                         partitioned_scan
+        processes - worker processes, by default one per CPU
+    RETURNS:
+        an iterator of func's results
+    RAISES:
+        whatever func or a range's find raised, after which the pool is
+        terminated
+    """
+    processes = processes or multiprocessing.cpu_count()
+    partitions = partitions or 4 * processes
+    if boundaries is None:
+        boundaries = sample_boundaries(spec.collection(), partitions, key,
+                                       query)
+    tasks = [(spec, func, partition, query, projection, key, find_kwargs)
+             for partition in partition_ranges(boundaries)]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for results in pool.imap_unordered(map_partition, tasks):
+            for result in results:
+                yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def map_partition(task):
+    """ Worker side of process_map: func's results for one range """
+    spec, func, partition, query, projection, key, find_kwargs = task
+    results = []
+
+    def handler(partition, document):
+        result = func(document)
+        if result is not None:
+            results.append(result)
+
+    scanned = scan_partition(spec.collection(), handler, partition, query,
+                             projection, key, None, 1, find_kwargs)
+    if scanned.error is not None:
+        raise scanned.error
+    return results
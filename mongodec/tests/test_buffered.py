@@ -0,0 +1,140 @@
+""" Tests for buffered.py """
+
+import unittest
+from bson.objectid import ObjectId
+from mongodec.buffered import BufferedWriter, WriteNotExecuted, \
+                              OPEN_WRITERS, close_writers
+from mongodec.filter_mongo import FilterMongoCollection
+from pymongo.errors import BulkWriteError, WriteError, AutoReconnect
+from pymongo.operations import InsertOne, UpdateOne
+from pymongo.results import BulkWriteResult
+
+
+class FakeCollection(object):
+    """ Records bulk_write batches; fails the requests listed in fail_at """
+    full_name = 'db.fake'
+
+    def __init__(self, fail_at=(), error=None):
+        self.batches = []
+        self.fail_at = fail_at
+        self.error = error
+
+    def bulk_write(self, requests, ordered=True):
+        self.batches.append((list(requests), ordered))
+        if self.error is not None:
+            raise self.error
+        details = {'nInserted': 0, 'nUpserted': 0, 'nMatched': 0,
+                   'nModified': 0, 'nRemoved': 0, 'upserted': [],
+                   'writeErrors': [], 'writeConcernErrors': []}
+        for index, request in enumerate(requests):
+            if index in self.fail_at:
+                details['writeErrors'].append({'index': index, 'code': 11000,
+                                               'errmsg': 'duplicate key',
+                                               'op': request._doc})
+                if ordered:
+                    break
+            elif isinstance(request, InsertOne):
+                request._doc.setdefault('_id', ObjectId())
+                details['nInserted'] += 1
+            elif request._upsert:
+                details['upserted'].append({'index': index, '_id': index})
+                details['nUpserted'] += 1
+        if details['writeErrors']:
+            raise BulkWriteError(details)
+        return BulkWriteResult(details, True)
+
+
+class TestBufferedWriter(unittest.TestCase):
+
+    def test_batches(self):
+        """ Writes go out by size, on flush and on close, in order """
+        collection = FakeCollection()
+        with BufferedWriter(collection, batch_size=2,
+                            flush_interval=None) as writer:
+            first = writer.insert_one({'x': 1})
+            self.assertFalse(first.done())
+            second = writer.update_one({'x': 2}, {'$set': {'y': 1}},
+                                       upsert=True)
+            self.assertEqual(len(collection.batches), 1)
+            third = writer.insert_one({'x': 3})
+            writer.flush()
+            fourth = writer.insert_one({'x': 4})
+        self.assertEqual([len(batch) for batch, _ in collection.batches],
+                         [2, 1, 1])
+        inserted_id = first.result().inserted_id
+        self.assertEqual(collection.batches[0][0],
+                         [InsertOne({'x': 1, '_id': inserted_id}),
+                          UpdateOne({'x': 2}, {'$set': {'y': 1}},
+                                    upsert=True)])
+        self.assertEqual(second.result().upserted_id, 1)
+        self.assertIsNone(second.result().inserted_id)
+        self.assertTrue(third.done() and fourth.done())
+        self.assertRaises(RuntimeError, writer.insert_one, {'x': 5})
+
+
+    def test_flush_interval(self):
+        collection = FakeCollection()
+        writer = BufferedWriter(collection, batch_size=100,
+                                flush_interval=0.01)
+        future = writer.insert_one({'x': 1})
+        self.assertIsNotNone(future.result(timeout=5).inserted_id)
+        writer.close()
+        self.assertEqual(len(collection.batches), 1)
+
+
+    def test_close_writers(self):
+        """ Writers left open are flushed at exit """
+        collection = FakeCollection()
+        writer = BufferedWriter(collection, flush_interval=60)
+        future = writer.insert_one({'x': 1})
+        self.assertIn(writer, OPEN_WRITERS)
+
+        close_writers()
+        self.assertTrue(future.done())
+        self.assertEqual(len(collection.batches), 1)
+        self.assertNotIn(writer, OPEN_WRITERS)
+
+
+    def test_errors(self):
+        """ Errors are set on the futures of the writes they belong to """
+        collection = FakeCollection(fail_at=(1,))
+        with BufferedWriter(collection, flush_interval=None) as writer:
+            futures = [writer.insert_one({'x': i}) for i in range(3)]
+        self.assertIsNotNone(futures[0].result().inserted_id)
+        self.assertIsInstance(futures[1].exception(), WriteError)
+        self.assertEqual(futures[1].exception().code, 11000)
+        self.assertRaises(WriteNotExecuted, futures[2].result)
+
+        # Unordered batches run past a failed write
+        collection = FakeCollection(fail_at=(1,))
+        with BufferedWriter(collection, flush_interval=None,
+                            ordered=False) as writer:
+            futures = [writer.insert_one({'x': i}) for i in range(3)]
+        self.assertFalse(collection.batches[0][1])
+        self.assertEqual([future.exception() is None for future in futures],
+                         [True, False, True])
+
+        # Errors of the whole batch go to every write
+        collection = FakeCollection(error=AutoReconnect('down'))
+        with BufferedWriter(collection, flush_interval=None) as writer:
+            futures = [writer.insert_one({'x': i}) for i in range(2)]
+        for future in futures:
+            self.assertRaises(AutoReconnect, future.result)
+
+
+    def test_filtered(self):
+        """ Writes through a FilterMongoCollection get its filter """
+        collection = FakeCollection()
+        filter_coll = FilterMongoCollection(collection, _filter={'t': 'a'},
+                                            timeout_wrap=False, stamp=True)
+        with filter_coll.buffered_writer(flush_interval=None) as writer:
+            writer.insert_one({'x': 1})
+            writer.update_one({'x': 1}, {'$set': {'y': 2}})
+        self.assertEqual(collection.batches[0][0][1],
+                         UpdateOne({'x': 1, 't': 'a'}, {'$set': {'y': 2}}))
+        self.assertEqual(collection.batches[0][0][0]._doc['t'], 'a')
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,259 @@
+""" Tests for cache.py """
+
+import threading
+import time
+import unittest
+from mongodec.cache import ResultCache, SingleFlight, cache_key
+from mongodec.filter_mongo import FilterMongoCollection
+from bson.son import SON
+from bson.codec_options import CodecOptions
+from pymongo import MongoClient, ReadPreference
+from pymongo.command_cursor import CommandCursor
+
+
+class FakeCollection(object):
+    """ Counts the reads that reach it """
+    full_name = 'db.fake'
+
+    def __init__(self):
+        self.reads = 0
+        self.docs = [{'t': 'a', 'x': 1}, {'t': 'a', 'x': 2}]
+
+    def find_one(self, filter=None, *args, **kwargs):
+        self.reads += 1
+        return dict(self.docs[0])
+
+    def count(self, filter=None, session=None, **kwargs):
+        self.reads += 1
+        return len(self.docs)
+
+    def distinct(self, key, filter=None, session=None, **kwargs):
+        self.reads += 1
+        return [doc[key] for doc in self.docs]
+
+    def update_one(self, filter, update, upsert=False):
+        self.docs[0]['x'] = 10
+
+    def insert_one(self, document):
+        self.docs.append(document)
+
+
+class TestResultCache(unittest.TestCase):
+
+    def test_cache(self):
+        """ Reads are served from the cache until a write """
+        cache = ResultCache()
+        fake = FakeCollection()
+        coll = FilterMongoCollection(fake, _filter={'t': 'a'},
+                                     timeout_wrap=False, result_cache=cache)
+
+        self.assertEqual(coll.count({'x': 1}), 2)
+        self.assertEqual(coll.count({'x': 1}), 2)
+        self.assertEqual(coll.count({'x': 2}), 2)
+        self.assertEqual(fake.reads, 2)
+
+        doc = coll.find_one({'x': 1})
+        doc['x'] = 'mutated'
+        self.assertEqual(coll.find_one({'x': 1}), {'t': 'a', 'x': 1})
+        self.assertEqual(coll.distinct('x'), [1, 2])
+        self.assertEqual(coll.distinct('x'), [1, 2])
+        self.assertEqual(fake.reads, 4)
+
+        # Any write drops the collection's entries
+        coll.update_one({'x': 1}, {'$set': {'x': 10}})
+        self.assertEqual(coll.distinct('x'), [10, 2])
+        coll.insert_one({'t': 'a', 'x': 3})
+        self.assertEqual(coll.count({'x': 1}), 3)
+        self.assertEqual(fake.reads, 6)
+
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (3, 6))
+        self.assertEqual(stats['invalidations'], 2)
+        self.assertEqual(stats['entries'], 1)
+        self.assertAlmostEqual(stats['hit_ratio'], 1 / 3.0)
+
+        # Without a cache, writes that need no rewriting aren't wrapped
+        plain = FilterMongoCollection(fake, timeout_wrap=False)
+        methods = plain.cdict['%s_methods' % plain.class_prefix]
+        self.assertNotIn('insert_one', methods)
+        self.assertIn('update_one', methods)
+
+
+    def test_options(self):
+        """ Collections with other codec options or read preferences don't
+            share entries
+        """
+        cache = ResultCache()
+        fake = FakeCollection()
+        tz_aware = FakeCollection()
+        tz_aware.codec_options = CodecOptions(tz_aware=True)
+        secondary = FakeCollection()
+        secondary.read_preference = ReadPreference.SECONDARY
+        for base in [fake, fake, tz_aware, secondary]:
+            coll = FilterMongoCollection(base, timeout_wrap=False,
+                                         result_cache=cache)
+            coll.count({'x': 1})
+        self.assertEqual([base.reads for base in [fake, tz_aware, secondary]],
+                         [1, 1, 1])
+
+
+    def test_limits(self):
+        cache = ResultCache(ttl=0.01, max_entries=2)
+        for i in range(3):
+            cache.put(('db.c', 'count', i), i, cache.generation('db.c'))
+        self.assertEqual(cache.stats()['entries'], 2)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.get(('db.c', 'count', 2)), (True, 2))
+        time.sleep(0.02)
+        self.assertEqual(cache.get(('db.c', 'count', 2)), (False, None))
+
+        cache = ResultCache(max_bytes=100)
+        cache.put(('db.c', 'find_one', 1), {'x': 'y' * 100},
+                  cache.generation('db.c'))
+        self.assertEqual(cache.stats()['entries'], 0)
+
+        # Results read before a write aren't stored after it
+        generation = cache.generation('db.c')
+        cache.invalidate('db.c')
+        cache.put(('db.c', 'count', 1), 1, generation)
+        self.assertEqual(cache.stats()['entries'], 0)
+
+
+    def test_cache_key(self):
+        self.assertEqual(cache_key('c', 'count', {'filter': {'a': 1, 'b': 2}}),
+                         cache_key('c', 'count', {'filter': {'b': 2, 'a': 1}}))
+        self.assertNotEqual(
+            cache_key('c', 'find_one', {'sort': SON([('a', 1), ('b', 1)])}),
+            cache_key('c', 'find_one', {'sort': SON([('b', 1), ('a', 1)])}))
+        self.assertIsNone(cache_key('c', 'count', {'filter': {'a': set()}}))
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_shared(self):
+        """ Concurrent identical calls make one query and share its result """
+        started, release = threading.Event(), threading.Event()
+        calls = []
+        collection = MongoClient(connect=False)['db']['c']
+
+        def aggregate(pipeline):
+            calls.append(pipeline)
+            started.set()
+            release.wait(5)
+            if pipeline == 'fail':
+                raise ValueError('failed')
+            return CommandCursor(collection, {'id': 0, 'ns': 'db.c',
+                                              'firstBatch': [{'x': 1},
+                                                             {'x': 2}]},
+                                 ('localhost', 27017))
+        aggregate.__name__ = 'aggregate'
+
+        single_flight = SingleFlight(methods=['aggregate'])
+        cdict = {'collection_name': 'db.c'}
+        for round, (pipeline, expected) in enumerate(
+                [('ok', [{'x': 1}, {'x': 2}]), ('fail', 'failed')]):
+            del calls[:]
+            started.clear()
+            release.clear()
+            results = []
+
+            def call():
+                try:
+                    cursor = single_flight(aggregate, cdict, 'aggregate',
+                                           {'pipeline': pipeline})
+                    self.assertIsInstance(cursor, CommandCursor)
+                    results.append(list(cursor))
+                except ValueError as error:
+                    results.append(str(error))
+
+            threads = [threading.Thread(target=call) for _ in range(5)]
+            threads[0].start()
+            started.wait(5)
+            for thread in threads[1:]:
+                thread.start()
+            # Wait for this round's 4 followers to join the flight
+            while single_flight.stats()['shared'] < 4 * (round + 1):
+                time.sleep(0.001)
+            release.set()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(results, [expected] * 5)
+            if pipeline == 'ok':
+                # Followers get their own copies
+                self.assertEqual(len(set(id(doc) for result in results
+                                         for doc in result)), 10)
+
+        self.assertEqual(single_flight.stats(), {'calls': 2, 'shared': 8})
+
+
+    def test_aggregate(self):
+        """ aggregate is shared on request, and never when it writes """
+        calls = []
+
+        def aggregate(pipeline):
+            calls.append(pipeline)
+            return 'cursor'
+        cdict = {'collection_name': 'db.c'}
+
+        self.assertEqual(SingleFlight().methods,
+                         frozenset(['find_one', 'count', 'distinct']))
+        single_flight = SingleFlight(methods=['aggregate'])
+        # Nobody joined, so the caller gets the cursor itself
+        self.assertEqual(single_flight(aggregate, cdict, 'aggregate',
+                                       {'pipeline': []}), 'cursor')
+        for stage in [{'$out': 'other'}, {'$merge': {'into': 'other'}}]:
+            single_flight(aggregate, cdict, 'aggregate',
+                          {'pipeline': [{'$match': {}}, stage]})
+        self.assertEqual(single_flight.stats(), {'calls': 1, 'shared': 0})
+        self.assertEqual(len(calls), 3)
+
+
+    def test_leader_interrupted(self):
+        """ A leader stopped by a BaseException still releases followers """
+        started, release = threading.Event(), threading.Event()
+
+        def count(filter):
+            started.set()
+            release.wait(5)
+            raise KeyboardInterrupt()
+
+        single_flight = SingleFlight()
+        cdict = {'collection_name': 'db.c'}
+        errors = []
+
+        def call():
+            try:
+                single_flight(count, cdict, 'count', {'filter': {}})
+            except KeyboardInterrupt as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=call) for _ in range(2)]
+        threads[0].start()
+        started.wait(5)
+        threads[1].start()
+        while single_flight.stats()['shared'] < 1:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(single_flight.flights, {})
+
+
+    def test_filtered(self):
+        """ Calls are keyed by the query with the filter injected """
+        fake = FakeCollection()
+        single_flight = SingleFlight()
+        coll = FilterMongoCollection(fake, _filter={'t': 'a'},
+                                     timeout_wrap=False,
+                                     single_flight=single_flight)
+        self.assertEqual(coll.count({'x': 1}), 2)
+        self.assertEqual(coll.count({'x': 1}), 2)
+        self.assertEqual(fake.reads, 2)
+        self.assertEqual(single_flight.stats(), {'calls': 2, 'shared': 0})
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,7 @@
 import unittest
 #import Changeling
-from mongodec.changeling import Changeling, replace_arg, convert_arg_soup
+from mongodec.changeling import Changeling, replace_arg, convert_arg_soup, \
+                                get_binder
 
 
 class TestChangeling(unittest.TestCase):
@@ -38,6 +39,37 @@ class TestChangeling(unittest.TestCase):
         self.assertEqual(c_wrap_all.f(12, no_changeling=True), 32)
 
 
+    def test_dispatch_cache(self):
+        """ Tests wrapped methods are built once and rebuilt on cdict change
+        """
+        class Foo(object):
+            def f(self, arg):
+                return arg
+
+        def plus_one(func, cdict, callargs):
+            return func(arg=callargs['arg'] + 1)
+
+        def plus_ten(func, cdict, callargs):
+            return func(arg=callargs['arg'] + 10)
+
+        c_foo = Changeling(Foo(), cdict={'Foo_methods': {'f': plus_one}})
+        self.assertEqual(c_foo.f(1), 2)
+        self.assertIs(c_foo.f, c_foo.f)
+
+        # In-place cdict mutation needs an explicit invalidation
+        c_foo.cdict['Foo_methods']['f'] = plus_ten
+        self.assertEqual(c_foo.f(1), 2)
+        c_foo.invalidate_dispatch()
+        self.assertEqual(c_foo.f(1), 11)
+
+        # Reassigning the cdict or no_wrap_all invalidates on its own
+        c_foo.cdict = {'Foo_methods': {'f': plus_one},
+                       'Foo_wrap_all': plus_ten}
+        self.assertEqual(c_foo.f(1), 12)
+        c_foo.no_wrap_all = True
+        self.assertEqual(c_foo.f(1), 2)
+
+
     def test_convert_arg_soup(self):
         """ Tests we can convert args/kwargs to just kwargs """
 
@@ -55,6 +87,24 @@ class TestChangeling(unittest.TestCase):
         self.assertEqual(callargs_3, {'arg1': 1, 'arg2': 2,
                                       'kwarg1': 3, 'kwarg2': 4})
 
+        # Bound methods drop self, and **kwargs get flattened
+        class Foo(object):
+            def f(self, arg1, arg2=None, **kwargs):
+                pass
+
+        foo = Foo()
+        self.assertEqual(convert_arg_soup(foo.f, 1, extra=2),
+                         {'arg1': 1, 'arg2': None, 'extra': 2})
+        self.assertIs(get_binder(foo.f), get_binder(Foo().f))
+
+        # Bad calls raise just like calling the function would
+        with self.assertRaises(TypeError):
+            convert_arg_soup(test_func, 1)
+        with self.assertRaises(TypeError):
+            convert_arg_soup(test_func, 1, 2, arg1=3)
+        with self.assertRaises(TypeError):
+            convert_arg_soup(foo.f, 1, 2, 3)
+
 
     def test_replace_arg(self):
         """ Tests we can replace args by name """
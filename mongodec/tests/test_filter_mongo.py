@@ -1,8 +1,11 @@
 """ Tests for filter_mongo.py """
 
 import unittest
+import bson
 import mongodec.mongodec as md
 import mongodec.filter_mongo as fm
+from pymongo import ReadPreference
+from pymongo.operations import InsertOne, UpdateOne, DeleteMany
 
 
 ######################################################################
@@ -61,6 +64,34 @@ class TestFilterMongo(unittest.TestCase):
             self.assertEqual(coll._filter, filt)
 
 
+    def test_FilterMongoDB_cache(self):
+        """ Wrapped collections are reused until evicted """
+        mongo_db = get_local_mongo()
+        filter_mongo = fm.FilterMongoDB(mongo_db, _filter={'foo': 'bar'},
+                                        cache_size=2)
+
+        coll = filter_mongo.collection_1
+        self.assertIs(filter_mongo['collection_1'], coll)
+        self.assertIs(filter_mongo.get_collection('collection_1'), coll)
+        self.assertEqual(filter_mongo.name, 'local')
+
+        secondary = filter_mongo.get_collection(
+            'collection_1', read_preference=ReadPreference.SECONDARY)
+        self.assertIsNot(secondary, coll)
+        self.assertEqual(secondary.base_object.read_preference,
+                         ReadPreference.SECONDARY)
+
+        # Least recently used entries fall out past cache_size
+        filter_mongo.collection_2
+        self.assertIsNot(filter_mongo.collection_1, coll)
+
+        coll_2 = filter_mongo.collection_2
+        filter_mongo.evict_collection('collection_2')
+        self.assertIsNot(filter_mongo.collection_2, coll_2)
+        filter_mongo.evict_collection()
+        self.assertEqual(len(filter_mongo.collection_cache), 0)
+
+
     def test_FilterMongoCollection_base(self):
         """ Just tests that we can build a filter collection object w/o err """
         config = md.MongoConfig(user=None, password=None, database='local',
@@ -621,6 +652,146 @@ class TestFilterMongo(unittest.TestCase):
                          sorted(exp_out, key=lambda d: d['val']))
 
 
+    def test_bulk_write(self):
+        """ FilterMongoCollection.bulk_write """
+        r_mongo_db = get_local_mongo()
+        c_mongo_db = fm.FilterMongoDB(r_mongo_db, _filter={'name': 'foobar'})
+        r_coll = r_mongo_db['dummyColl']
+        c_coll = c_mongo_db['dummyColl']
+
+        r_coll.insert({'name': 'foobar', 'id': 'a', 'val': 0})
+        r_coll.insert({'name': 'foobaz', 'id': 'a', 'val': 1})
+        r_coll.insert({'name': 'foobaz', 'id': 'b', 'val': 2})
+
+        result = c_coll.bulk_write([
+            UpdateOne({'id': 'a'}, {'$set': {'val': 10}}),
+            DeleteMany({'id': 'b'}),
+            InsertOne({'name': 'foobar', 'id': 'c', 'val': 3})])
+        self.assertEqual(result.modified_count, 1)
+        self.assertEqual(result.deleted_count, 0)
+
+        exp_out = [{'name': 'foobaz', 'id': 'a', 'val': 1},
+                   {'name': 'foobaz', 'id': 'b', 'val': 2},
+                   {'name': 'foobar', 'id': 'c', 'val': 3},
+                   {'name': 'foobar', 'id': 'a', 'val': 10}]
+        self.assertEqual(sorted(r_coll.find({}, {'_id': 0}),
+                                key=lambda d: d['val']), exp_out)
+
+    def test_stamp(self):
+        """ FilterMongoCollection(stamp=True) """
+        r_mongo_db = get_local_mongo()
+        c_mongo_db = fm.FilterMongoDB(r_mongo_db, _filter={'name': 'foobar'},
+                                      stamp=True)
+        r_coll = r_mongo_db['dummyColl']
+        c_coll = c_mongo_db['dummyColl']
+
+        document = {'id': 'a'}
+        c_coll.insert_one(document)
+        self.assertEqual(document['name'], 'foobar')
+        c_coll.insert_many({'id': i} for i in 'bc')
+        c_coll.replace_one({'id': 'a'}, {'id': 'a', 'val': 1})
+        c_coll.replace_one({'id': 'd'}, {'id': 'd'}, upsert=True)
+        c_coll.update_one({'id': 'e'}, {'$set': {'val': 2}}, upsert=True)
+        c_coll.bulk_write([InsertOne({'id': 'f'})])
+
+        self.assertEqual(c_coll.count(), 6)
+        self.assertEqual(r_coll.count({'name': 'foobar'}), 6)
+        self.assertEqual(c_coll.find_one({'id': 'a'}, {'_id': 0}),
+                         {'id': 'a', 'val': 1, 'name': 'foobar'})
+
+    def test_raw(self):
+        """ find and aggregate with raw=True """
+        r_mongo_db = get_local_mongo()
+        c_mongo_db = fm.FilterMongoDB(r_mongo_db, _filter={'name': 'foobar'})
+        r_coll = r_mongo_db['dummyColl']
+        c_coll = c_mongo_db['dummyColl']
+
+        r_coll.insert_many([{'name': 'foobar', 'val': i} for i in range(5)] +
+                           [{'name': 'foobaz', 'val': 5}])
+
+        batches = list(c_coll.find({}, {'_id': 0}, batch_size=2, raw=True))
+        self.assertTrue(all(isinstance(b, memoryview) for b in batches))
+        self.assertEqual([doc['val'] for b in batches
+                          for doc in fm.raw_documents(b)], range(5))
+
+        pipeline = [{'$group': {'_id': None, 'count': {'$sum': 1}}}]
+        [batch] = c_coll.aggregate(pipeline, raw=True)
+        self.assertEqual(bson.decode_all(batch.tobytes()),
+                         [{'_id': None, 'count': 5}])
+        [batch] = c_coll.aggregate_raw_batches(pipeline)
+        self.assertEqual(bson.decode_all(batch),
+                         [{'_id': None, 'count': 5}])
+
+
+
+class RawCollection(object):
+    """ Returns the filter or pipeline it was called with, as raw batches """
+    full_name = 'db.raw'
+
+    class Cursor(list):
+        def close(self):
+            pass
+
+    def find(self, *args, **kwargs):
+        raise AssertionError('raw find went to find')
+
+    def aggregate(self, pipeline, session=None, **kwargs):
+        return ('cursor', pipeline, kwargs)
+
+    def find_raw_batches(self, *args, **kwargs):
+        return self.Cursor([bson.BSON.encode(kwargs['filter'] or {})])
+
+    def aggregate_raw_batches(self, pipeline, session=None, **kwargs):
+        return self.Cursor([bson.BSON.encode(stage) for stage in pipeline])
+
+
+class TestRawBatches(unittest.TestCase):
+
+    def test_raw(self):
+        """ raw is handled with and without no_changeling """
+        coll = fm.FilterMongoCollection(RawCollection(), {'t': 'a'},
+                                        timeout_wrap=False)
+        for no_changeling, expected in [(False, {'x': 1, 't': 'a'}),
+                                        (True, {'x': 1})]:
+            [batch] = coll.find({'x': 1}, raw=True,
+                                no_changeling=no_changeling)
+            self.assertEqual(bson.BSON(batch.tobytes()).decode(), expected)
+            batches = coll.aggregate([{'$match': {'x': 1}}], raw=True,
+                                     no_changeling=no_changeling)
+            self.assertEqual([bson.BSON(b.tobytes()).decode()
+                              for b in batches][-1],
+                             {'$match': expected})
+
+        self.assertEqual(coll.aggregate([], batchSize=2),
+                         ('cursor', [{'$match': {'t': 'a'}}],
+                          {'batchSize': 2}))
+        self.assertEqual(coll.aggregate([], no_changeling=True),
+                         ('cursor', [], {}))
+
+
+    def test_raw_documents(self):
+        documents = [{'a': 1}, {'b': [1, 2]}, {'c': {'d': 'e'}}]
+        batch = b''.join(bson.BSON.encode(doc) for doc in documents)
+        raw = list(fm.raw_documents(batch))
+        self.assertEqual([doc.raw for doc in raw],
+                         [bson.BSON.encode(doc) for doc in documents])
+        self.assertEqual(raw[2]['c']['d'], 'e')
+        self.assertEqual(list(fm.raw_documents(b'')), [])
+
+
+    def test_raw_batches(self):
+        class Cursor(list):
+            closed = False
+
+            def close(self):
+                self.closed = True
+
+        cursor = Cursor([b'ab', b'cd'])
+        batches = fm.raw_batches(cursor)
+        self.assertEqual(next(batches).tobytes(), b'ab')
+        batches.close()
+        self.assertTrue(cursor.closed)
+
 
 
 if __name__ == '__main__':
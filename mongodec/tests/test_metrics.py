@@ -0,0 +1,204 @@
+""" Tests for metrics.py """
+
+import time
+import unittest
+import mongodec.mongodec as md
+from mongodec.filter_mongo import FilterMongoCollection
+from mongodec.changeling import Changeling, hooked, replace_arg
+from mongodec.metrics import CallMetrics, SlowQueryLog, prometheus_text, \
+                             redact
+from pymongo.errors import NetworkTimeout
+
+
+class Foo(object):
+    def f(self, arg):
+        return arg
+
+    def g(self):
+        raise ValueError('g')
+
+
+class SlowCursor(object):
+    """ A cursor that takes delay seconds to fetch each document """
+    def __init__(self, documents, delay):
+        self.documents = list(documents)
+        self.delay = delay
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        time.sleep(self.delay)
+        if not self.documents:
+            raise StopIteration
+        return self.documents.pop(0)
+
+    def limit(self, n):
+        del self.documents[n:]
+        return self
+
+    def close(self):
+        self.closed = True
+
+
+class SlowFindCollection(object):
+    full_name = 'db.coll'
+
+    def find(self, filter=None, projection=None):
+        return SlowCursor([{'_id': i} for i in range(3)], 0.02)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_CallMetrics(self):
+        """ Calls, errors and retries are recorded per label and method """
+        metrics = CallMetrics(buckets=(1, 60))
+        c_foo = Changeling(Foo(), cdict={'metrics': metrics})
+
+        self.assertEqual(c_foo.f(1), 1)
+        self.assertEqual(c_foo.f(arg=2), 2)
+        with self.assertRaises(ValueError):
+            c_foo.g()
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(sorted(snapshot), [('Foo', 'f'), ('Foo', 'g')])
+        self.assertEqual(snapshot[('Foo', 'f')]['calls'], 2)
+        self.assertEqual(snapshot[('Foo', 'f')]['errors'], 0)
+        self.assertEqual(snapshot[('Foo', 'g')]['errors'], 1)
+        self.assertEqual(snapshot[('Foo', 'f')]['buckets'],
+                         [(1, 2), (60, 2), (float('inf'), 2)])
+
+        # Retries inside mongo_timeout_wrap count against the current call
+        def flaky(arg, calls=[0]):
+            calls[0] += 1
+            if calls[0] == 1:
+                raise NetworkTimeout('flaky')
+            return arg
+
+        cdict = {'metrics': metrics,
+                 'retry_policy': md.RetryPolicy(base_delay=0,
+                                                budget=md.RetryBudget())}
+        wrapped = metrics.instrument('coll', 'flaky',
+                                     lambda arg: md.mongo_timeout_wrap(
+                                         flaky, cdict, {'arg': arg}))
+        self.assertEqual(wrapped(3), 3)
+        self.assertEqual(metrics.snapshot()[('coll', 'flaky')]['retries'], 1)
+
+        metrics.reset()
+        self.assertEqual(metrics.snapshot(), {})
+
+
+    def test_disabled(self):
+        """ Without metrics, methods aren't wrapped for timing """
+        metrics = CallMetrics()
+        plain = Changeling(Foo())
+        timed = Changeling(Foo(), cdict={'metrics': metrics})
+        self.assertEqual(plain.f.__name__, 'wrapper')
+        self.assertEqual(plain.f(1), timed.f(1))
+        self.assertEqual(len(metrics.snapshot()), 1)
+
+
+    def test_prometheus_text(self):
+        metrics = CallMetrics(buckets=(0.5,))
+        metrics.observe('db.coll', 'find_one', 0.25)
+        metrics.observe('db.coll', 'find_one', 2, error=True)
+
+        self.assertEqual(prometheus_text(metrics).splitlines(), [
+            '# HELP mongodec_calls_total Calls made',
+            '# TYPE mongodec_calls_total counter',
+            'mongodec_calls_total{collection="db.coll",method="find_one"} 2',
+            '# HELP mongodec_call_errors_total Calls that raised',
+            '# TYPE mongodec_call_errors_total counter',
+            'mongodec_call_errors_total{collection="db.coll",'
+            'method="find_one"} 1',
+            '# HELP mongodec_call_retries_total Retries made by '
+            'mongo_timeout_wrap',
+            '# TYPE mongodec_call_retries_total counter',
+            'mongodec_call_retries_total{collection="db.coll",'
+            'method="find_one"} 0',
+            '# HELP mongodec_call_duration_seconds Call latency',
+            '# TYPE mongodec_call_duration_seconds histogram',
+            'mongodec_call_duration_seconds_bucket{collection="db.coll",'
+            'method="find_one",le="0.5"} 1',
+            'mongodec_call_duration_seconds_bucket{collection="db.coll",'
+            'method="find_one",le="+Inf"} 2',
+            'mongodec_call_duration_seconds_sum{collection="db.coll",'
+            'method="find_one"} 2.25',
+            'mongodec_call_duration_seconds_count{collection="db.coll",'
+            'method="find_one"} 2'])
+
+
+    def test_SlowQueryLog(self):
+        """ Slow calls are kept with the post-filter query shape """
+        slow_log = SlowQueryLog(threshold=0, maxlen=2)
+        cdict = {'update_filter': {'tenant': 'a'},
+                 'call_hooks': [slow_log],
+                 'collection_name': 'db.coll'}
+
+        def distinct(key, filter=None):
+            return ['x', 'y']
+
+        wrapper = hooked(replace_arg('filter', md.update_filter))
+        callargs = {'key': 'k', 'filter': {'val': {'$in': [1, 2]}}}
+        self.assertEqual(wrapper(distinct, cdict=cdict, callargs=callargs),
+                         ['x', 'y'])
+
+        [record] = slow_log.entries()
+        self.assertEqual(record['collection'], 'db.coll')
+        self.assertEqual(record['method'], 'distinct')
+        self.assertEqual(record['query'], {'tenant': '?',
+                                           'val': {'$in': ['?']}})
+        self.assertEqual(record['n_returned'], 2)
+
+        # Only the last maxlen calls are kept, and fast ones not at all
+        for _ in range(3):
+            wrapper(distinct, cdict=cdict, callargs={'key': 'k',
+                                                     'filter': None})
+        self.assertEqual(len(slow_log.entries()), 2)
+        slow_log.clear()
+        slow_log.threshold = 60
+        wrapper(distinct, cdict=cdict, callargs={'key': 'k', 'filter': None})
+        self.assertEqual(slow_log.entries(), [])
+
+
+    def test_SlowQueryLog_find(self):
+        """ A find is timed while its cursor is read """
+        slow_log = SlowQueryLog(threshold=0.05)
+        coll = FilterMongoCollection(SlowFindCollection(), _filter={'t': 'a'},
+                                     timeout_wrap=False,
+                                     slow_query_log=slow_log)
+
+        cursor = coll.find({'x': 1}).limit(5)
+        self.assertEqual(slow_log.entries(), [])
+        self.assertEqual(len(list(cursor)), 3)
+        [record] = slow_log.entries()
+        self.assertEqual(record['method'], 'find')
+        self.assertEqual(record['query'], {'t': '?', 'x': '?'})
+        self.assertEqual(record['n_returned'], 3)
+        self.assertGreaterEqual(record['duration'], 0.05)
+
+        # A closed cursor is recorded with what was read, just once
+        slow_log.clear()
+        cursor = coll.find()
+        for _ in range(3):
+            next(cursor)
+        cursor.close()
+        cursor.close()
+        self.assertTrue(cursor.cursor.closed)
+        self.assertEqual([record['n_returned']
+                          for record in slow_log.entries()], [3])
+
+
+    def test_redact(self):
+        self.assertEqual(redact([{'$match': {'a': 1, 'b': {'$gt': 2}}},
+                                 {'$limit': 10}]),
+                         [{'$match': {'a': '?', 'b': {'$gt': '?'}}},
+                          {'$limit': '?'}])
+        self.assertEqual(redact('some_id'), '?')
+        self.assertEqual(redact(None), None)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
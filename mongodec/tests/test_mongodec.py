@@ -2,9 +2,13 @@
 
 import unittest
 import mongodec.mongodec as md
+import mongodec.filter_mongo as fm
 import os, json
 from pymongo.errors import NetworkTimeout, ConnectionFailure
-from pymongo import ReadPreference
+from pymongo import MongoClient, ReadPreference
+from bson.regex import Regex
+from pymongo.operations import InsertOne, UpdateOne, UpdateMany, ReplaceOne, \
+                               DeleteOne, DeleteMany
 
 def get_local_mongo():
     return md.MongoConfig(user=None, password=None, database='local',
@@ -74,6 +78,37 @@ class TestMongodec(unittest.TestCase):
             os.environ['foobar'] = original_val
 
 
+    def test_MongoConfig_resolve(self):
+        config = md.MongoConfig(database='local', host='localhost',
+                                port=27017)
+        self.assertEqual(config.uri(), 'mongodb://localhost:27017/local')
+        self.assertIs(config.resolve(), config.resolve())
+
+        auth_config = md.MongoConfig(user='dev', password='pw',
+                                     database='local', host='localhost',
+                                     replica_set='?replicaSet=rs0')
+        self.assertEqual(auth_config.uri(),
+                         'mongodb://dev:pw@localhost/local?replicaSet=rs0')
+
+        # The environment is read once, until refresh
+        original_val = os.environ.get('foobar')
+        os.environ['foobar'] = json.dumps({'database': 'local',
+                                           'host': 'localhost'})
+        env_config = md.MongoConfig(environ_var='foobar')
+        self.assertEqual(env_config.uri(), 'mongodb://localhost/local')
+        os.environ['foobar'] = json.dumps({'database': 'other',
+                                           'host': 'otherhost',
+                                           'user': 'dev', 'password': 'pw'})
+        self.assertEqual(env_config.resolve()['database'], 'local')
+        self.assertEqual(env_config.refresh(),
+                         {'uri': 'mongodb://dev:pw@otherhost/other',
+                          'database': 'other', 'client_kwargs': {}})
+        if original_val is None:
+            del os.environ['foobar']
+        else:
+            os.environ['foobar'] = original_val
+
+
     def test_MongoConfig_kwargs(self):
         config = md.MongoConfig(user=None, password=None, database='local',
                                 host='localhost', port=27017,
@@ -84,6 +119,32 @@ class TestMongodec(unittest.TestCase):
         self.assertEqual(mongo_db.read_preference, ReadPreference.SECONDARY)
 
 
+    def test_MongoConfig_shared_client(self):
+        config = md.MongoConfig(database='local', host='localhost',
+                                port=27017)
+        other_config = md.MongoConfig(database='local', host='localhost',
+                                      port=27017)
+
+        # Configs with the same uri and kwargs share one client
+        client = config.client()
+        self.assertIs(config.client(), client)
+        self.assertIs(other_config.client(), client)
+        self.assertIs(config.db().client, client)
+        self.assertIsNot(config.client(shared=False), client)
+
+        config.modify_client_kwargs({'connect': False})
+        self.assertIsNot(config.client(), client)
+
+        # A forked child doesn't reuse the parent's clients
+        md.CLIENT_REGISTRY['pid'] = -1
+        self.assertIsNot(other_config.client(), client)
+        self.assertEqual(md.CLIENT_REGISTRY['pid'], os.getpid())
+
+        other_config.close()
+        config.close()
+        self.assertEqual(md.CLIENT_REGISTRY['clients'], {})
+
+
     '''
     ##########################################################################
     #                                                                        #
@@ -117,6 +178,96 @@ class TestMongodec(unittest.TestCase):
         self.assertTrue(md.mongo_timeout_wrap(g, None, {'arg1': None}))
 
 
+    def test_RetryPolicy(self):
+        def failer(errors):
+            def f(calls=[0]):
+                calls[0] += 1
+                if calls[0] <= len(errors):
+                    raise errors[calls[0] - 1]
+                return calls[0]
+            return f
+
+        policy = md.RetryPolicy(base_delay=0, jitter=False,
+                                budget=md.RetryBudget())
+        cdict = {'retry_policy': policy}
+        self.assertEqual(md.mongo_timeout_wrap(
+            failer([NetworkTimeout('a'), ConnectionFailure('b')]), cdict, {}),
+            3)
+
+        # Non-retryable errors go straight through
+        with self.assertRaises(ValueError):
+            md.mongo_timeout_wrap(failer([ValueError('c')]), cdict, {})
+
+        # Out of attempts re-raises the last error
+        policy.max_attempts = 2
+        with self.assertRaises(ConnectionFailure):
+            md.mongo_timeout_wrap(failer([NetworkTimeout('a'),
+                                          ConnectionFailure('b')]), cdict, {})
+
+        # Backoff doubles up to max_delay; jitter stays under it
+        policy = md.RetryPolicy(base_delay=1, max_delay=5, jitter=False)
+        self.assertEqual([policy.delay(i) for i in range(1, 6)],
+                         [1, 2, 4, 5, 5])
+        policy.jitter = True
+        self.assertTrue(0 <= policy.delay(3) <= 4)
+        self.assertFalse(policy.should_retry(1, elapsed=29, delay=2))
+
+
+    def test_RetryBudget(self):
+        budget = md.RetryBudget(max_tokens=4, token_ratio=0.5)
+        self.assertTrue(budget.withdraw())
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+
+        # Successful calls earn retries back
+        budget.deposit()
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+
+
+    def test_CircuitBreaker(self):
+        breaker = md.CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        policy = md.RetryPolicy(base_delay=0, jitter=False,
+                                budget=md.RetryBudget())
+        cdict = {'retry_policy': policy, 'circuit_breaker': breaker}
+        calls = []
+
+        def down():
+            calls.append(1)
+            raise ConnectionFailure('down')
+
+        # Two failures open the breaker, which then fails fast
+        with self.assertRaises(md.CircuitOpenError):
+            md.mongo_timeout_wrap(down, cdict, {})
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(breaker.snapshot()['state'], breaker.OPEN)
+        with self.assertRaises(md.CircuitOpenError):
+            md.mongo_timeout_wrap(lambda: True, cdict, {})
+
+        # After the cool-down a failed probe re-opens it...
+        breaker.opened_at -= 60
+        with self.assertRaises(md.CircuitOpenError):
+            md.mongo_timeout_wrap(down, cdict, {})
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+        # An interrupted probe gives its slot back...
+        def interrupted():
+            raise KeyboardInterrupt()
+
+        breaker.opened_at -= 60
+        with self.assertRaises(KeyboardInterrupt):
+            md.mongo_timeout_wrap(interrupted, cdict, {})
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+
+        # ...and a successful one closes it
+        self.assertTrue(md.mongo_timeout_wrap(lambda: True, cdict, {}))
+        self.assertEqual(breaker.snapshot(),
+                         {'state': breaker.CLOSED, 'consecutive_failures': 0,
+                          'opened_at': None, 'seconds_until_probe': 0})
+
+
     def test_modify_agg_pipeline(self):
         with self.assertRaises(AssertionError):
             md.modify_agg_pipeline('not pipeline', None, {})
@@ -128,8 +279,84 @@ class TestMongodec(unittest.TestCase):
 
         self.assertEqual(new_callargs,
                          {'alpha': 'beta',
-                          'pipeline': [{'$match': {'a': 'b', 'c': 'd'}},
-                                       {'$match': {'foo': 'bar'}}]})
+                          'pipeline': [{'$match': {'a': 'b', 'c': 'd',
+                                                   'foo': 'bar'}}]})
+
+
+    def test_rewrite_pipeline(self):
+        plan = md.compile_filter({'tenant': 'a'})
+        group = {'$group': {'_id': '$id'}}
+
+        self.assertEqual(md.rewrite_pipeline(plan, [group]),
+                         [{'$match': {'tenant': 'a'}}, group])
+        self.assertEqual(md.rewrite_pipeline(plan, []),
+                         [{'$match': {'tenant': 'a'}}])
+
+        # A leading $match can't override the filter, even in merge mode
+        pipeline = [{'$match': {'tenant': 'b', 'x': 1}}, group]
+        self.assertEqual(md.rewrite_pipeline(plan, pipeline),
+                         [{'$match': {'tenant': 'a', 'x': 1,
+                                      '$and': [{'tenant': 'b'}]}}, group])
+        self.assertEqual(pipeline, [{'$match': {'tenant': 'b', 'x': 1}},
+                                    group])
+
+        geo_near = {'$geoNear': {'near': [0, 0], 'distanceField': 'd',
+                                 'query': {'x': 1}}}
+        self.assertEqual(md.rewrite_pipeline(plan, [geo_near]),
+                         [{'$geoNear': {'near': [0, 0], 'distanceField': 'd',
+                                        'query': {'x': 1, 'tenant': 'a'}}}])
+
+        search = {'$search': {'text': {'query': 'q', 'path': 'p'}}}
+        self.assertEqual(md.rewrite_pipeline(plan, [search, group]),
+                         [search, {'$match': {'tenant': 'a'}}, group])
+        self.assertEqual(md.rewrite_pipeline(plan, [search,
+                                                    {'$match': {'x': 1}}]),
+                         [search, {'$match': {'tenant': 'a', 'x': 1}}])
+
+        coll_stats = [{'$collStats': {'count': {}}}]
+        self.assertEqual(md.rewrite_pipeline(plan, coll_stats), coll_stats)
+        self.assertEqual(md.PIPELINE_ACTIONS[('$collStats',)], ('skip', 0))
+
+
+    def test_rewrite_pipeline_lookups(self):
+        plan = md.compile_filter({'tenant': 'a'})
+        match = {'$match': {'tenant': 'a'}}
+        pipeline = [
+            {'$lookup': {'from': 'orders', 'localField': 'id',
+                         'foreignField': 'user_id', 'as': 'orders'}},
+            {'$lookup': {'from': 'shared', 'as': 'shared', 'pipeline': [
+                {'$unionWith': 'orders'}]}},
+            {'$graphLookup': {'from': 'orders', 'startWith': '$id',
+                              'connectFromField': 'id',
+                              'connectToField': 'parent', 'as': 'tree'}},
+            {'$facet': {'f': [{'$unionWith': {
+                'coll': 'orders', 'pipeline': [{'$match': {'x': 1}}]}}]}}]
+
+        # Joins aren't touched unless asked for
+        self.assertEqual(md.rewrite_pipeline(plan, pipeline),
+                         [match] + pipeline)
+
+        self.assertEqual(md.rewrite_pipeline(plan, pipeline, set(['orders'])),
+            [match,
+             {'$lookup': {'from': 'orders', 'localField': 'id',
+                          'foreignField': 'user_id', 'as': 'orders',
+                          'pipeline': [match]}},
+             {'$lookup': {'from': 'shared', 'as': 'shared', 'pipeline': [
+                 {'$unionWith': {'coll': 'orders', 'pipeline': [match]}}]}},
+             {'$graphLookup': {'from': 'orders', 'startWith': '$id',
+                               'connectFromField': 'id',
+                               'connectToField': 'parent', 'as': 'tree',
+                               'restrictSearchWithMatch': {'tenant': 'a'}}},
+             {'$facet': {'f': [{'$unionWith': {
+                 'coll': 'orders',
+                 'pipeline': [{'$match': {'tenant': 'a', 'x': 1}}]}}]}}])
+
+        # True filters joins against every collection
+        self.assertEqual(md.rewrite_pipeline(plan, pipeline[1:2], True),
+            [match,
+             {'$lookup': {'from': 'shared', 'as': 'shared', 'pipeline': [
+                 match,
+                 {'$unionWith': {'coll': 'orders', 'pipeline': [match]}}]}}])
 
 
     def test_update_filter(self):
@@ -157,6 +384,195 @@ class TestMongodec(unittest.TestCase):
         self.assertEqual(callargs_3, {'filter': {'a': 'b', 'c': 'd',
                                                  '_id': 'ID'}, 'foo': 'bar'})
 
+        # The caller's filter is never modified, and is passed through as
+        # is when it has every key already
+        query = {'_id': 'ID'}
+        callargs_5 = {'filter': query}
+        md.update_filter('filter', {'update_filter': {'a': 'b'}}, callargs_5)
+        self.assertEqual(query, {'_id': 'ID'})
+        self.assertEqual(callargs_5, {'filter': {'_id': 'ID', 'a': 'b'}})
+
+        query = {'a': 'x'}
+        callargs_6 = {'filter': query}
+        md.update_filter('filter', {'update_filter': {'a': 'b'}}, callargs_6)
+        self.assertIs(callargs_6['filter'], query)
+
+        # A precompiled plan in the cdict is used over update_filter
+        callargs_4 = {'filter': None}
+        plan = md.compile_filter({'c': 'd'})
+        md.update_filter('filter', {'update_filter': {'a': 'b'},
+                                    'filter_plan': plan}, callargs_4)
+        self.assertEqual(callargs_4, {'filter': {'c': 'd'}})
+
+
+    def test_FilterPlan_and(self):
+        plan = md.compile_filter({'tenant': 'a', 'val': {'$gte': 10}},
+                                 mode=md.AND)
+
+        # No clash: same as a merge, and untouched queries pass through
+        query = {'tenant': 'a', 'val': {'$gte': 10}, 'x': 1}
+        self.assertIs(plan.apply(query), query)
+        self.assertEqual(plan.apply({'x': 1}),
+                         {'tenant': 'a', 'val': {'$gte': 10}, 'x': 1})
+
+        # Range operators on the same field are flattened
+        self.assertEqual(plan.apply({'val': {'$lt': 20}}),
+                         {'tenant': 'a', 'val': {'$gte': 10, '$lt': 20}})
+
+        # A caller can't swap the tenant out; clashes go into $and
+        query = {'tenant': 'b', 'val': {'$gte': 0}, '$and': [{'y': 1}]}
+        self.assertEqual(plan.apply(query),
+                         {'tenant': 'a', 'val': {'$gte': 10},
+                          '$and': [{'y': 1}, {'tenant': 'b'},
+                                   {'val': {'$gte': 0}}]})
+        self.assertEqual(query, {'tenant': 'b', 'val': {'$gte': 0},
+                                 '$and': [{'y': 1}]})
+        self.assertEqual(plan.apply('ID'),
+                         {'_id': 'ID', 'tenant': 'a', 'val': {'$gte': 10}})
+
+        # $regex and $options stay together: a caller can't add options to
+        # the plan's regex
+        regex_plan = md.compile_filter({'name': {'$regex': '^a'}},
+                                       mode=md.AND)
+        self.assertEqual(regex_plan.apply({'name': {'$options': 'i'}}),
+                         {'name': {'$regex': '^a'},
+                          '$and': [{'name': {'$options': 'i'}}]})
+        self.assertEqual(regex_plan.apply({'name': {'$regex': 'b',
+                                                    '$options': 'x'}}),
+                         {'name': {'$regex': '^a'},
+                          '$and': [{'name': {'$regex': 'b',
+                                             '$options': 'x'}}]})
+        self.assertEqual(regex_plan.apply({'name': {'$ne': 'ab'}}),
+                         {'name': {'$regex': '^a', '$ne': 'ab'}})
+
+        and_plan = md.compile_filter({'$and': [{'a': 1}]}, mode=md.AND)
+        self.assertEqual(and_plan.apply({'$and': [{'b': 2}]}),
+                         {'$and': [{'a': 1}, {'b': 2}]})
+
+
+    def test_FilterPlan_stamp(self):
+        plan = md.compile_filter({'tenant': 'a', 'kind': {'$eq': 'x'},
+                                  'val': {'$gte': 10}, 'sub.key': 1,
+                                  'name': Regex('^a'),
+                                  '$or': [{'b': 1}, {'c': 1}]})
+        self.assertEqual(sorted(plan.stamp_items),
+                         [('kind', 'x'), ('tenant', 'a')])
+
+        document = {'val': 1}
+        self.assertEqual(plan.stamp(document),
+                         {'val': 1, 'tenant': 'a', 'kind': 'x'})
+        self.assertEqual(document, {'val': 1})
+        stamped = {'val': 1, 'tenant': 'a', 'kind': 'x'}
+        self.assertIs(plan.stamp(stamped), stamped)
+
+        # In MERGE mode the document's own values win, in AND mode the plan's
+        self.assertEqual(plan.stamp({'tenant': 'b'}),
+                         {'tenant': 'b', 'kind': 'x'})
+        self.assertEqual(plan.as_and().stamp({'tenant': 'b'}),
+                         {'tenant': 'a', 'kind': 'x'})
+
+        self.assertIs(plan.stamp(document, in_place=True), document)
+        self.assertEqual(document, {'val': 1, 'tenant': 'a', 'kind': 'x'})
+
+
+    def test_stamp_inserts(self):
+        cdict = {'filter_plan': md.compile_filter({'tenant': 'a'})}
+        document = {'x': 1}
+        md.stamp_inserts('document', cdict, {'document': document})
+        self.assertEqual(document, {'x': 1, 'tenant': 'a'})
+
+        # Iterables are stamped lazily, as they're consumed
+        pulled = []
+        def documents():
+            for i in range(3):
+                pulled.append(i)
+                yield {'x': i}
+        callargs = md.stamp_inserts('documents', cdict,
+                                    {'documents': documents()})
+        self.assertEqual(pulled, [])
+        self.assertEqual(list(callargs['documents']),
+                         [{'x': i, 'tenant': 'a'} for i in range(3)])
+
+        # Lists are stamped in place and passed on as they are
+        documents = [{'x': 1}]
+        callargs = md.stamp_inserts('documents', cdict,
+                                    {'documents': documents})
+        self.assertIs(callargs['documents'], documents)
+        self.assertEqual(documents, [{'x': 1, 'tenant': 'a'}])
+
+        # ...so insert_many([]) fails as the driver says it should
+        collection = MongoClient(connect=False)['db']['coll']
+        filtered = fm.FilterMongoCollection(collection, {'tenant': 'a'},
+                                            timeout_wrap=False, stamp=True)
+        for coll in [collection, filtered]:
+            with self.assertRaisesRegexp(TypeError, 'non-empty list'):
+                coll.insert_many([])
+
+        replacement = {'x': 2}
+        callargs = md.stamp_replacement('replacement', cdict,
+                                        {'replacement': replacement})
+        self.assertEqual(callargs['replacement'], {'x': 2, 'tenant': 'a'})
+        self.assertEqual(replacement, {'x': 2})
+        update = {'$set': {'x': 3}}
+        callargs = md.stamp_replacement('document', cdict,
+                                        {'document': update})
+        self.assertIs(callargs['document'], update)
+
+
+    def test_update_requests(self):
+        insert = InsertOne({'x': 1})
+        update = UpdateOne({'x': 1}, {'$set': {'y': 2}}, upsert=True)
+        already_filtered = DeleteOne({'x': 1, 'a': 'b'})
+        callargs = {'requests': [insert, update, already_filtered,
+                                 UpdateMany({}, {'$set': {'y': 3}}),
+                                 ReplaceOne({'x': 2}, {'x': 3}),
+                                 DeleteMany(None)]}
+
+        md.update_requests('requests', {'update_filter': {'a': 'b'}},
+                           callargs)
+        self.assertEqual(callargs['requests'],
+                         [insert,
+                          UpdateOne({'x': 1, 'a': 'b'}, {'$set': {'y': 2}},
+                                    upsert=True),
+                          already_filtered,
+                          UpdateMany({'a': 'b'}, {'$set': {'y': 3}}),
+                          ReplaceOne({'x': 2, 'a': 'b'}, {'x': 3}),
+                          DeleteMany({'a': 'b'})])
+        self.assertIs(callargs['requests'][2], already_filtered)
+        self.assertEqual(update._filter, {'x': 1})
+
+        # With stamp, inserts and replacements get the filter's fields
+        replace = ReplaceOne({'x': 2}, {'x': 3}, upsert=True)
+        callargs = {'requests': [insert, replace]}
+        md.update_requests('requests', {'update_filter': {'a': 'b'},
+                                        'stamp': True}, callargs)
+        self.assertEqual(callargs['requests'],
+                         [InsertOne({'x': 1, 'a': 'b'}),
+                          ReplaceOne({'x': 2, 'a': 'b'}, {'x': 3, 'a': 'b'},
+                                     upsert=True)])
+        self.assertEqual(replace, ReplaceOne({'x': 2}, {'x': 3}, upsert=True))
+
+
+    def test_compile_filter(self):
+        _filter = {'a': {'$gt': 1}, '$or': [{'b': 1}, {'c': 2}]}
+        plan = md.compile_filter(_filter)
+        self.assertIs(md.compile_filter(plan), plan)
+
+        # Later changes to the source filter don't leak into the plan
+        _filter['a']['$gt'] = 100
+        self.assertEqual(plan.apply(None),
+                         {'a': {'$gt': 1}, '$or': [{'b': 1}, {'c': 2}]})
+        self.assertEqual(md.compile_filter(None).apply('ID'), 'ID')
+
+        with self.assertRaises(ValueError):
+            md.compile_filter({'a': 1}, mode='or')
+
+        for bad_filter in ['ID', {'$bogus': 1}, {'$or': []},
+                           {'$and': [{'$bogus': 1}]},
+                           {'a': {'$gt': 1, 'b': 2}}]:
+            with self.assertRaises(ValueError):
+                md.compile_filter(bad_filter)
+
 
 
 if __name__ == '__main__':
@@ -0,0 +1,123 @@
+""" Tests for motor_mongo.py """
+
+import unittest
+import mongodec.mongodec as md
+from mongodec.metrics import CallMetrics
+from pymongo import MongoClient
+from pymongo.errors import AutoReconnect
+
+try:
+    from tornado import gen
+    from tornado.concurrent import Future
+    from tornado.ioloop import IOLoop
+    import mongodec.motor_mongo as mm
+except ImportError:
+    gen = None
+
+
+def resolved(result=None, error=None):
+    future = Future()
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+    return future
+
+
+class FakeMotorCollection(object):
+    """ Stands in for a MotorCollection: async methods return Futures of
+        the arguments they got, cursor methods return them straight away
+    """
+    def __init__(self, failures=0):
+        self.delegate = MongoClient(connect=False)['db']['fake']
+        self.full_name = self.delegate.full_name
+        self.failures = failures
+
+    def find_one(self, *args, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            return resolved(error=AutoReconnect('flaky'))
+        return resolved(kwargs)
+
+    def update_one(self, *args, **kwargs):
+        return resolved(kwargs)
+
+    def find(self, *args, **kwargs):
+        return ('cursor', kwargs)
+
+    def aggregate(self, *args, **kwargs):
+        return ('cursor', kwargs)
+
+
+@unittest.skipIf(gen is None, 'needs tornado')
+class TestFilterMotorCollection(unittest.TestCase):
+
+    def run_sync(self, func):
+        return IOLoop.current().run_sync(func)
+
+    def test_filter(self):
+        """ Filters go in as they do for FilterMongoCollection """
+        coll = mm.FilterMotorCollection(FakeMotorCollection(),
+                                        _filter={'t': 'a'})
+
+        @gen.coroutine
+        def calls():
+            found = yield coll.find_one({'x': 1})
+            updated = yield coll.update_one({'x': 1}, {'$set': {'y': 2}},
+                                            upsert=True)
+            raise gen.Return((found, updated))
+
+        found, updated = self.run_sync(calls)
+        self.assertEqual(found['filter'], {'x': 1, 't': 'a'})
+        self.assertEqual(updated, {'filter': {'x': 1, 't': 'a'},
+                                   'update': {'$set': {'y': 2}},
+                                   'upsert': True,
+                                   'bypass_document_validation': False,
+                                   'collation': None,
+                                   'array_filters': None,
+                                   'hint': None,
+                                   'session': None})
+
+        # Cursor methods aren't made async
+        self.assertEqual(coll.find({'x': 1}),
+                         ('cursor', {'filter': {'x': 1, 't': 'a'},
+                                     'projection': None}))
+        self.assertEqual(coll.aggregate([])[1]['pipeline'],
+                         [{'$match': {'t': 'a'}}])
+
+
+    def test_retry(self):
+        """ Failed Futures are retried with gen.sleep between attempts """
+        policy = md.RetryPolicy(base_delay=0.001, budget=md.RetryBudget())
+        fake = FakeMotorCollection(failures=2)
+        coll = mm.FilterMotorCollection(fake, _filter={'t': 'a'},
+                                        retry_policy=policy)
+        self.assertEqual(self.run_sync(lambda: coll.find_one())['filter'],
+                         {'t': 'a'})
+        self.assertEqual(fake.failures, 0)
+
+        # Retries are counted against the call, which is timed until its
+        # Future resolves
+        metrics = CallMetrics()
+        for method in ['find_one', 'update_one']:
+            fake = FakeMotorCollection(failures=1)
+            fake.update_one = fake.find_one
+            coll = mm.FilterMotorCollection(fake, retry_policy=policy,
+                                            metrics=metrics)
+            self.run_sync(lambda: getattr(coll, method)({}, {}))
+        snapshot = metrics.snapshot()
+        for method in ['find_one', 'update_one']:
+            self.assertEqual((snapshot[('db.fake', method)]['calls'],
+                              snapshot[('db.fake', method)]['retries']),
+                             (1, 1))
+
+        fake = FakeMotorCollection(failures=2)
+        coll = mm.FilterMotorCollection(
+            fake, retry_policy=md.RetryPolicy(max_attempts=2, budget=None))
+        with self.assertRaises(AutoReconnect):
+            self.run_sync(lambda: coll.find_one())
+
+
+
+if __name__ == '__main__':
+    unittest.main()
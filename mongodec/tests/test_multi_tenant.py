@@ -0,0 +1,133 @@
+""" Tests for multi_tenant.py """
+
+import threading
+import unittest
+from mongodec.multi_tenant import fan_out, QuerySpec, TenantResult, \
+                                  DeadlineExceeded, batched_find, \
+                                  group_tenants, with_field
+
+
+class FakeCollection(object):
+    full_name = 'db.fake'
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.queries = []
+
+    def find(self, filter=None, projection=None, sort=None):
+        self.queries.append((filter, projection))
+        def matches(doc, k, v):
+            if isinstance(v, dict) and '$in' in v:
+                return doc.get(k) in v['$in']
+            return doc.get(k) == v
+        for doc in self.docs:
+            if all(matches(doc, k, v) for k, v in filter.items()):
+                if projection:
+                    doc = dict((k, v) for k, v in doc.items()
+                               if k in projection)
+                yield dict(doc)
+
+    def count(self, filter=None):
+        if filter.get('tenant') == 'broken':
+            raise ValueError('broken tenant')
+        return len([doc for doc in self.docs
+                    if all(doc.get(k) == v for k, v in filter.items())])
+
+
+class FakeDB(object):
+    name = 'db'
+
+    def __init__(self, docs):
+        self.coll = FakeCollection(docs)
+
+    def __getitem__(self, name):
+        return self.coll
+
+
+class TestFanOut(unittest.TestCase):
+
+    def test_fan_out(self):
+        """ Every tenant's result is yielded, errors don't stop the rest """
+        db = FakeDB([{'tenant': 'a'}, {'tenant': 'a'}, {'tenant': 'b'}])
+        tenants = [(t, {'tenant': t}) for t in ['a', 'b', 'c', 'broken']]
+        results = list(fan_out(db, tenants, QuerySpec('coll', 'count'),
+                               max_workers=2, timeout_wrap=False))
+
+        self.assertEqual(sorted(result[:2] for result in results),
+                         [('a', 2), ('b', 1), ('broken', None), ('c', 0)])
+        [broken] = [result for result in results if result.error]
+        self.assertEqual(broken.tenant, 'broken')
+        self.assertIsInstance(broken.error, ValueError)
+
+
+    def test_deadline(self):
+        """ Tenants still running at the deadline time out """
+        release = threading.Event()
+
+        def query(filter_db):
+            if filter_db._filter['tenant'] == 'slow':
+                release.wait(5)
+            return filter_db._filter['tenant']
+
+        tenants = {'slow': {'tenant': 'slow'}, 'fast': {'tenant': 'fast'}}
+        results = list(fan_out(FakeDB([]), tenants, query, deadline=0.05))
+        release.set()
+
+        self.assertEqual(results[0], TenantResult('fast', 'fast', None))
+        self.assertEqual(results[1].tenant, 'slow')
+        self.assertIsInstance(results[1].error, DeadlineExceeded)
+
+
+class TestBatchedFind(unittest.TestCase):
+
+    def test_batched_find(self):
+        """ One $in query, documents handed back to their tenants """
+        coll = FakeCollection([{'tenant': 'a', 'kind': 'x', 'val': 1},
+                               {'tenant': 'b', 'kind': 'x', 'val': 2},
+                               {'tenant': 'a', 'kind': 'y', 'val': 3},
+                               {'tenant': 'c', 'kind': 'x', 'val': 4}])
+        tenants = [('A', {'tenant': 'a'}), ('B', {'tenant': 'b'}),
+                   ('D', {'tenant': 'd'}), ('other', {'val': {'$gt': 3}})]
+        results = batched_find(coll, tenants, {'kind': 'x'},
+                               projection={'val': 1}, tenant_field='tenant')
+
+        self.assertEqual(list(results), ['A', 'B', 'D', 'other'])
+        self.assertEqual(results['A'], [{'val': 1}])
+        self.assertEqual(results['B'], [{'val': 2}])
+        self.assertEqual(results['D'], [])
+        self.assertEqual(coll.queries[0],
+                         ({'tenant': {'$in': ['a', 'b', 'd']}, 'kind': 'x'},
+                          {'val': 1, 'tenant': 1}))
+        self.assertEqual(len(coll.queries), 2)
+
+        # tenant_field is found when one field tells the filters apart
+        results = batched_find(coll, {'A': {'tenant': 'a', 'kind': 'x'},
+                                      'C': {'tenant': 'c', 'kind': 'x'}})
+        self.assertEqual([doc['val'] for doc in results['C']], [4])
+        self.assertRaises(ValueError, batched_find, coll,
+                          [(1, {'a': 1, 'b': 1}), (2, {'a': 2, 'b': 2})])
+        self.assertRaises(ValueError, batched_find, coll, tenants[:2],
+                          limit=10)
+
+
+    def test_group_tenants(self):
+        tenants = [(i, {'tenant': i, 'kind': 'x'}) for i in range(5)]
+        tenants.append(('same', {'tenant': 0, 'kind': 'x'}))
+        queries = group_tenants(tenants, 'tenant', max_in=3)
+        self.assertEqual([_filter for _filter, _ in queries],
+                         [{'tenant': {'$in': [0, 1, 2]}, 'kind': 'x'},
+                          {'tenant': {'$in': [3, 4]}, 'kind': 'x'}])
+        self.assertEqual(queries[0][1][0], [0, 'same'])
+
+
+    def test_with_field(self):
+        self.assertEqual(with_field(None, 't'), (None, False))
+        self.assertEqual(with_field(['a'], 't'), ({'a': 1, 't': 1}, True))
+        self.assertEqual(with_field({'t': 0, 'b': 0}, 't'),
+                         ({'b': 0}, True))
+        self.assertEqual(with_field({'b': 0}, 't'), ({'b': 0}, False))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
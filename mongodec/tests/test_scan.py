@@ -0,0 +1,312 @@
+""" Tests for scan.py """
+
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import unittest
+from bson.objectid import ObjectId
+from mongodec.mongodec import MongoConfig
+from mongodec.filter_mongo import FilterMongoCollection, \
+                                  FilterMongoCollectionSpec
+from mongodec.scan import partitioned_scan, sample_boundaries, \
+                          partition_ranges, partition_query, Partition, \
+                          ScanCheckpoint, FileCheckpoint, process_map, \
+                          type_bracket, scan_projection
+
+
+def bson_order(value):
+    """ Sort key putting values of different types in BSON order """
+    if value is None:
+        return (1, None)
+    elif isinstance(value, (int, long, float)):
+        return (2, value)
+    elif isinstance(value, basestring):
+        return (3, value)
+    return (7, value)
+
+
+class FakeCollection(object):
+    """ Documents {'_id': i, 'tenant': 'a' or 'b'}; understands just the
+        queries scan.py makes, type bracketing included
+    """
+    full_name = 'db.fake'
+
+    def __init__(self, n):
+        self.docs = [{'_id': i, 'tenant': 'ab'[i % 2]} for i in range(n)]
+        self.pipelines = []
+        self.fail_at = None
+
+    def matches(self, doc, query):
+        ops = {'$gte': lambda a, b: a >= b, '$gt': lambda a, b: a > b,
+               '$lt': lambda a, b: a < b, '$eq': lambda a, b: a == b}
+        for k, v in (query or {}).items():
+            if k == '$and':
+                if not all(self.matches(doc, clause) for clause in v):
+                    return False
+            elif k == '$or':
+                if not any(self.matches(doc, clause) for clause in v):
+                    return False
+            elif k == '$expr':
+                [(op, (field, value))] = v.items()
+                field = doc.get(field['$ifNull'][0][1:])
+                if not ops[op](bson_order(field), bson_order(value)):
+                    return False
+            elif isinstance(v, dict) and '$not' in v:
+                if type_bracket(doc.get(k)) == tuple(v['$not']['$type']):
+                    return False
+            elif isinstance(v, dict):
+                if type_bracket(doc.get(k)) is None:
+                    return False
+                for op, bound in v.items():
+                    if (type_bracket(doc[k]) != type_bracket(bound) or
+                        not ops[op](doc[k], bound)):
+                        return False
+            elif doc.get(k) != v:
+                return False
+        return True
+
+    def find(self, filter=None, projection=None, sort=None):
+        docs = sorted(self.docs, key=lambda doc: [bson_order(doc.get(k))
+                                                  for k, _ in sort])
+        for doc in docs:
+            if self.matches(doc, filter):
+                if doc['_id'] == self.fail_at:
+                    raise ValueError('failed at %s' % self.fail_at)
+                if projection:
+                    doc = dict((k, v) for k, v in doc.items()
+                               if projection.get(k, k == '_id'))
+                yield dict(doc)
+
+    def aggregate(self, pipeline):
+        self.pipelines.append(pipeline)
+        key = pipeline[-1]['$project']['key'][1:]
+        query = pipeline[0].get('$match')
+        return [{'key': doc[key]} for doc in self.docs
+                if key in doc and self.matches(doc, query)]
+
+
+class FakeSpec(FilterMongoCollectionSpec):
+    """ Builds its FilterMongoCollection over a FakeCollection """
+    def collection(self):
+        fake = FakeCollection(self.collection_kwargs['n'])
+        return FilterMongoCollection(fake, _filter=self._filter,
+                                     timeout_wrap=False)
+
+
+def pid_and_id(document):
+    if document['_id'] % 10:
+        return (os.getpid(), document['_id'])
+
+
+class TestPartitionedScan(unittest.TestCase):
+
+    def test_scan(self):
+        """ Every filtered document is handled once, across partitions """
+        fake = FakeCollection(100)
+        coll = FilterMongoCollection(fake, _filter={'tenant': 'a'},
+                                     timeout_wrap=False)
+        seen = []
+        lock = threading.Lock()
+
+        def handler(partition, document):
+            with lock:
+                seen.append((partition.index, document['_id']))
+
+        results = partitioned_scan(coll, handler, partitions=4)
+        self.assertEqual(sorted(_id for _, _id in seen), range(0, 100, 2))
+        self.assertEqual([result.count for result in results],
+                         [12, 13, 12, 13, 0])
+        self.assertEqual(fake.pipelines[0][0], {'$match': {'tenant': 'a'}})
+        for index, _id in seen:
+            partition = results[index].partition
+            self.assertTrue(partition.lower is None or _id >= partition.lower)
+            self.assertTrue(partition.upper is None or _id < partition.upper)
+
+
+    def test_resume(self):
+        """ A checkpointed scan picks up where it failed """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'scan.json')
+            fake = FakeCollection(40)
+            fake.fail_at = 25
+            seen = []
+            handler = lambda partition, document: seen.append(document['_id'])
+
+            results = partitioned_scan(fake, handler, boundaries=[20],
+                                       checkpoint=FileCheckpoint(path),
+                                       checkpoint_every=2)
+            self.assertIsNone(results[0].error)
+            self.assertIsInstance(results[1].error, ValueError)
+            self.assertEqual(sorted(seen), range(25))
+
+            fake.fail_at = None
+            results = partitioned_scan(fake, handler, boundaries=[30],
+                                       checkpoint=FileCheckpoint(path))
+            self.assertEqual(sorted(seen), range(40))
+            self.assertEqual([result.count for result in results],
+                             [0, 15, 0])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+    def test_resume_handler_error(self):
+        """ A document whose handler raised is handled again on resume """
+        fake = FakeCollection(10)
+        checkpoint = ScanCheckpoint()
+        seen = []
+
+        def failing(partition, document):
+            if document['_id'] == 5:
+                raise ValueError('handler failed')
+            seen.append(document['_id'])
+
+        results = partitioned_scan(fake, failing, boundaries=[],
+                                   checkpoint=checkpoint, checkpoint_every=1)
+        self.assertIsInstance(results[0].error, ValueError)
+        self.assertEqual(checkpoint.progress(0), ((4, 4), False))
+
+        results = partitioned_scan(
+            fake, lambda partition, document: seen.append(document['_id']),
+            checkpoint=checkpoint)
+        self.assertIsNone(results[0].error)
+        self.assertEqual(seen, range(10))
+
+
+    def test_outside_keys(self):
+        """ Keys missing, null or of another type than the boundaries are
+            scanned too
+        """
+        fake = FakeCollection(10)
+        fake.docs += [{'_id': 'x'}, {'_id': u'y'}]
+        for doc in fake.docs[:8]:
+            doc['k'] = doc['_id'] // 2
+        fake.docs[8]['k'] = None
+        fake.docs[10]['k'] = 'text'
+        seen = []
+        handler = lambda partition, document: seen.append(document['_id'])
+
+        results = partitioned_scan(fake, handler, partitions=3)
+        self.assertEqual(len(results), 4)
+        self.assertEqual(sorted(results[-1].partition.outside), ['number'])
+        self.assertEqual(sorted(seen), range(10) + ['x', 'y'])
+
+        del seen[:]
+        results = partitioned_scan(fake, handler, key='k', boundaries=[2])
+        self.assertEqual(sorted(seen), range(10) + ['x', 'y'])
+        self.assertEqual([result.count for result in results], [4, 4, 4])
+
+
+    def test_resume_shared_keys(self):
+        """ Resuming among documents sharing a key skips none of them """
+        fake = FakeCollection(12)
+        for doc in fake.docs:
+            doc['k'] = doc['_id'] // 4
+        fake.docs[11]['k'] = None
+        fake.docs[10].pop('k')
+        checkpoint = ScanCheckpoint()
+        seen = []
+
+        def failing(partition, document):
+            if document['_id'] in (6, 10):
+                raise ValueError('handler failed')
+            seen.append(document['_id'])
+
+        results = partitioned_scan(fake, failing, key='k', boundaries=[1],
+                                   checkpoint=checkpoint, checkpoint_every=1,
+                                   projection={'tenant': 1})
+        self.assertEqual([result.error is None for result in results],
+                         [True, False, False])
+        self.assertEqual(checkpoint.progress(1), ((1, 5), False))
+        self.assertEqual(checkpoint.progress(2), (None, False))
+
+        def handler(partition, document):
+            self.assertNotIn('k', document)
+            seen.append(document['_id'])
+
+        partitioned_scan(fake, handler, key='k', checkpoint=checkpoint,
+                         projection={'tenant': 1})
+        self.assertEqual(sorted(seen), range(12))
+
+
+    def test_helpers(self):
+        self.assertEqual(partition_ranges([10, 20]),
+                         [Partition(0, None, 10), Partition(1, 10, 20),
+                          Partition(2, 20, None),
+                          Partition(3, None, None, ['number'])])
+        self.assertEqual(partition_ranges([]), [Partition(0, None, None)])
+        self.assertRaises(ValueError, partition_ranges, [1, 'a'])
+        self.assertEqual(partition_query(Partition(1, 10, 20), '_id',
+                                         {'x': 1}),
+                         {'x': 1, '_id': {'$gte': 10, '$lt': 20}})
+        self.assertEqual(partition_query(Partition(1, 10, 20), '_id',
+                                         {'_id': {'$ne': 15}},
+                                         after=(12, 12)),
+                         {'$and': [{'_id': {'$lt': 20}},
+                                   {'_id': {'$gt': 12}}],
+                          '_id': {'$ne': 15}})
+        self.assertEqual(partition_query(Partition(1, 10, 20), 'k',
+                                         after=(12, 'id')),
+                         {'k': {'$lt': 20},
+                          '$or': [{'k': {'$gt': 12}},
+                                  {'$and': [{'k': 12},
+                                            {'_id': {'$gt': 'id'}}]}]})
+        self.assertEqual(partition_query(Partition(3, None, None, ['number']),
+                                         'k', {'x': 1}),
+                         {'x': 1, 'k': {'$not': {'$type': ['number']}}})
+        self.assertEqual(partition_query(Partition(0, None, None), '_id'),
+                         None)
+        self.assertEqual(type_bracket(ObjectId()), ('objectId',))
+        self.assertEqual(type_bracket(u'a'), ('string', 'symbol'))
+        self.assertIsNone(type_bracket(None))
+        self.assertEqual(scan_projection({'_id': 0, 'a': 1}, 'k'),
+                         ({'a': 1, 'k': 1}, ['k', '_id']))
+        self.assertEqual(scan_projection(['a'], '_id'), ({'a': 1}, []))
+
+        fake = FakeCollection(10)
+        self.assertEqual(sample_boundaries(fake, 2, query={'tenant': 'a'}),
+                         [4])
+
+        checkpoint = ScanCheckpoint()
+        checkpoint.record(1, (None, ObjectId('0' * 24)))
+        self.assertEqual(checkpoint.progress(1),
+                         ((None, ObjectId('0' * 24)), False))
+        self.assertEqual(checkpoint.progress(0), (None, False))
+        # Checkpoints from before _ids were recorded resume at the key
+        old = ScanCheckpoint({'boundaries': [], 'partitions': {
+            '0': {'last': 5, 'done': False}}})
+        self.assertEqual(old.progress(0), ((5, None), False))
+
+
+    def test_process_map(self):
+        """ Ranges are read and transformed in worker processes """
+        spec = FakeSpec(None, 'fake', {'tenant': 'a'}, n=100)
+        results = list(process_map(spec, pid_and_id, partitions=4,
+                                   processes=2))
+        self.assertEqual(sorted(_id for _, _id in results),
+                         [i for i in range(0, 100, 2) if i % 10])
+        self.assertNotIn(os.getpid(), set(pid for pid, _ in results))
+
+
+    def test_spec(self):
+        """ Specs pickle without their collection and rebuild it """
+        config = MongoConfig(host='localhost', port=27017, database='db')
+        spec = FilterMongoCollectionSpec(config, 'coll', {'tenant': 'a'},
+                                         stamp=True)
+        collection = spec.collection()
+        self.assertIs(spec.collection(), collection)
+
+        copy = pickle.loads(pickle.dumps(spec))
+        self.assertIsNone(copy.built)
+        rebuilt = copy.collection()
+        self.assertIsNot(rebuilt, collection)
+        self.assertEqual(rebuilt.base_object.full_name, 'db.coll')
+        self.assertEqual(rebuilt.cdict['update_filter'], {'tenant': 'a'})
+        self.assertTrue(rebuilt.cdict['stamp'])
+
+
+
+if __name__ == '__main__':
+    unittest.main()